@@ -0,0 +1,145 @@
+import multiprocessing, os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from prefect import flow, get_run_logger
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+from sr_parser import extract_dxa_report
+from database import get_session
+from ingest import ingest_report
+from metrics import RunMetrics
+from utilities import COMPREHENSIVE_SR_CLASS_UID
+
+
+## Files handed to a worker at once, amortises the inter-process round-trip
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "16"))
+
+
+@flow(name="backfill-reports", log_prints=True)
+def backfill_reports(directory, workers=None, batch_size=BACKFILL_BATCH_SIZE):
+    """Re-ingests every SR found under a directory, e.g. an archive export.
+
+    Parsing is spread over a pool of worker processes, one per core by default,
+    while this process owns the database session and writes the parsed reports
+    as they come back.
+    """
+    logger = get_run_logger()
+    metrics = RunMetrics()
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+    logger.info(f"Backfilling {len(paths)} files from {directory}")
+
+    counts = {"stored": 0, "skipped": 0, "failed": 0, "rows": 0}
+    with get_session() as session:
+        for path, extracted, error in parse_files(paths, workers, batch_size):
+            if error is not None:
+                logger.info(f"Error parsing SR {path} due to {error}")
+                counts["failed"] += 1
+                continue
+            if extracted is None:
+                counts["skipped"] += 1
+                continue
+            metrics.count("reports_parsed")
+
+            try:
+                with metrics.stage("store"):
+                    rows = ingest_report(session, extracted, logger)
+            except Exception as e:
+                logger.info(f"Error saving SR {path} due to {e}")
+                counts["failed"] += 1
+                continue
+            counts["rows"] += rows
+            counts["stored"] += 1
+            metrics.count("rows_inserted", rows)
+
+    logger.info(f"Backfill finished: {counts}")
+    metrics.publish("backfill-reports", logger)
+    return counts
+
+
+def parse_files(paths, workers=None, batch_size=BACKFILL_BATCH_SIZE):
+    """Parses SR files in a process pool.
+
+    At most two batches per worker are in flight, so reports are not parsed
+    faster than they can be stored and memory use stays flat on large archives.
+
+    Args:
+        paths (list): Files to parse, non-SR files are skipped.
+        workers (int): Worker processes, defaults to the number of cores.
+        batch_size (int): Files per task.
+
+    Yields:
+        (path, ExtractedReport or None, error message or None) in completion
+        order.
+    """
+    workers = workers or os.cpu_count()
+    batches = iter(
+        [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    )
+
+    ## Spawned rather than forked so workers do not inherit the connections
+    ## pooled by this process
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pending = set()
+        for batch in batches:
+            pending.add(executor.submit(parse_batch, batch))
+            if len(pending) >= 2 * workers:
+                break
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+                batch = next(batches, None)
+                if batch is not None:
+                    pending.add(executor.submit(parse_batch, batch))
+
+
+def parse_batch(paths):
+    """Runs in a worker process."""
+    results = []
+    for path in paths:
+        try:
+            ## SRs have no pixel data, skipping it makes ruling out the DXA
+            ## images cheap
+            ds = dcmread(path, stop_before_pixels=True)
+        except InvalidDicomError:
+            results.append((path, None, None))
+            continue
+        try:
+            if not COMPREHENSIVE_SR_CLASS_UID in str(ds.get("SOPClassUID", "")):
+                results.append((path, None, None))
+                continue
+            results.append((path, compact(extract_dxa_report(ds)), None))
+        except Exception as e:
+            results.append((path, None, str(e)))
+    return results
+
+
+def plain(value):
+    ## pydicom's DSfloat, IS and UID pickle with their element state, plain
+    ## values make the batches sent back to the writer about 3x smaller
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return value
+
+
+def compact(extracted):
+    return extracted._replace(
+        header={key: plain(value) for key, value in extracted.header.items()},
+        bmd_values=[
+            type(row)(*map(plain, row)) for row in extracted.bmd_values
+        ],
+        bmd_trend_values=[
+            type(row)(*map(plain, row)) for row in extracted.bmd_trend_values
+        ],
+    )
@@ -0,0 +1,190 @@
+"""Runs synthetic DXA SRs through parse, ingest and findings generation and
+compares the throughput with a stored baseline.
+
+Every stage reports studies/s and p50/p99 per-study latency, parse also
+reports content items/s and ingest rows/s. Studies come in pairs of visits a
+year apart per patient whose trend tables overlap, so ingest also exercises
+the trend points shared between a patient's reports. The run checks that some
+trend rows were stored once for both studies.
+
+Run from the flow directory, on a throwaway SQLite file by default or on a
+scratch Postgres database:
+
+    python -m benchmarks.e2e_bench --studies 200 --trend-length 10
+    python -m benchmarks.e2e_bench --database-uri postgresql://... --save-baseline
+
+Body parts and regions default to those in benchmarks.synthetic and can be
+narrowed with --body-part "Left Femur=Neck,Total", repeated per body part.
+
+Results are compared with the entry of baselines.json recorded for the same
+database, study count and SR shape. The run fails when a stage's throughput
+drops by more than --tolerance. Baselines depend on the machine, so record new
+ones with --save-baseline after hardware changes and when a change makes a
+stage faster.
+"""
+
+import argparse, io, json, os, statistics, sys, tempfile, time
+from datetime import date
+from pydicom import dcmread
+from pydicom.filewriter import dcmwrite
+from benchmarks.synthetic import BODY_PART_REGIONS, make_dxa_sr, count_content_items
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+STAGES = ["parse", "ingest", "findings"]
+
+
+def make_studies(studies, trend_length, body_part_regions, seed=0):
+    """Returns (accession, SR file bytes, content items) per synthetic study.
+
+    Ids are unique per run so repeated runs on one database ingest new rows.
+    """
+    run = f"{int(time.time()) % 10**6:06d}"
+    generated = []
+    for i in range(studies):
+        ds = make_dxa_sr(
+            body_part_regions=body_part_regions,
+            trend_length=trend_length,
+            patient_id=f"BENCH{run}P{i // 2}",
+            accession=f"BENCH{run}A{i}",
+            study_date=date(2023 + i % 2, 6, 1),
+            seed=seed + i,
+        )
+        buffer = io.BytesIO()
+        dcmwrite(buffer, ds, write_like_original=False)
+        generated.append((ds.AccessionNumber, buffer.getvalue(), count_content_items(ds)))
+    return generated
+
+
+def run(generated):
+    """Times every stage of every study.
+
+    Returns:
+        (figures per stage, trend rows parsed, trend rows stored)
+    """
+    from sqlalchemy import func, select
+    from sr_parser import extract_dxa_report
+    from data_models import BMDTrendValue
+    from database import get_session
+    from ingest import ingest_report
+    from bmd_utilities import process_sample
+
+    latencies = {stage: [] for stage in STAGES}
+    items = rows = trend_rows = 0
+    with get_session() as session:
+        count_trend_rows = select(func.count(BMDTrendValue.id))
+        trend_rows_before = session.execute(count_trend_rows).scalar()
+        for accession, data, content_items in generated:
+            start = time.perf_counter()
+            extracted = extract_dxa_report(dcmread(io.BytesIO(data)))
+            latencies["parse"].append(time.perf_counter() - start)
+            items += content_items
+            trend_rows += len(extracted.bmd_trend_values)
+
+            start = time.perf_counter()
+            rows += ingest_report(session, extracted)
+            latencies["ingest"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            process_sample(accession)
+            latencies["findings"].append(time.perf_counter() - start)
+
+        trend_rows_stored = session.execute(count_trend_rows).scalar() - trend_rows_before
+
+    results = {}
+    for stage, values in latencies.items():
+        total = sum(values)
+        values = sorted(values)
+        results[stage] = {
+            "studies_per_second": len(values) / total,
+            "p50_ms": statistics.median(values) * 1e3,
+            "p99_ms": values[min(len(values) - 1, int(len(values) * 0.99))] * 1e3,
+        }
+    results["parse"]["items_per_second"] = items / sum(latencies["parse"])
+    results["ingest"]["rows_per_second"] = rows / sum(latencies["ingest"])
+    return results, trend_rows, trend_rows_stored
+
+
+def baseline_key(dialect, studies, trend_length, body_part_regions):
+    regions = sum(len(regions) for regions in body_part_regions.values())
+    return f"{dialect}/studies={studies}/trend={trend_length}/regions={regions}"
+
+
+def compare(results, baseline, tolerance):
+    """Prints every figure next to its baseline, returns the regressed stages."""
+    regressions = []
+    for stage, figures in results.items():
+        for name, value in figures.items():
+            line = f"{stage} {name}: {value:.1f}"
+            reference = baseline.get(stage, {}).get(name)
+            if reference:
+                line += f" (baseline {reference:.1f}, {value / reference - 1:+.0%})"
+            print(line)
+
+        reference = baseline.get(stage, {}).get("studies_per_second")
+        if reference and figures["studies_per_second"] < reference * (1 - tolerance):
+            regressions.append(stage)
+    return regressions
+
+
+def parse_body_parts(values):
+    if not values:
+        return BODY_PART_REGIONS
+    body_part_regions = {}
+    for value in values:
+        body_part, _, regions = value.partition("=")
+        body_part_regions[body_part] = (
+            regions.split(",") if regions else BODY_PART_REGIONS[body_part]
+        )
+    return body_part_regions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--database-uri", help="defaults to a temporary SQLite file")
+    parser.add_argument("--studies", type=int, default=200)
+    parser.add_argument("--trend-length", type=int, default=5)
+    parser.add_argument("--body-part", action="append", metavar="NAME[=REGION,...]")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    ## database reads DATABASE_URI when the engine is first built
+    directory = tempfile.TemporaryDirectory()
+    os.environ["DATABASE_URI"] = args.database_uri or (
+        f"sqlite:///{os.path.join(directory.name, 'bench.db')}"
+    )
+    from database import get_engine, init_db
+
+    init_db()
+
+    body_part_regions = parse_body_parts(args.body_part)
+    generated = make_studies(args.studies, args.trend_length, body_part_regions)
+    results, trend_rows, trend_rows_stored = run(generated)
+    print(f"{trend_rows} trend rows parsed, {trend_rows_stored} stored")
+    ## Every second study repeats its patient's earlier visits
+    if args.studies >= 2 and args.trend_length >= 2:
+        assert trend_rows_stored < trend_rows, "no trend rows were shared between studies"
+
+    key = baseline_key(
+        get_engine().dialect.name, args.studies, args.trend_length, body_part_regions
+    )
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+
+    print(key)
+    regressions = compare(results, baselines.get(key, {}), args.tolerance)
+
+    if args.save_baseline:
+        baselines[key] = results
+        with open(args.baselines, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Saved baseline to {args.baselines}")
+    elif regressions:
+        print(f"Slower than baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
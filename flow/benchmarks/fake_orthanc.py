@@ -0,0 +1,359 @@
+"""Local stand-in for Orthanc, for exercising the pipeline without a PACS.
+
+FakeOrthanc serves the REST endpoints the flows use from a directory of DICOM
+files, FakeStoreSCP accepts the C-STORE of the generated SRs. Both can add
+latency and fail a share of the requests, to load-test throughput and retries.
+
+Serve a fixture directory, generating synthetic SRs into it when it is empty,
+then point ORTHANC_URL and PACS_HOST/PACS_PORT at it:
+
+    python -m benchmarks.fake_orthanc ./fixtures --generate 100 --latency 0.05
+"""
+
+import argparse, hashlib, io, json, os, random, threading, time, zipfile
+from urllib.parse import parse_qs, urlsplit
+from collections import Counter
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pydicom import dcmread
+from pynetdicom import AE, evt, AllStoragePresentationContexts
+
+## Tags copied to MainDicomTags, as Orthanc does for its lookups
+STUDY_TAGS = ["StudyInstanceUID", "AccessionNumber", "StudyDate", "PatientID"]
+SERIES_TAGS = ["SeriesInstanceUID", "Modality"]
+
+
+def orthanc_id(*uids):
+    ## Orthanc ids are a SHA-1 of the DICOM identifiers split in 5 groups
+    digest = hashlib.sha1("|".join(uids).encode()).hexdigest()
+    return "-".join(digest[i : i + 8] for i in range(0, 40, 8))
+
+
+def index_fixtures(directory):
+    """Reads the headers of every DICOM file under a directory.
+
+    Returns:
+        (studies, series, instances) dicts keyed by Orthanc-style id.
+    """
+    studies, series, instances = {}, {}, {}
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            ds = dcmread(path, stop_before_pixels=True)
+            study_id = orthanc_id(ds.PatientID, ds.StudyInstanceUID)
+            series_id = orthanc_id(ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID)
+            instance_id = orthanc_id(
+                ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID
+            )
+
+            study = studies.setdefault(
+                study_id,
+                {
+                    "ID": study_id,
+                    "MainDicomTags": {tag: str(ds.get(tag, "")) for tag in STUDY_TAGS},
+                    "Series": [],
+                },
+            )
+            if series_id not in series:
+                study["Series"].append(series_id)
+                series[series_id] = {
+                    "ID": series_id,
+                    "ParentStudy": study_id,
+                    "MainDicomTags": {tag: str(ds.get(tag, "")) for tag in SERIES_TAGS},
+                    "Instances": [],
+                }
+            series[series_id]["Instances"].append(instance_id)
+            instances[instance_id] = path
+    return studies, series, instances
+
+
+class FakeOrthanc(ThreadingHTTPServer):
+    """Serves /studies, /series, /instances, /studies/{id}/media,
+    /tools/find and /changes from a fixture directory.
+
+    The changes feed holds one StableStudy change per study, more are logged
+    with add_change.
+
+    Args:
+        address (tuple): (host, port) to listen on, port 0 picks a free one.
+        directory (str): DICOM files to serve.
+        latency (float): Seconds added to every request.
+        failure_rate (float): Share of requests answered with a 503.
+        seed: Seed for the failures.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, directory, latency=0.0, failure_rate=0.0, seed=None):
+        super().__init__(address, FakeOrthancHandler)
+        self.studies, self.series, self.instances = index_fixtures(directory)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = Counter()
+        self.changes = []
+        for study_id in self.studies:
+            self.add_change("StableStudy", "Study", study_id)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def add_change(self, change_type, resource_type, resource_id):
+        self.changes.append(
+            {
+                "Seq": len(self.changes) + 1,
+                "ChangeType": change_type,
+                "ResourceType": resource_type,
+                "ID": resource_id,
+            }
+        )
+
+    def get_changes(self, since=0, limit=100, last=False):
+        end = len(self.changes)
+        if last:
+            return {"Changes": self.changes[-1:], "Done": True, "Last": end}
+        page = self.changes[since : since + limit]
+        return {
+            "Changes": page,
+            "Done": since + len(page) >= end,
+            "Last": page[-1]["Seq"] if page else end,
+        }
+
+    def count(self, name):
+        with self._lock:
+            self.requests[name] += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def find(self, query):
+        ## Only the StudyDate range used by find_studies is supported
+        low, _, high = query.get("StudyDate", "-").partition("-")
+        return [
+            study_id
+            for study_id, study in self.studies.items()
+            if (low or "0") <= study["MainDicomTags"]["StudyDate"] <= (high or "9")
+        ]
+
+    def media(self, study_id):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            index = 0
+            for series_id in self.studies[study_id]["Series"]:
+                for instance_id in self.series[series_id]["Instances"]:
+                    zip_file.write(self.instances[instance_id], f"IMAGES/IM{index}")
+                    index += 1
+        return archive.getvalue()
+
+
+class FakeOrthancHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ## Headers and body are separate writes on a keep-alive connection, with
+    ## Nagle's algorithm the body waits for the client's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type="application/json", status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        server = self.server
+        if method == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        server.count(method)
+
+        time.sleep(server.latency)
+        if server.should_fail():
+            server.count("failed")
+            self.send_body({"Message": "Injected failure"}, status=503)
+            return
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        resource, resource_id, *rest = url.path.strip("/").split("/") + [None]
+        rest = [part for part in rest if part is not None]
+        if method == "POST" and (resource, resource_id) == ("tools", "find"):
+            self.send_body(server.find(body.get("Query", {})))
+        elif method != "GET":
+            self.send_body({"Message": "Unknown resource"}, status=404)
+        elif resource == "changes" and resource_id is None:
+            self.send_body(
+                server.get_changes(
+                    since=int(query.get("since", ["0"])[0]),
+                    limit=int(query.get("limit", ["100"])[0]),
+                    last="last" in query,
+                )
+            )
+        elif resource == "studies" and resource_id in server.studies and not rest:
+            self.send_body(server.studies[resource_id])
+        elif resource == "studies" and resource_id in server.studies and rest == ["series"]:
+            series = server.studies[resource_id]["Series"]
+            self.send_body([server.series[series_id] for series_id in series])
+        elif resource == "studies" and resource_id in server.studies and rest == ["media"]:
+            self.send_body(server.media(resource_id), "application/zip")
+        elif resource == "series" and resource_id in server.series and not rest:
+            self.send_body(server.series[resource_id])
+        elif resource == "instances" and resource_id in server.instances and rest == ["file"]:
+            with open(server.instances[resource_id], "rb") as file:
+                self.send_body(file.read(), "application/dicom")
+        else:
+            self.send_body({"Message": "Unknown resource"}, status=404)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class FakeStoreSCP:
+    """C-STORE SCP that counts what it receives instead of storing it.
+
+    Args:
+        address (tuple): (host, port) to listen on, port 0 picks a free one.
+        ae_title (str): Called AE title to accept.
+        latency (float): Seconds added to every C-STORE.
+        failure_rate (float): Share of C-STOREs answered with 0xA700 (out of
+            resources).
+        abort_rate (float): Share of C-STOREs that abort the association
+            instead of answering, as a peer dropping the connection would.
+        seed: Seed for the failures and aborts.
+    """
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        ae_title="ORTHANC",
+        latency=0.0,
+        failure_rate=0.0,
+        abort_rate=0.0,
+        seed=None,
+    ):
+        self.address = address
+        self.ae_title = ae_title
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.abort_rate = abort_rate
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+        self._ae = AE(ae_title=ae_title)
+        self._ae.supported_contexts = AllStoragePresentationContexts
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._server = self._ae.start_server(
+            self.address,
+            block=False,
+            evt_handlers=[
+                (evt.EVT_C_STORE, self.handle_store),
+                (evt.EVT_CONN_OPEN, self.handle_open),
+            ],
+        )
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def handle_open(self, event):
+        with self._lock:
+            self.counts["associations"] += 1
+
+    def handle_store(self, event):
+        time.sleep(self.latency)
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.abort_rate:
+                self.counts["aborted"] += 1
+                outcome = "abort"
+            elif draw < self.abort_rate + self.failure_rate:
+                self.counts["failed"] += 1
+                outcome = "fail"
+            else:
+                self.counts["stored"] += 1
+                outcome = "store"
+
+        if outcome == "abort":
+            event.assoc.abort()
+            return 0xA700
+        if outcome == "fail":
+            return 0xA700
+        return 0x0000
+
+
+def generate_fixtures(directory, studies, trend_length=5, seed=0):
+    """Writes one synthetic DXA SR per study, two visits per patient."""
+    from benchmarks.synthetic import make_dxa_sr
+
+    os.makedirs(directory, exist_ok=True)
+    for i in range(studies):
+        ds = make_dxa_sr(
+            trend_length=trend_length,
+            patient_id=f"FAKE{i // 2:06d}",
+            accession=f"FAKE{i:08d}",
+            study_date=date(2023 + i % 2, 6, 1),
+            seed=seed + i,
+        )
+        ds.save_as(os.path.join(directory, f"{ds.SOPInstanceUID}.dcm"), write_like_original=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--generate", type=int, default=0, metavar="STUDIES")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--http-port", type=int, default=8042)
+    parser.add_argument("--dicom-port", type=int, default=4242)
+    parser.add_argument("--ae-title", default="ORTHANC")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--store-latency", type=float, default=0.0)
+    parser.add_argument("--store-failure-rate", type=float, default=0.0)
+    parser.add_argument("--store-abort-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.generate and not (os.path.isdir(args.directory) and os.listdir(args.directory)):
+        generate_fixtures(args.directory, args.generate)
+
+    orthanc = FakeOrthanc(
+        (args.host, args.http_port), args.directory, args.latency, args.failure_rate
+    ).start()
+    scp = FakeStoreSCP(
+        (args.host, args.dicom_port),
+        args.ae_title,
+        args.store_latency,
+        args.store_failure_rate,
+        args.store_abort_rate,
+    ).start()
+    print(f"Serving {len(orthanc.studies)} studies on {orthanc.url}, C-STORE on port {scp.port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"HTTP {dict(orthanc.requests)}, C-STORE {dict(scp.counts)}")
+    except KeyboardInterrupt:
+        orthanc.shutdown()
+        scp.stop()
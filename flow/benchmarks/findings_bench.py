@@ -0,0 +1,100 @@
+"""Compares findings generation on pandas frames with the StudyMeasurements path.
+
+LSC thresholds are read from a throwaway SQLite file seeded with the default
+table. Run from the flow directory:
+
+    python -m benchmarks.findings_bench --iterations 500
+"""
+
+import argparse, os, random, tempfile, time
+import pandas as pd
+from bmd_utilities import return_findings, findings_from_measurements
+from measurements import StudyMeasurements
+from benchmarks.legacy_findings import return_findings as legacy_return_findings
+from benchmarks.synthetic import BODY_PART_REGIONS
+
+
+def make_study_frames(trend_length=5, seed=0):
+    """Builds studies / bmd_values / bmd_trend_values frames for one study."""
+    rng = random.Random(seed)
+    bmd_values = []
+    bmd_trend_values = []
+    for body_part, regions in BODY_PART_REGIONS.items():
+        for region in regions:
+            bmd_values.append(
+                {
+                    "study_id": 1,
+                    "body_part": body_part,
+                    "region": region,
+                    "bmd": round(rng.uniform(0.6, 1.3), 3),
+                    "t_score": round(rng.uniform(-4, 2), 1),
+                    "z_score": round(rng.uniform(-3, 2), 1),
+                }
+            )
+            for visit in range(1, trend_length + 1):
+                bmd_trend_values.append(
+                    {
+                        "study_id": 1,
+                        "body_part": body_part,
+                        "region": f"Trend {region}",
+                        "date": pd.Timestamp(2024 - visit, 6, 1),
+                        "bmd": round(rng.uniform(0.6, 1.3), 3),
+                    }
+                )
+    studies = pd.DataFrame(
+        [
+            {
+                "id": 1,
+                "institution_name": "Mississauga Hospital",
+                "date_time": pd.Timestamp(2024, 6, 1, 9, 30),
+            }
+        ]
+    )
+    return studies, pd.DataFrame(bmd_values), pd.DataFrame(bmd_trend_values)
+
+
+def time_call(function, iterations):
+    function()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def run(iterations=200, trend_length=5):
+    studies, bmd_values, bmd_trend_values = make_study_frames(trend_length)
+    args = (1, "male", 65, studies, bmd_values, bmd_trend_values)
+
+    assert legacy_return_findings(*args) == return_findings(*args)
+
+    measurements = StudyMeasurements.from_frames(
+        studies["date_time"].values[0], bmd_values, bmd_trend_values
+    )
+    return {
+        "pandas": time_call(lambda: legacy_return_findings(*args), iterations),
+        "measurements (incl. build)": time_call(
+            lambda: return_findings(*args), iterations
+        ),
+        "measurements (prebuilt)": time_call(
+            lambda: findings_from_measurements(
+                1, "male", 65, "Mississauga Hospital", measurements
+            ),
+            iterations,
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--trend-length", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(directory.name, 'bench.db')}"
+    from database import init_db
+
+    init_db()
+
+    for name, seconds in run(args.iterations, args.trend_length).items():
+        print(f"{name}: {seconds * 1e6:.0f} us/study")
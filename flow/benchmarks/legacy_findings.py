@@ -0,0 +1,390 @@
+"""Frozen copy of the pandas implementation of return_findings.
+
+Kept only as the baseline for benchmarks.findings_bench, do not use it in the
+flow. The shared helpers are imported from bmd_utilities.
+"""
+
+import pandas as pd
+from bmd_utilities import (
+    format_score,
+    get_change_type,
+    filter_vertebra_by_tscore,
+    select_vertebra_combination,
+    get_diagnostic_category,
+)
+
+
+def return_prev_exam_dates(sample, study_id, bmd_trend_values):
+    study_date = sample["date_time"].values[0]
+    study_date_normalized = pd.to_datetime(study_date).normalize()
+
+    subset = bmd_trend_values[(bmd_trend_values.study_id == study_id)]
+    filtered_bmd_trend_values = subset[(subset["date"] < study_date_normalized)]
+
+    if len(filtered_bmd_trend_values) == 0:
+        return None, None
+    else:
+        ## previous
+        reference_date_row = filtered_bmd_trend_values.loc[
+            filtered_bmd_trend_values["date"].idxmax()
+        ]
+        reference_date_str = reference_date_row["date"]
+
+        grouped = filtered_bmd_trend_values.groupby("date")["body_part"].apply(set)
+        required_parts = set(filtered_bmd_trend_values["body_part"].unique())
+        valid_dates = grouped[grouped.apply(lambda x: required_parts.issubset(x))]
+
+        if len(valid_dates) == 0:
+            baseline_date_str = None
+        else:
+            baseline_date_str = valid_dates.index.min()
+
+        return reference_date_str, baseline_date_str
+
+
+def get_findings_text(
+    findings_df, age, findings_type, reference=None, cannot_be_compared=False
+):
+    bmd = findings_df["bmd"].values[0]
+    t_score = findings_df["t_score"].values[0]
+    z_score = findings_df["z_score"].values[0]
+
+    findings = []
+
+    if age >= 50:
+        findings.append(
+            f"{findings_type} = {bmd} g/cm2. T-score = {format_score(t_score)}"
+        )
+    else:
+        findings.append(
+            f"{findings_type} = {bmd} g/cm2. Z-score = {format_score(z_score)}"
+        )
+
+    if reference is not None and not reference.empty and not cannot_be_compared:
+        reference_bmd = reference["bmd"].values[0]
+        change = bmd - reference_bmd
+        change_type = ""
+        if change > 0:
+            change_type = "increased"
+        else:
+            change_type = "decreased"
+        percent_change = change / reference_bmd * 100
+        findings.append(
+            f"This value has {change_type} by {abs(round(change, 3))} g/cm2 ({abs(round(percent_change, 1))}%) compared to the previous."
+        )
+
+    findings.append("\n")
+    return " ".join(findings)
+
+
+def get_numerical_values(findings_df, age):
+    t_score = findings_df["t_score"].values[0]
+    z_score = findings_df["z_score"].values[0]
+    if age >= 50:
+        return t_score
+    else:
+        return z_score
+
+
+def get_change_value(findings_df, reference_df):
+    bmd = findings_df["bmd"].values[0]
+    if reference_df is not None and not reference_df.empty:
+        reference_bmd = reference_df["bmd"].values[0]
+        change = bmd - reference_bmd
+        change = round(change, 3)
+        return change
+    else:
+        return None
+
+
+def return_findings(
+    study_id,
+    sex,
+    age,
+    studies,
+    bmd_values,
+    bmd_trend_values,
+):
+    findings = []
+    scores = []
+    lumbar_scores = 0
+    change_values = []
+
+    study = studies.loc[studies.id == study_id]
+
+    institution_name = study["institution_name"].values[0]
+
+    report = bmd_values.loc[bmd_values.study_id == study_id]
+
+    if report.empty:
+        raise ValueError(f"No bmd_values for {study_id}")
+
+    reference_date_str, baseline_date_str = return_prev_exam_dates(
+        study, study_id, bmd_trend_values
+    )
+
+    report_reference = bmd_trend_values.loc[
+        (bmd_trend_values.study_id == study_id)
+        & (bmd_trend_values.date == reference_date_str)
+    ]
+
+    lumbar_spine = report.loc[report.body_part == "AP Spine"]
+    l1_l4 = None
+
+    if not lumbar_spine.empty:
+
+        exclude_l4 = False
+
+        if age >= 50:
+            l1 = lumbar_spine.loc[lumbar_spine.region == "L1"]
+            l2 = lumbar_spine.loc[lumbar_spine.region == "L2"]
+            l3 = lumbar_spine.loc[lumbar_spine.region == "L3"]
+            l4 = lumbar_spine.loc[lumbar_spine.region == "L4"]
+
+            t_scores = {
+                "L1": l1["t_score"].values[0] if not l1.empty else None,
+                "L2": l2["t_score"].values[0] if not l2.empty else None,
+                "L3": l3["t_score"].values[0] if not l3.empty else None,
+                "L4": l4["t_score"].values[0] if not l4.empty else None,
+            }
+
+            filtered_t_scores = filter_vertebra_by_tscore(t_scores)
+
+            # Select the best vertebra combination
+            selected_combination = select_vertebra_combination(filtered_t_scores)
+
+            if selected_combination != ["L1", "L2", "L3", "L4"]:
+                exclude_l4 = True
+
+        if not exclude_l4:
+            l1_l4 = lumbar_spine.loc[lumbar_spine.region == "L1-L4"]
+            l1_l4_reference = report_reference.loc[
+                report_reference.region == "Trend L1-L4"
+            ]
+            if l1_l4 is not None and not l1_l4.empty:
+                findings.append(
+                    get_findings_text(
+                        l1_l4,
+                        age,
+                        "LUMBAR SPINE (L1-L4)",
+                        l1_l4_reference,
+                    )
+                )
+                value = get_change_value(l1_l4, l1_l4_reference)
+                if value != None:
+                    change_values.append(
+                        get_change_type(value, "lumbar spine", institution_name)
+                    )
+                scores.append(get_numerical_values(l1_l4, age))
+                lumbar_scores = get_numerical_values(l1_l4, age)
+
+        elif selected_combination == ["L1", "L2", "L3"]:
+            l1_l3 = lumbar_spine.loc[lumbar_spine.region == "L1-L3"]
+            l1_l3_reference = report_reference.loc[
+                report_reference.region == "Trend L1-L3"
+            ]
+            if not l1_l3.empty:
+                findings.append(
+                    get_findings_text(
+                        l1_l3,
+                        age,
+                        "LUMBAR SPINE (L1-L3)",
+                        l1_l3_reference,
+                    )
+                )
+                findings.append(
+                    "L4 has been excluded from these calculations because it is significantly different than all the other vertebral bodies.\n"
+                )
+                value = get_change_value(l1_l3, l1_l3_reference)
+                if value != None:
+                    change_values.append(
+                        get_change_type(value, "lumbar spine", institution_name)
+                    )
+                scores.append(get_numerical_values(l1_l3, age))
+                lumbar_scores = get_numerical_values(l1_l3, age)
+
+        elif selected_combination == ["L2", "L3", "L4"]:
+            l2_l4 = lumbar_spine.loc[lumbar_spine.region == "L2-L4"]
+            l2_l4_reference = report_reference.loc[
+                report_reference.region == "Trend L2-L4"
+            ]
+            if not l2_l4.empty:
+                findings.append(
+                    get_findings_text(
+                        l2_l4,
+                        age,
+                        "LUMBAR SPINE (L2-L4)",
+                        l2_l4_reference,
+                    )
+                )
+                findings.append(
+                    "L1 has been excluded from these calculations because it is significantly different than all the other vertebral bodies.\n"
+                )
+                value = get_change_value(l2_l4, l2_l4_reference)
+                if value != None:
+                    change_values.append(
+                        get_change_type(value, "lumbar spine", institution_name)
+                    )
+                scores.append(get_numerical_values(l2_l4, age))
+                lumbar_scores = get_numerical_values(l2_l4, age)
+        else:
+            findings.append(
+                "LUMBAR SPINE: L1 and L4 have both been excluded from these calculations has been excluded from these calculations because it is significantly different than all the other vertebral bodies. No valid scores to report.\n"
+            )
+
+    else:
+        findings.append("Lumbar spine: No valid scans available.")
+
+    left_femur = report.loc[report.body_part == "Left Femur"]
+    if not left_femur.empty:
+        neck = left_femur.loc[left_femur.region == "Neck"]
+        neck_reference = report_reference.loc[report_reference.region == "Trend Neck"]
+        if not neck.empty:
+            if sex == "male":
+                if age >= 50:
+                    min_neck = neck.loc[neck["t_score"] == neck["t_score"].min()]
+                else:
+                    min_neck = neck.loc[neck["z_score"] == neck["z_score"].min()]
+                findings.append(
+                    get_findings_text(
+                        min_neck,
+                        age,
+                        "LEFT FEMORAL NECK",
+                        neck_reference,
+                    )
+                )
+                scores.append(get_numerical_values(min_neck, age))
+
+                if age >= 50:
+                    max_neck = neck.loc[neck["t_score"] == neck["t_score"].max()]
+                else:
+                    max_neck = neck.loc[neck["z_score"] == neck["z_score"].max()]
+                findings.append(
+                    get_findings_text(
+                        max_neck, age, "LEFT FEMORAL NECK (FEMALE REFERENCE)"
+                    )
+                )
+
+            else:
+                findings.append(
+                    get_findings_text(
+                        neck,
+                        age,
+                        "LEFT FEMORAL NECK",
+                        neck_reference,
+                    )
+                )
+                scores.append(get_numerical_values(neck, age))
+
+        total = left_femur.loc[left_femur.region == "Total"]
+        total_reference = report_reference.loc[report_reference.region == "Trend Total"]
+        if not total.empty:
+            if sex == "male":
+                if age >= 50:
+                    min_total = total.loc[total["t_score"] == total["t_score"].min()]
+                else:
+                    min_total = total.loc[total["z_score"] == total["z_score"].min()]
+                findings.append(
+                    get_findings_text(
+                        min_total,
+                        age,
+                        "TOTAL PROXIMAL LEFT FEMUR",
+                        total_reference,
+                    )
+                )
+                value = get_change_value(total, total_reference)
+                if value:
+                    change_values.append(
+                        get_change_type(value, "hip", institution_name)
+                    )
+                scores.append(get_numerical_values(min_total, age))
+            else:
+                findings.append(
+                    get_findings_text(
+                        total,
+                        age,
+                        "TOTAL PROXIMAL LEFT FEMUR",
+                        total_reference,
+                    )
+                )
+                value = get_change_value(total, total_reference)
+                if value:
+                    change_values.append(
+                        get_change_type(value, "hip", institution_name)
+                    )
+                scores.append(get_numerical_values(total, age))
+
+    left_forearm = report.loc[report.body_part == "Left Forearm"]
+    if not left_forearm.empty:
+        radius_1_3 = left_forearm.loc[left_forearm.region == "Radius 33%"]
+        radius_1_3_reference = report_reference.loc[
+            report_reference.region == "Trend Radius 33%"
+        ]
+        if not radius_1_3.empty:
+            findings.append(
+                get_findings_text(
+                    radius_1_3, age, "1/3 LEFT RADIUS", radius_1_3_reference
+                )
+            )
+            scores.append(get_numerical_values(radius_1_3, age))
+
+    right_femur = report.loc[report.body_part == "Right Femur"]
+    if not right_femur.empty:
+        neck = right_femur.loc[right_femur.region == "Neck"]
+        if not neck.empty:
+            if sex == "male":
+                if age >= 50:
+                    min_neck = neck.loc[neck["t_score"] == neck["t_score"].min()]
+                else:
+                    min_neck = neck.loc[neck["z_score"] == neck["z_score"].min()]
+                findings.append(get_findings_text(min_neck, age, "RIGHT FEMORAL NECK"))
+                scores.append(get_numerical_values(min_neck, age))
+
+                if age >= 50:
+                    max_neck = neck.loc[neck["t_score"] == neck["t_score"].max()]
+                else:
+                    max_neck = neck.loc[neck["z_score"] == neck["z_score"].max()]
+                findings.append(
+                    get_findings_text(
+                        max_neck, age, "RIGHT FEMORAL NECK (FEMALE REFERENCE)"
+                    )
+                )
+
+            else:
+                findings.append(get_findings_text(neck, age, "RIGHT FEMORAL NECK"))
+                scores.append(get_numerical_values(neck, age))
+
+        total = right_femur.loc[right_femur.region == "Total"]
+        if not total.empty:
+            if sex == "male":
+                if age >= 50:
+                    min_total = total.loc[total["t_score"] == total["t_score"].min()]
+                else:
+                    min_total = total.loc[total["z_score"] == total["z_score"].min()]
+                findings.append(
+                    get_findings_text(min_total, age, "TOTAL PROXIMAL RIGHT FEMUR")
+                )
+                scores.append(get_numerical_values(min_total, age))
+            else:
+                findings.append(
+                    get_findings_text(total, age, "TOTAL PROXIMAL RIGHT FEMUR")
+                )
+                scores.append(get_numerical_values(total, age))
+
+    left_forearm = report.loc[report.body_part == "Right Forearm"]
+    if not left_forearm.empty:
+        radius_1_3 = left_forearm.loc[left_forearm.region == "Radius 33%"]
+        if not radius_1_3.empty:
+            findings.append(get_findings_text(radius_1_3, age, "1/3 RIGHT RADIUS"))
+            scores.append(get_numerical_values(radius_1_3, age))
+
+    if len(scores) == 0:
+        raise ValueError(f"No t/z scires have been found study {study_id}")
+
+    diagnostic_category = get_diagnostic_category(age, scores)
+    findings.append(f"BONE MINERAL DENSITY: {diagnostic_category}\n")
+
+    return (
+        "\n".join(findings),
+        diagnostic_category,
+    )
@@ -0,0 +1,191 @@
+"""Load-tests study downloads and C-STORE sends against the local Orthanc
+stand-in, with injected latency and failures.
+
+Downloads go through the same helpers as download_study, in the "instances"
+and "archive" retrieve modes and with the async client, on --concurrency
+threads or tasks. Sends go through AssociationManager. Failed studies are
+retried as many times as the download_study and send_ds tasks retry, without
+the delay between attempts.
+
+Run from the flow directory:
+
+    python -m benchmarks.orthanc_load_bench --studies 50 --latency 0.05 --failure-rate 0.05 \\
+        --store-latency 0.02 --store-abort-rate 0.05
+"""
+
+import argparse, os, shutil, statistics, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+import anyio
+from pydicom import dcmread
+from main import download_study, download_archive, download_sr_instances, select_sr_instances, send_ds
+from orthanc_client import AsyncOrthancClient
+from pacs import AssociationManager
+from utilities import create_sr, orthanc_get_session
+from benchmarks.fake_orthanc import FakeOrthanc, FakeStoreSCP, generate_fixtures
+
+
+class Attempts:
+    """Per-item latencies (retries included), retries and failures of a run."""
+
+    def __init__(self):
+        self.latencies = []
+        self.retries = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def add(self, start, retries, size=0, failed=False):
+        self.latencies.append(time.perf_counter() - start)
+        self.retries += retries
+        self.failures += failed
+        self.bytes += size or 0
+
+    def report(self, name, wall):
+        latencies = sorted(self.latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        throughput = f"{len(latencies) / wall:.1f}/s"
+        if self.bytes:
+            throughput += f", {self.bytes / wall / 1e6:.2f} MB/s"
+        print(
+            f"{name}: {throughput}, "
+            f"p50 {statistics.median(latencies) * 1e3:.1f} ms, p99 {p99 * 1e3:.1f} ms, "
+            f"{self.retries} retries, {self.failures} failed"
+        )
+
+
+def with_retries(function, retries, attempts, *args):
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            result = function(*args)
+        except Exception:
+            if attempt == retries:
+                attempts.add(start, attempt, failed=True)
+                return None
+            continue
+        attempts.add(start, attempt, result)
+        return result
+
+
+def download_sync(mode, url_root, orthanc_study_uids, concurrency):
+    helper = download_archive if mode == "archive" else download_sr_instances
+    session = orthanc_get_session()
+    attempts = Attempts()
+
+    def download(orthanc_study_uid):
+        with_retries(helper, download_study.retries, attempts, session, url_root, orthanc_study_uid)
+        shutil.rmtree(f"./{orthanc_study_uid}", ignore_errors=True)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(download, orthanc_study_uids))
+    return attempts
+
+
+def download_async(url_root, orthanc_study_uids, concurrency):
+    attempts = Attempts()
+
+    async def download(client, orthanc_study_uid):
+        series = await client.get_json(f"/studies/{orthanc_study_uid}/series")
+        os.makedirs(f"./{orthanc_study_uid}/IMAGES", exist_ok=True)
+        size = 0
+        for instance_id in select_sr_instances(series):
+            size += await client.download(
+                f"/instances/{instance_id}/file",
+                f"./{orthanc_study_uid}/IMAGES/{instance_id}",
+            )
+        return size
+
+    async def worker(client, queue):
+        for orthanc_study_uid in queue:
+            start = time.perf_counter()
+            for attempt in range(download_study.retries + 1):
+                try:
+                    size = await download(client, orthanc_study_uid)
+                except Exception:
+                    if attempt == download_study.retries:
+                        attempts.add(start, attempt, failed=True)
+                    continue
+                attempts.add(start, attempt, size)
+                break
+            shutil.rmtree(f"./{orthanc_study_uid}", ignore_errors=True)
+
+    async def main():
+        queue = iter(orthanc_study_uids)
+        async with AsyncOrthancClient(url_root, max_connections=concurrency) as client:
+            async with anyio.create_task_group() as task_group:
+                for _ in range(concurrency):
+                    task_group.start_soon(worker, client, queue)
+
+    anyio.run(main)
+    return attempts
+
+
+def send(paths, scp):
+    datasets = [
+        create_sr(dcmread(path, stop_before_pixels=True), "Synthetic findings", "Normal")
+        for path in paths
+    ]
+    manager = AssociationManager("127.0.0.1", scp.port, scp.ae_title)
+    attempts = Attempts()
+
+    def store(ds):
+        manager.send([ds])
+
+    for ds in datasets:
+        with_retries(store, send_ds.retries, attempts, ds)
+    manager.close()
+    return attempts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--fixtures", help="DICOM directory, synthetic SRs by default")
+    parser.add_argument("--studies", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--store-latency", type=float, default=0.0)
+    parser.add_argument("--store-failure-rate", type=float, default=0.0)
+    parser.add_argument("--store-abort-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    fixtures = args.fixtures or os.path.join(workdir, "fixtures")
+    if not args.fixtures:
+        generate_fixtures(fixtures, args.studies)
+
+    orthanc = FakeOrthanc(
+        ("127.0.0.1", 0), fixtures, args.latency, args.failure_rate, seed=0
+    ).start()
+    scp = FakeStoreSCP(
+        latency=args.store_latency,
+        failure_rate=args.store_failure_rate,
+        abort_rate=args.store_abort_rate,
+        seed=0,
+    ).start()
+
+    ## The download helpers write to the working directory
+    os.chdir(workdir)
+    orthanc_study_uids = list(orthanc.studies)
+    print(f"{len(orthanc_study_uids)} studies, {args.concurrency} concurrent downloads")
+
+    try:
+        for mode in ["instances", "archive", "async"]:
+            start = time.perf_counter()
+            if mode == "async":
+                attempts = download_async(orthanc.url, orthanc_study_uids, args.concurrency)
+            else:
+                attempts = download_sync(
+                    mode, orthanc.url, orthanc_study_uids, args.concurrency
+                )
+            attempts.report(f"download ({mode})", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        attempts = send(list(orthanc.instances.values()), scp)
+        attempts.report("send", time.perf_counter() - start)
+        print(f"HTTP {dict(orthanc.requests)}, C-STORE {dict(scp.counts)}")
+    finally:
+        orthanc.shutdown()
+        scp.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
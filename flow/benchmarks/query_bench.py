@@ -0,0 +1,155 @@
+"""Measures load_sample latency on a large archive with and without the
+non-unique lookup indexes.
+
+Point it at a scratch database, the tables are migrated and filled with
+synthetic rows (12 bmd_values and 60 bmd_trend_values per study):
+
+    python -m benchmarks.query_bench --database-uri postgresql://... --studies 20000
+"""
+
+import argparse, os, random, statistics, time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, func, text
+from sqlalchemy.orm import Session
+from data_models import Base, Patient, Study, Report, BMDValue, BMDTrendValue, Result
+from benchmarks.synthetic import BODY_PART_REGIONS
+
+TREND_LENGTH = 4
+BATCH_SIZE = 500
+
+
+def fill(engine, studies, seed=0):
+    """Inserts ``studies`` synthetic studies with one report each."""
+    rng = random.Random(seed)
+    with Session(engine) as session:
+        offset = session.execute(select(func.count(Study.id))).scalar()
+        for start in range(offset, offset + studies, BATCH_SIZE):
+            stop = min(start + BATCH_SIZE, offset + studies)
+            ids = range(start + 1, stop + 1)
+            session.execute(
+                insert(Patient),
+                [{"id": i, "mrn": f"MRN{i}", "sex": "F", "birth_date": "19500101"} for i in ids],
+            )
+            session.execute(
+                insert(Study),
+                [
+                    {
+                        "id": i,
+                        "patient_id": i,
+                        "study_instance_uid": f"1.2.3.{i}",
+                        "accession": f"ACC{i}",
+                        "date_time": datetime(2024, 6, 1),
+                        "description": "DXA",
+                        "age": 74,
+                        "institution_name": "Mississauga Hospital",
+                    }
+                    for i in ids
+                ],
+            )
+            session.execute(
+                insert(Report), [{"id": i, "study_id": i, "sop_instance_uid": f"1.2.4.{i}"} for i in ids]
+            )
+            values, trend_values, results = [], [], []
+            for i in ids:
+                row = {"report_id": i, "study_id": i, "patient_id": i}
+                for body_part, regions in BODY_PART_REGIONS.items():
+                    for region in regions:
+                        values.append(
+                            {**row, "body_part": body_part, "region": region, "bmd": rng.uniform(0.6, 1.3),
+                             "t_score": rng.uniform(-4, 2), "z_score": rng.uniform(-3, 2)}
+                        )
+                        for visit in range(TREND_LENGTH + 1):
+                            trend_values.append(
+                                {**row, "body_part": body_part, "region": f"Trend {region}",
+                                 "date": datetime(2024, 6, 1) - timedelta(days=365 * visit),
+                                 "bmd": rng.uniform(0.6, 1.3)}
+                            )
+                results.append({"studyInstanceUID": f"1.2.3.{i}", "accession": f"ACC{i}"})
+            session.execute(insert(BMDValue), values)
+            session.execute(insert(BMDTrendValue), trend_values)
+            session.execute(
+                text(
+                    """
+                    INSERT INTO report_trend_values (report_id, trend_value_id)
+                    SELECT report_id, id FROM bmd_trend_values
+                    WHERE report_id BETWEEN :first AND :last
+                    ORDER BY id
+                    """
+                ),
+                {"first": ids[0], "last": ids[-1]},
+            )
+            session.execute(insert(Result), results)
+            session.commit()
+
+
+def time_lookups(engine, studies, samples, seed=1):
+    """Returns the per-call latencies of load_sample and of the results lookup
+    parse_study and save_result do, in seconds."""
+    from database import load_sample
+
+    rng = random.Random(seed)
+    accessions = [f"ACC{rng.randint(1, studies)}" for _ in range(samples)]
+    timings = {"load_sample": [], "results by accession": []}
+    with engine.connect() as conn:
+        for accession in accessions:
+            start = time.perf_counter()
+            load_sample(conn, accession)
+            timings["load_sample"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            conn.execute(select(Result.id).where(Result.accession == accession)).all()
+            timings["results by accession"].append(time.perf_counter() - start)
+    return timings
+
+
+def lookup_indexes():
+    return [
+        index
+        for table in Base.metadata.sorted_tables
+        for index in table.indexes
+        if not index.unique
+    ]
+
+
+def report(label, timings):
+    for name, latencies in timings.items():
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(
+            f"{label} {name}: p50 {statistics.median(latencies) * 1e3:.2f} ms, "
+            f"p99 {p99 * 1e3:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database-uri", required=True)
+    parser.add_argument("--studies", type=int, default=20000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    ## database reads DATABASE_URI when the engine is first built
+    os.environ["DATABASE_URI"] = args.database_uri
+    from alembic import command
+    from alembic.config import Config
+    from database import ALEMBIC_CONFIG, get_engine
+
+    command.upgrade(Config(ALEMBIC_CONFIG), "head")
+    engine = get_engine()
+
+    with Session(engine) as session:
+        existing = session.execute(select(func.count(Study.id))).scalar()
+    if existing < args.studies:
+        start = time.perf_counter()
+        fill(engine, args.studies - existing)
+        print(f"Loaded {args.studies - existing} studies in {time.perf_counter() - start:.1f} s")
+    with Session(engine) as session:
+        rows = session.execute(select(func.count(BMDTrendValue.id))).scalar()
+    print(f"{args.studies} studies, {rows} bmd_trend_values rows")
+
+    for index in lookup_indexes():
+        index.drop(engine)
+    report("without indexes", time_lookups(engine, args.studies, args.samples))
+    for index in lookup_indexes():
+        index.create(engine)
+    report("with indexes", time_lookups(engine, args.studies, args.samples))
@@ -0,0 +1,60 @@
+"""Measures SR parsing throughput on synthetic trend-heavy DXA reports.
+
+The SR is serialized once and every iteration reads it back from those bytes,
+as re-ingesting the archive reads files, so the figures include decoding the
+raw elements that pydicom defers until the parser accesses them.
+
+Run from the flow directory:
+
+    python -m benchmarks.sr_parser_bench --trend-length 20 --iterations 200
+"""
+
+import argparse, io, time
+from pydicom import dcmread
+from pydicom.filewriter import dcmwrite
+from sr_parser import convert_dicom_to_json, extract_dxa_report
+from benchmarks.synthetic import make_dxa_sr, count_content_items
+
+
+def time_parser(parser, raw, iterations):
+    parser(dcmread(io.BytesIO(raw)))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parser(dcmread(io.BytesIO(raw)))
+    return time.perf_counter() - start
+
+
+def run(trend_length=10, iterations=100):
+    ds = make_dxa_sr(trend_length=trend_length, seed=0)
+    items = count_content_items(ds)
+    buffer = io.BytesIO()
+    dcmwrite(buffer, ds, write_like_original=False)
+    raw = buffer.getvalue()
+
+    results = {}
+    for name, parser in [
+        ("dcmread + convert_dicom_to_json", convert_dicom_to_json),
+        ("dcmread + extract_dxa_report", extract_dxa_report),
+    ]:
+        elapsed = time_parser(parser, raw, iterations)
+        results[name] = {
+            "trend_length": trend_length,
+            "items_per_sr": items,
+            "srs_per_second": iterations / elapsed,
+            "items_per_second": items * iterations / elapsed,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trend-length", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    for name, result in run(args.trend_length, args.iterations).items():
+        print(
+            f"{name}: {result['items_per_sr']} items/SR, "
+            f"{result['srs_per_second']:.1f} SR/s, "
+            f"{result['items_per_second']:.0f} items/s"
+        )
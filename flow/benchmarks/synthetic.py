@@ -0,0 +1,171 @@
+import random
+from datetime import date
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+from utilities import COMPREHENSIVE_SR_CLASS_UID
+
+
+BODY_PART_REGIONS = {
+    "AP Spine": ["L1", "L2", "L3", "L4", "L1-L4", "L1-L3", "L2-L4"],
+    "Left Femur": ["Neck", "Total"],
+    "Right Femur": ["Neck", "Total"],
+    "Left Forearm": ["Radius 33%"],
+}
+
+
+def concept(meaning):
+    item = Dataset()
+    item.CodeValue = meaning[:16]
+    item.CodingSchemeDesignator = "99SYN"
+    item.CodeMeaning = meaning
+    return Sequence([item])
+
+
+def container(meaning, items):
+    item = Dataset()
+    item.ValueType = "CONTAINER"
+    item.ConceptNameCodeSequence = concept(meaning)
+    item.ContentSequence = Sequence(items)
+    return item
+
+
+def num(meaning, value, units=None):
+    item = Dataset()
+    item.ValueType = "NUM"
+    item.ConceptNameCodeSequence = concept(meaning)
+    measured_value = Dataset()
+    measured_value.NumericValue = f"{value:.3f}"
+    if units is not None:
+        measured_value.MeasurementUnitsCodeSequence = concept(units)
+    item.MeasuredValueSequence = Sequence([measured_value])
+    return item
+
+
+def text(meaning, value):
+    item = Dataset()
+    item.ValueType = "TEXT"
+    item.ConceptNameCodeSequence = concept(meaning)
+    item.TextValue = value
+    return item
+
+
+def region_container(region, rng):
+    bmd = rng.uniform(0.6, 1.3)
+    return container(
+        region,
+        [
+            num("BMD", bmd, "g/cm2"),
+            text("BMD_TSCORE", f"{rng.uniform(-4, 2):.1f}"),
+            text("BMD_ZSCORE", f"{rng.uniform(-3, 2):.1f}"),
+        ],
+    )
+
+
+def trend_container(region, study_date, trend_length, rng):
+    points = []
+    baseline = rng.uniform(0.6, 1.3)
+    previous = baseline
+    for visit in range(trend_length, 0, -1):
+        ## Same day of earlier years, so the visits of two studies of a patient
+        ## line up as they do in real trend tables
+        visit_date = study_date.replace(year=study_date.year - visit)
+        bmd = previous + rng.uniform(-0.03, 0.03)
+        points.append(
+            container(
+                visit_date.strftime("%d-%b-%Y"),
+                [
+                    num("AGE", 50 + rng.uniform(0, 30), "y"),
+                    num("BMD", bmd, "g/cm2"),
+                    container("CHANGE_VS_PREVIOUS", [num("BMD", bmd - previous)]),
+                    container(
+                        "PCHANGE_VS_PREVIOUS",
+                        [num("BMD", (bmd - previous) / previous * 100, "%")],
+                    ),
+                    container("CHANGE_VS_BASELINE", [num("BMD", bmd - baseline)]),
+                ],
+            )
+        )
+        previous = bmd
+    return container(f"Trend {region}", points)
+
+
+def make_dxa_sr(
+    body_part_regions=BODY_PART_REGIONS,
+    trend_length=5,
+    patient_id="SYN0001",
+    accession=None,
+    study_date=date(2024, 6, 1),
+    seed=None,
+):
+    """Builds a synthetic DXA Comprehensive SR in the layout convert_dicom_to_json reads.
+
+    Args:
+        body_part_regions (dict): Body part name -> list of region names.
+        trend_length (int): Number of prior visits in every trend table.
+        patient_id (str): PatientID of the study.
+        accession (str): AccessionNumber, random when not given.
+        study_date (datetime.date): StudyDate, trend visits are yearly before it.
+        seed: Seed for the measurement values.
+
+    Returns:
+        pydicom.dataset.Dataset
+    """
+    rng = random.Random(seed)
+
+    body_parts = []
+    for body_part, regions in body_part_regions.items():
+        items = [region_container(region, rng) for region in regions]
+        if trend_length:
+            items.extend(
+                trend_container(region, study_date, trend_length, rng)
+                for region in regions
+            )
+        body_parts.append(container(body_part, items))
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = COMPREHENSIVE_SR_CLASS_UID
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = COMPREHENSIVE_SR_CLASS_UID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = "SR"
+    ds.PatientID = patient_id
+    ds.PatientName = "SYNTHETIC^PATIENT"
+    ds.PatientBirthDate = "19600101"
+    ds.PatientSex = rng.choice(["F", "M"])
+    ds.PatientAge = f"{rng.randint(40, 90):03d}Y"
+    ds.PatientSize = "1.65"
+    ds.PatientWeight = "65"
+    ds.AccessionNumber = accession or f"SYN{rng.randint(0, 10**9):09d}"
+    ds.StudyDate = study_date.strftime("%Y%m%d")
+    ds.StudyTime = "093000"
+    ds.StudyDescription = "DXA BONE DENSITY"
+    ds.InstitutionName = "Mississauga Hospital"
+    ds.StationName = "DXA01"
+    ds.Manufacturer = "SYNTHETIC"
+    ds.ManufacturerModelName = "SYNTHETIC"
+    ds.SoftwareVersions = "1.0"
+
+    ds.ValueType = "CONTAINER"
+    ds.ConceptNameCodeSequence = concept("DXA Report")
+    ds.ContentSequence = Sequence(body_parts)
+    return ds
+
+
+def count_content_items(ds):
+    """Counts the content items of an SR tree, the unit of the items/s figures."""
+    count = 0
+    stack = [ds]
+    while stack:
+        item = stack.pop()
+        if "ContentSequence" in item:
+            count += len(item.ContentSequence)
+            stack.extend(item.ContentSequence)
+    return count
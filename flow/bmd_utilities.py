@@ -1,7 +1,8 @@
 import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import os
+from caroc import fracture_risk
+from database import get_engine, load_sample
+from lsc import get_institution_lsc
+from measurements import StudyMeasurements
 
 
 def format_score(number):
@@ -12,42 +13,13 @@ def interpolate(value, x1, x2, y1, y2):
     return y1 + (value - x1) * (y2 - y1) / (x2 - x1)
 
 
-# Data Processing Functions
-def return_prev_exam_dates(sample, study_id, bmd_trend_values):
-    study_date = sample["date_time"].values[0]
-    study_date_normalized = pd.to_datetime(study_date).normalize()
-
-    subset = bmd_trend_values[(bmd_trend_values.study_id == study_id)]
-    filtered_bmd_trend_values = subset[(subset["date"] < study_date_normalized)]
-
-    if len(filtered_bmd_trend_values) == 0:
-        return None, None
-    else:
-        ## previous
-        reference_date_row = filtered_bmd_trend_values.loc[
-            filtered_bmd_trend_values["date"].idxmax()
-        ]
-        reference_date_str = reference_date_row["date"]
-
-        grouped = filtered_bmd_trend_values.groupby("date")["body_part"].apply(set)
-        required_parts = set(filtered_bmd_trend_values["body_part"].unique())
-        valid_dates = grouped[grouped.apply(lambda x: required_parts.issubset(x))]
-
-        if len(valid_dates) == 0:
-            baseline_date_str = None
-        else:
-            baseline_date_str = valid_dates.index.min()
-
-        return reference_date_str, baseline_date_str
-
-
 # Turn Findings into a string
 def get_findings_text(
-    findings_df, age, findings_type, reference=None, cannot_be_compared=False
+    findings, age, findings_type, reference=None, cannot_be_compared=False
 ):
-    bmd = findings_df["bmd"].values[0]
-    t_score = findings_df["t_score"].values[0]
-    z_score = findings_df["z_score"].values[0]
+    bmd = findings[0].bmd
+    t_score = findings[0].t_score
+    z_score = findings[0].z_score
 
     findings = []
 
@@ -60,8 +32,8 @@ def get_findings_text(
             f"{findings_type} = {bmd} g/cm2. Z-score = {format_score(z_score)}"
         )
 
-    if reference is not None and not reference.empty and not cannot_be_compared:
-        reference_bmd = reference["bmd"].values[0]
+    if reference and not cannot_be_compared:
+        reference_bmd = reference[0].bmd
         change = bmd - reference_bmd
         change_type = ""
         if change > 0:
@@ -78,9 +50,9 @@ def get_findings_text(
 
 
 ## Get Value based on Age
-def get_numerical_values(findings_df, age):
-    t_score = findings_df["t_score"].values[0]
-    z_score = findings_df["z_score"].values[0]
+def get_numerical_values(findings, age):
+    t_score = findings[0].t_score
+    z_score = findings[0].z_score
     if age >= 50:
         return t_score
     else:
@@ -88,10 +60,10 @@ def get_numerical_values(findings_df, age):
 
 
 ## Get bmd change value
-def get_change_value(findings_df, reference_df):
-    bmd = findings_df["bmd"].values[0]
-    if reference_df is not None and not reference_df.empty:
-        reference_bmd = reference_df["bmd"].values[0]
+def get_change_value(findings, reference):
+    bmd = findings[0].bmd
+    if reference:
+        reference_bmd = reference[0].bmd
         change = bmd - reference_bmd
         change = round(change, 3)
         return change
@@ -101,90 +73,24 @@ def get_change_value(findings_df, reference_df):
 
 ## Get change based on hospital and lsc
 def get_change_type(value, region, institution_name):
-    if institution_name == "Mississauga Hospital":
-        lsc_spine = 0.033
-        lsc_total = 0.017
-        if region == "lumbar spine":
-            if abs(value) > lsc_spine:
-                if value > 0:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "increase",
-                        "significant": True,
-                    }
-                else:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "decrease",
-                        "significant": True,
-                    }
-            else:
-                return {"region": "lumbar spine", "significant": False, "change": None}
-        elif region == "hip":
-            if abs(value) > lsc_total:
-                if value > 0:
-                    return {"region": "hip", "change": "increase", "significant": True}
-                else:
-                    return {"region": "hip", "change": "decrease", "significant": True}
-            else:
-                return {"region": "hip", "significant": False, "change": None}
-
-    elif institution_name == "Queensway Hospital":
-        lsc_spine = 0.039
-        lsc_total = 0.024
-        if region == "lumbar spine":
-            if abs(value) > lsc_spine:
-                if value > 0:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "increase",
-                        "significant": True,
-                    }
-                else:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "decrease",
-                        "significant": True,
-                    }
-            else:
-                return {"region": "lumbar spine", "significant": False, "change": None}
-        elif region == "hip":
-            if abs(value) > lsc_total:
-                if value > 0:
-                    return {"region": "hip", "change": "increase", "significant": True}
-                else:
-                    return {"region": "hip", "change": "decrease", "significant": True}
-            else:
-                return {"region": "hip", "significant": False, "change": None}
-
-    elif institution_name == "Credit Valley Hospital":
-        lsc_spine = 0.036
-        lsc_total = 0.024
-
-        if region == "lumbar spine":
-            if abs(value) > lsc_spine:
-                if value > 0:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "increase",
-                        "significant": True,
-                    }
-                else:
-                    return {
-                        "region": "lumbar spine",
-                        "change": "decrease",
-                        "significant": True,
-                    }
-            else:
-                return {"region": "lumbar spine", "significant": False, "change": None}
-        elif region == "hip":
-            if abs(value) > lsc_total:
-                if value > 0:
-                    return {"region": "hip", "change": "increase", "significant": True}
-                else:
-                    return {"region": "hip", "change": "decrease", "significant": True}
-            else:
-                return {"region": "hip", "significant": False, "change": None}
+    lsc = get_institution_lsc(institution_name)
+    if lsc is None:
+        return None
+
+    if region == "lumbar spine":
+        threshold = lsc.lsc_spine
+    elif region == "hip":
+        threshold = lsc.lsc_total
+    else:
+        return None
+
+    if abs(value) > threshold:
+        if value > 0:
+            return {"region": region, "change": "increase", "significant": True}
+        else:
+            return {"region": region, "change": "decrease", "significant": True}
+    else:
+        return {"region": region, "significant": False, "change": None}
 
 
 ## Logic to exclude verterbrae
@@ -254,6 +160,16 @@ def select_vertebra_combination(filtered_t_scores):
     return []
 
 
+## Rows with the lowest (or highest) score, missing scores are ignored
+def select_by_score(findings, score, lowest=True):
+    values = [getattr(finding, score) for finding in findings]
+    values = [value for value in values if pd.notna(value)]
+    if not values:
+        return []
+    target = min(values) if lowest else max(values)
+    return [finding for finding in findings if getattr(finding, score) == target]
+
+
 def return_findings(
     study_id,
     sex,
@@ -262,48 +178,38 @@ def return_findings(
     bmd_values,
     bmd_trend_values,
 ):
-    findings = []
-    scores = []
-    lumbar_scores = 0
-    change_values = []
-
     study = studies.loc[studies.id == study_id]
-
     institution_name = study["institution_name"].values[0]
 
-    report = bmd_values.loc[bmd_values.study_id == study_id]
-
-    if report.empty:
+    measurements = StudyMeasurements.from_frames(
+        study["date_time"].values[0],
+        bmd_values.loc[bmd_values.study_id == study_id],
+        bmd_trend_values.loc[bmd_trend_values.study_id == study_id],
+    )
+    if not measurements.values:
         raise ValueError(f"No bmd_values for {study_id}")
 
-    reference_date_str, baseline_date_str = return_prev_exam_dates(
-        study, study_id, bmd_trend_values
+    return findings_from_measurements(
+        study_id, sex, age, institution_name, measurements
     )
 
-    report_reference = bmd_trend_values.loc[
-        (bmd_trend_values.study_id == study_id)
-        & (bmd_trend_values.date == reference_date_str)
-    ]
 
-    lumbar_spine = report.loc[report.body_part == "AP Spine"]
-    l1_l4 = None
+def findings_from_measurements(study_id, sex, age, institution_name, measurements):
+    findings = []
+    scores = []
+    lumbar_scores = 0
+    change_values = []
+    score = "t_score" if age >= 50 else "z_score"
 
-    if not lumbar_spine.empty:
+    if "AP Spine" in measurements.body_parts:
 
         exclude_l4 = False
 
         if age >= 50:
-            l1 = lumbar_spine.loc[lumbar_spine.region == "L1"]
-            l2 = lumbar_spine.loc[lumbar_spine.region == "L2"]
-            l3 = lumbar_spine.loc[lumbar_spine.region == "L3"]
-            l4 = lumbar_spine.loc[lumbar_spine.region == "L4"]
-
-            t_scores = {
-                "L1": l1["t_score"].values[0] if not l1.empty else None,
-                "L2": l2["t_score"].values[0] if not l2.empty else None,
-                "L3": l3["t_score"].values[0] if not l3.empty else None,
-                "L4": l4["t_score"].values[0] if not l4.empty else None,
-            }
+            t_scores = {}
+            for region in ["L1", "L2", "L3", "L4"]:
+                vertebra = measurements.get("AP Spine", region)
+                t_scores[region] = vertebra[0].t_score if vertebra else None
 
             filtered_t_scores = filter_vertebra_by_tscore(t_scores)
 
@@ -314,11 +220,9 @@ def return_findings(
                 exclude_l4 = True
 
         if not exclude_l4:
-            l1_l4 = lumbar_spine.loc[lumbar_spine.region == "L1-L4"]
-            l1_l4_reference = report_reference.loc[
-                report_reference.region == "Trend L1-L4"
-            ]
-            if l1_l4 is not None and not l1_l4.empty:
+            l1_l4 = measurements.get("AP Spine", "L1-L4")
+            l1_l4_reference = measurements.reference("Trend L1-L4")
+            if l1_l4:
                 findings.append(
                     get_findings_text(
                         l1_l4,
@@ -336,11 +240,9 @@ def return_findings(
                 lumbar_scores = get_numerical_values(l1_l4, age)
 
         elif selected_combination == ["L1", "L2", "L3"]:
-            l1_l3 = lumbar_spine.loc[lumbar_spine.region == "L1-L3"]
-            l1_l3_reference = report_reference.loc[
-                report_reference.region == "Trend L1-L3"
-            ]
-            if not l1_l3.empty:
+            l1_l3 = measurements.get("AP Spine", "L1-L3")
+            l1_l3_reference = measurements.reference("Trend L1-L3")
+            if l1_l3:
                 findings.append(
                     get_findings_text(
                         l1_l3,
@@ -361,11 +263,9 @@ def return_findings(
                 lumbar_scores = get_numerical_values(l1_l3, age)
 
         elif selected_combination == ["L2", "L3", "L4"]:
-            l2_l4 = lumbar_spine.loc[lumbar_spine.region == "L2-L4"]
-            l2_l4_reference = report_reference.loc[
-                report_reference.region == "Trend L2-L4"
-            ]
-            if not l2_l4.empty:
+            l2_l4 = measurements.get("AP Spine", "L2-L4")
+            l2_l4_reference = measurements.reference("Trend L2-L4")
+            if l2_l4:
                 findings.append(
                     get_findings_text(
                         l2_l4,
@@ -392,16 +292,12 @@ def return_findings(
     else:
         findings.append("Lumbar spine: No valid scans available.")
 
-    left_femur = report.loc[report.body_part == "Left Femur"]
-    if not left_femur.empty:
-        neck = left_femur.loc[left_femur.region == "Neck"]
-        neck_reference = report_reference.loc[report_reference.region == "Trend Neck"]
-        if not neck.empty:
+    if "Left Femur" in measurements.body_parts:
+        neck = measurements.get("Left Femur", "Neck")
+        neck_reference = measurements.reference("Trend Neck")
+        if neck:
             if sex == "male":
-                if age >= 50:
-                    min_neck = neck.loc[neck["t_score"] == neck["t_score"].min()]
-                else:
-                    min_neck = neck.loc[neck["z_score"] == neck["z_score"].min()]
+                min_neck = select_by_score(neck, score)
                 findings.append(
                     get_findings_text(
                         min_neck,
@@ -412,10 +308,7 @@ def return_findings(
                 )
                 scores.append(get_numerical_values(min_neck, age))
 
-                if age >= 50:
-                    max_neck = neck.loc[neck["t_score"] == neck["t_score"].max()]
-                else:
-                    max_neck = neck.loc[neck["z_score"] == neck["z_score"].max()]
+                max_neck = select_by_score(neck, score, lowest=False)
                 findings.append(
                     get_findings_text(
                         max_neck, age, "LEFT FEMORAL NECK (FEMALE REFERENCE)"
@@ -433,14 +326,11 @@ def return_findings(
                 )
                 scores.append(get_numerical_values(neck, age))
 
-        total = left_femur.loc[left_femur.region == "Total"]
-        total_reference = report_reference.loc[report_reference.region == "Trend Total"]
-        if not total.empty:
+        total = measurements.get("Left Femur", "Total")
+        total_reference = measurements.reference("Trend Total")
+        if total:
             if sex == "male":
-                if age >= 50:
-                    min_total = total.loc[total["t_score"] == total["t_score"].min()]
-                else:
-                    min_total = total.loc[total["z_score"] == total["z_score"].min()]
+                min_total = select_by_score(total, score)
                 findings.append(
                     get_findings_text(
                         min_total,
@@ -471,13 +361,10 @@ def return_findings(
                     )
                 scores.append(get_numerical_values(total, age))
 
-    left_forearm = report.loc[report.body_part == "Left Forearm"]
-    if not left_forearm.empty:
-        radius_1_3 = left_forearm.loc[left_forearm.region == "Radius 33%"]
-        radius_1_3_reference = report_reference.loc[
-            report_reference.region == "Trend Radius 33%"
-        ]
-        if not radius_1_3.empty:
+    if "Left Forearm" in measurements.body_parts:
+        radius_1_3 = measurements.get("Left Forearm", "Radius 33%")
+        radius_1_3_reference = measurements.reference("Trend Radius 33%")
+        if radius_1_3:
             findings.append(
                 get_findings_text(
                     radius_1_3, age, "1/3 LEFT RADIUS", radius_1_3_reference
@@ -485,22 +372,15 @@ def return_findings(
             )
             scores.append(get_numerical_values(radius_1_3, age))
 
-    right_femur = report.loc[report.body_part == "Right Femur"]
-    if not right_femur.empty:
-        neck = right_femur.loc[right_femur.region == "Neck"]
-        if not neck.empty:
+    if "Right Femur" in measurements.body_parts:
+        neck = measurements.get("Right Femur", "Neck")
+        if neck:
             if sex == "male":
-                if age >= 50:
-                    min_neck = neck.loc[neck["t_score"] == neck["t_score"].min()]
-                else:
-                    min_neck = neck.loc[neck["z_score"] == neck["z_score"].min()]
+                min_neck = select_by_score(neck, score)
                 findings.append(get_findings_text(min_neck, age, "RIGHT FEMORAL NECK"))
                 scores.append(get_numerical_values(min_neck, age))
 
-                if age >= 50:
-                    max_neck = neck.loc[neck["t_score"] == neck["t_score"].max()]
-                else:
-                    max_neck = neck.loc[neck["z_score"] == neck["z_score"].max()]
+                max_neck = select_by_score(neck, score, lowest=False)
                 findings.append(
                     get_findings_text(
                         max_neck, age, "RIGHT FEMORAL NECK (FEMALE REFERENCE)"
@@ -511,13 +391,10 @@ def return_findings(
                 findings.append(get_findings_text(neck, age, "RIGHT FEMORAL NECK"))
                 scores.append(get_numerical_values(neck, age))
 
-        total = right_femur.loc[right_femur.region == "Total"]
-        if not total.empty:
+        total = measurements.get("Right Femur", "Total")
+        if total:
             if sex == "male":
-                if age >= 50:
-                    min_total = total.loc[total["t_score"] == total["t_score"].min()]
-                else:
-                    min_total = total.loc[total["z_score"] == total["z_score"].min()]
+                min_total = select_by_score(total, score)
                 findings.append(
                     get_findings_text(min_total, age, "TOTAL PROXIMAL RIGHT FEMUR")
                 )
@@ -528,10 +405,9 @@ def return_findings(
                 )
                 scores.append(get_numerical_values(total, age))
 
-    left_forearm = report.loc[report.body_part == "Right Forearm"]
-    if not left_forearm.empty:
-        radius_1_3 = left_forearm.loc[left_forearm.region == "Radius 33%"]
-        if not radius_1_3.empty:
+    if "Right Forearm" in measurements.body_parts:
+        radius_1_3 = measurements.get("Right Forearm", "Radius 33%")
+        if radius_1_3:
             findings.append(get_findings_text(radius_1_3, age, "1/3 RIGHT RADIUS"))
             scores.append(get_numerical_values(radius_1_3, age))
 
@@ -547,6 +423,46 @@ def return_findings(
     )
 
 
+## Lumbar region findings_from_measurements reports for each vertebra selection
+LUMBAR_REGIONS = {
+    ("L1", "L2", "L3", "L4"): "L1-L4",
+    ("L1", "L2", "L3"): "L1-L3",
+    ("L2", "L3", "L4"): "L2-L4",
+}
+
+
+def get_lumbar_t_score(measurements):
+    t_scores = {}
+    for region in ["L1", "L2", "L3", "L4"]:
+        vertebra = measurements.get("AP Spine", region)
+        t_scores[region] = vertebra[0].t_score if vertebra else None
+
+    combination = select_vertebra_combination(filter_vertebra_by_tscore(t_scores))
+    lumbar = measurements.get("AP Spine", LUMBAR_REGIONS.get(tuple(combination)))
+    return lumbar[0].t_score if lumbar else None
+
+
+def get_fracture_risk(sex, age, measurements):
+    """CAROC 2010 fracture risk category of a study, None under 50 years of age
+    or without a femoral neck T-score.
+
+    Fracture and glucocorticoid history are not recorded in the SR, the
+    category is the basal risk from the BMD values.
+    """
+    neck = measurements.get("Left Femur", "Neck") or measurements.get(
+        "Right Femur", "Neck"
+    )
+    ## Men are rated on the female reference, their highest neck T-score
+    if sex == "male":
+        neck = select_by_score(neck, "t_score", lowest=False)
+    return fracture_risk(
+        age,
+        sex == "male",
+        neck[0].t_score if neck else None,
+        get_lumbar_t_score(measurements),
+    )
+
+
 def strip_risk(risk_category):
     if "Low" in risk_category:
         return "Low"
@@ -605,31 +521,19 @@ def get_change_statement(change_values):
 
 
 def get_lsc(institution_name):
-    if institution_name == "Mississauga Hospital":
-        return "LSC (least significant change) at MH:\n\
-Lumbar spine - 0.033 gm/cm2\n\
-Total femur - 0.017 gm/cm2"
-    elif institution_name == "Queensway Hospital":
-        return "LSC (least significant change) at QH:\n\
-Lumbar spine - 0.039 gm/cm2\n\
-Total femur - 0.024 gm/cm2"
-    elif institution_name == "Credit Valley Hospital":
-        return "LSC (least significant change) at CVH:\n\
-Lumbar spine - 0.036 gm/cm2\n\
-Total femur - 0.024gm/cm2"
+    lsc = get_institution_lsc(institution_name)
+    if lsc is None:
+        return None
+    return f"LSC (least significant change) at {lsc.abbreviation}:\n\
+Lumbar spine - {lsc.lsc_spine} gm/cm2\n\
+Total femur - {lsc.lsc_total} gm/cm2"
 
 
 def process_sample(
     accession,
 ):
-    DATABASE_URI = os.getenv("DATABASE_URI")
-    DATABASE_URI.replace("postgresql", "postgresql+psycopg2")
-    conn = create_engine(DATABASE_URI)
-    patients = pd.read_sql("SELECT * FROM patients", conn)
-    studies = pd.read_sql("SELECT * FROM studies", conn)
-    bmd_values = pd.read_sql("SELECT * FROM bmd_values", conn)
-    bmd_trend_values = pd.read_sql("SELECT * FROM bmd_trend_values", conn)
-    bmd_trend_values["date"] = pd.to_datetime(bmd_trend_values["date"])
+    with get_engine().connect() as conn:
+        patients, studies, bmd_values, bmd_trend_values = load_sample(conn, accession)
 
     study = studies.loc[studies.accession == accession]
     study_id = study["id"].values[0]
@@ -641,14 +545,22 @@ def process_sample(
         .replace("M", "male")
     )
     age = study["age"].values[0]
-    findings, diagnostic_category = (
-        return_findings(
-            study_id,
-            sex,
-            age,
-            studies,
-            bmd_values,
-            bmd_trend_values,
-        )
+    measurements = StudyMeasurements.from_frames(
+        study["date_time"].values[0],
+        bmd_values.loc[bmd_values.study_id == study_id],
+        bmd_trend_values.loc[bmd_trend_values.study_id == study_id],
+    )
+    if not measurements.values:
+        raise ValueError(f"No bmd_values for {study_id}")
+
+    findings, diagnostic_category = findings_from_measurements(
+        study_id, sex, age, study["institution_name"].values[0], measurements
     )
-    return findings, diagnostic_category
+    ## Not reported under 50 years of age or without a femoral neck T-score
+    fracture_risk = get_fracture_risk(sex, age, measurements)
+    if fracture_risk is not None:
+        findings += (
+            f"\nFRACTURE RISK CATEGORY: {fracture_risk} (CAROC 2010 basal risk, "
+            "fracture and glucocorticoid history not assessed)\n"
+        )
+    return findings, diagnostic_category, fracture_risk
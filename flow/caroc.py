@@ -0,0 +1,125 @@
+import numpy as np
+
+
+## CAROC 2010 basal risk by femoral neck T-score (white female reference), one
+## row per age band. A T-score above the first threshold is Low, below the
+## second High, Moderate in between, bounds included
+AGE_BANDS = np.array([50, 55, 60, 65, 70, 75, 80, 85])
+WOMEN_THRESHOLDS = np.array(
+    [
+        [-2.5, -3.8],
+        [-2.5, -3.8],
+        [-2.3, -3.7],
+        [-1.9, -3.5],
+        [-1.7, -3.2],
+        [-1.2, -2.9],
+        [-0.5, -2.6],
+        [0.1, -2.2],
+    ]
+)
+MEN_THRESHOLDS = np.array(
+    [
+        [-2.5, -3.9],
+        [-2.5, -3.9],
+        [-2.5, -3.7],
+        [-2.4, -3.7],
+        [-2.3, -3.7],
+        [-2.3, -3.8],
+        [-2.1, -3.8],
+        [-2.0, -3.8],
+    ]
+)
+RISK_CATEGORIES = np.array(["Low", "Moderate", "High"], dtype=object)
+
+## Ages below a midpoint belong to the younger band, ties go to the older one
+_BAND_EDGES = (AGE_BANDS[:-1] + AGE_BANDS[1:]) / 2
+
+LOW, MODERATE, HIGH = range(3)
+
+
+def age_band_index(age):
+    """Index of the closest CAROC age band, ages over 85 use the 85 band."""
+    return np.searchsorted(_BAND_EDGES, age, side="right")
+
+
+def classify_risk(
+    age,
+    is_male,
+    neck_t_score,
+    lumbar_t_score=np.nan,
+    fracture_count=0,
+    hip_or_vertebral_fracture=False,
+    glucocorticoid=False,
+):
+    """Vectorised CAROC 2010 fracture risk category, as specified in report.md.
+
+    Every argument is a scalar or an array broadcast against the others.
+
+    Args:
+        age: Age in years, no category is given under 50.
+        is_male: Selects the men's thresholds.
+        neck_t_score: Femoral neck T-score from the white female reference,
+            NaN when not measured.
+        lumbar_t_score: Lumbar spine T-score, moves Low to Moderate at or
+            below -2.5.
+        fracture_count: Fragility fractures after age 40.
+        hip_or_vertebral_fracture: Fragility hip or vertebral fracture after
+            age 40.
+        glucocorticoid: Positive glucocorticoid history.
+
+    Returns:
+        Object array of "Low", "Moderate", "High" or None.
+    """
+    (
+        age,
+        is_male,
+        neck_t_score,
+        lumbar_t_score,
+        fracture_count,
+        hip_or_vertebral_fracture,
+        glucocorticoid,
+    ) = np.broadcast_arrays(
+        np.asarray(age, dtype=float),
+        np.asarray(is_male, dtype=bool),
+        np.asarray(neck_t_score, dtype=float),
+        np.asarray(lumbar_t_score, dtype=float),
+        np.asarray(fracture_count, dtype=int),
+        np.asarray(hip_or_vertebral_fracture, dtype=bool),
+        np.asarray(glucocorticoid, dtype=bool),
+    )
+
+    band = age_band_index(age)
+    thresholds = np.where(
+        is_male[..., None], MEN_THRESHOLDS[band], WOMEN_THRESHOLDS[band]
+    )
+    fracture = fracture_count > 0
+    high_history = (
+        (fracture & glucocorticoid) | hip_or_vertebral_fracture | (fracture_count >= 2)
+    )
+
+    with np.errstate(invalid="ignore"):
+        level = (neck_t_score <= thresholds[..., 0]).astype(int) + (
+            neck_t_score < thresholds[..., 1]
+        )
+        ## One category up for a fracture or glucocorticoid history, then the
+        ## lumbar spine can still move Low to Moderate
+        level = np.minimum(level + (fracture | glucocorticoid), HIGH)
+        level = np.where((level == LOW) & (lumbar_t_score <= -2.5), MODERATE, level)
+        level = np.where(high_history, HIGH, level)
+
+        return np.where(
+            (np.isnan(neck_t_score) & ~high_history) | ~(age >= 50),
+            None,
+            RISK_CATEGORIES[level],
+        )
+
+
+def fracture_risk(age, is_male, neck_t_score, lumbar_t_score=None, **history):
+    """classify_risk for a single study, None values are treated as missing."""
+    return classify_risk(
+        age,
+        is_male,
+        np.nan if neck_t_score is None else neck_t_score,
+        np.nan if lumbar_t_score is None else lumbar_t_score,
+        **history,
+    ).item()
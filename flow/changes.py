@@ -0,0 +1,168 @@
+import hashlib, os, time
+from prefect import flow, get_run_logger
+from prefect.deployments import run_deployment
+from sqlalchemy import select
+from data_models import ChangesCursor
+from database import get_session
+from main import has_predictor_series
+from utilities import orthanc_get_session, orthanc_get_url_root
+
+
+## Deployment every batch of new studies is handed to, as "<flow>/<deployment>"
+CHANGES_DEPLOYMENT = os.getenv("CHANGES_DEPLOYMENT", "extract-studies-batch/bmd-batch")
+## Studies per dispatched flow run, and the longest a study waits for its batch
+## to fill before it is dispatched anyway, in seconds
+CHANGES_BATCH_SIZE = int(os.getenv("CHANGES_BATCH_SIZE", "50"))
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", "30"))
+## Seconds between polls once the feed is caught up, and changes per request
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "5"))
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "100"))
+## A study is dispatched when one of its series has one of these modalities
+CHANGES_MODALITIES = os.getenv("CHANGES_MODALITIES", "SR").split(",")
+
+CURSOR_NAME = "orthanc"
+
+
+@flow(name="follow-changes", log_prints=True)
+def follow_changes(
+    run_seconds=None,
+    deployment_name=CHANGES_DEPLOYMENT,
+    batch_size=CHANGES_BATCH_SIZE,
+    max_wait=CHANGES_MAX_WAIT,
+):
+    """Follows Orthanc's /changes feed and dispatches new DXA studies in batches.
+
+    Every StableStudy change with an SR series and no predictor series is
+    queued. A batch is handed to deployment_name as one flow run once it holds
+    batch_size studies or its oldest study has waited max_wait seconds.
+
+    The feed position is kept in the changes_cursors table and only moves past
+    a change once its study was dispatched, so studies are processed at least
+    once across restarts. A study dispatched twice is skipped by the batch's
+    precheck. Run a single instance of this flow.
+
+    Args:
+        run_seconds (float): Stop after this long, runs until cancelled when
+            not given.
+        deployment_name (str): "<flow>/<deployment>" taking orthanc_study_uids.
+        batch_size (int): Studies per dispatched flow run.
+        max_wait (float): Seconds a queued study waits for its batch to fill.
+    """
+    logger = get_run_logger()
+    orthanc_session = orthanc_get_session()
+    orthanc_root = orthanc_get_url_root()
+
+    since = load_cursor()
+    if since is None:
+        ## Without a cursor start from the current end of the feed, older
+        ## studies are caught up with extract-studies-batch or -async
+        since = get_changes(orthanc_session, orthanc_root, last=True)["Last"]
+        save_cursor(since)
+    logger.info(f"Following Orthanc changes from {since}")
+
+    started = time.monotonic()
+    ## (orthanc_study_uid, change Seq, time queued) in feed order, so the
+    ## first study has waited longest
+    pending = []
+    dispatched = 0
+    while run_seconds is None or time.monotonic() - started < run_seconds:
+        changes = get_changes(orthanc_session, orthanc_root, since=since)
+        for change in changes["Changes"]:
+            if change["ChangeType"] != "StableStudy":
+                continue
+            if any(change["ID"] == queued[0] for queued in pending):
+                continue
+            if is_dxa_study(orthanc_session, orthanc_root, change["ID"]):
+                pending.append((change["ID"], change["Seq"], time.monotonic()))
+        since = changes["Last"]
+
+        while pending and (
+            len(pending) >= batch_size or time.monotonic() - pending[0][2] >= max_wait
+        ):
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            dispatch(deployment_name, batch, logger)
+            dispatched += len(batch)
+        ## Only move past changes whose studies were all dispatched
+        if not pending:
+            save_cursor(since)
+
+        if changes["Done"]:
+            time.sleep(CHANGES_POLL_INTERVAL)
+
+    if pending:
+        dispatch(deployment_name, pending, logger)
+        dispatched += len(pending)
+        save_cursor(since)
+    logger.info(f"Dispatched {dispatched} studies, stopped at change {since}")
+    return dispatched
+
+
+def get_changes(orthanc_session, orthanc_root, since=None, last=False):
+    """Reads a page of Orthanc's /changes feed, or only its end with last."""
+    params = {"last": ""} if last else {"since": since, "limit": CHANGES_PAGE_SIZE}
+    response = orthanc_session.get(f"{orthanc_root}/changes", params=params)
+    if not response.ok:
+        raise Exception(
+            f"Request failed with code {response.status_code}, returned error was: {response.text}"
+        )
+    return response.json()
+
+
+def is_dxa_study(orthanc_session, orthanc_root, orthanc_study_uid):
+    """Checks a study has a series to report on and was not reported yet.
+
+    Sending the generated SR back to Orthanc makes the study stable again, the
+    predictor series keeps that change from being dispatched a second time.
+    """
+    response = orthanc_session.get(f"{orthanc_root}/studies/{orthanc_study_uid}/series")
+    if response.status_code == 404:
+        ## Deleted since the change was logged
+        return False
+    if not response.ok:
+        raise Exception(
+            f"Request failed with code {response.status_code}, returned error was: {response.text}"
+        )
+    series = response.json()
+    if has_predictor_series(series):
+        return False
+    return any(
+        serie.get("MainDicomTags", {}).get("Modality") in CHANGES_MODALITIES
+        for serie in series
+    )
+
+
+def dispatch(deployment_name, batch, logger):
+    """Starts a flow run for a batch of (orthanc_study_uid, seq, queued) entries."""
+    orthanc_study_uids = [orthanc_study_uid for orthanc_study_uid, _, _ in batch]
+    ## The idempotency key only depends on the batch, so a batch re-sent after
+    ## a restart, before its cursor was saved, maps to the flow run already
+    ## created for it. The Seq range keeps a study changed again later from
+    ## mapping to its earlier run
+    seqs = sorted(seq for _, seq, _ in batch)
+    digest = hashlib.sha1("|".join(sorted(orthanc_study_uids)).encode()).hexdigest()
+    flow_run = run_deployment(
+        deployment_name,
+        parameters={"orthanc_study_uids": orthanc_study_uids},
+        timeout=0,
+        idempotency_key=f"changes-{seqs[0]}-{seqs[-1]}-{digest}",
+    )
+    logger.info(f"Dispatched {len(orthanc_study_uids)} studies as flow run {flow_run.name}")
+
+
+def load_cursor(name=CURSOR_NAME):
+    with get_session() as session:
+        return session.execute(
+            select(ChangesCursor.last_seq).where(ChangesCursor.name == name)
+        ).scalar()
+
+
+def save_cursor(last_seq, name=CURSOR_NAME):
+    with get_session() as session:
+        cursor = session.execute(
+            select(ChangesCursor).where(ChangesCursor.name == name)
+        ).scalar_one_or_none()
+        if cursor is None:
+            session.add(ChangesCursor(name=name, last_seq=last_seq))
+        elif cursor.last_seq != last_seq:
+            cursor.last_seq = last_seq
+        session.commit()
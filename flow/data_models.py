@@ -6,12 +6,14 @@ Base = declarative_base()
 
 
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     Float,
     ForeignKey,
     DateTime,
+    Index,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -36,7 +38,7 @@ class Study(Base):
     __tablename__ = "studies"
 
     id = Column(Integer, primary_key=True)
-    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False, index=True)
     study_instance_uid = Column(String, nullable=False, unique=True)
     accession = Column(String, nullable=False, unique=True)
     date_time = Column(DateTime, nullable=False)
@@ -62,12 +64,13 @@ class Report(Base):
     __tablename__ = "reports"
 
     id = Column(Integer, primary_key=True)
-    study_id = Column(Integer, ForeignKey("studies.id"), nullable=False)
+    study_id = Column(Integer, ForeignKey("studies.id"), nullable=False, index=True)
     sop_instance_uid = Column(String, nullable=False, unique=True)
 
     study = relationship("Study", back_populates="report")
     bmd_values = relationship("BMDValue", back_populates="report")
     bmd_trend_values = relationship("BMDTrendValue", back_populates="report")
+    trend_value_links = relationship("ReportTrendValue", back_populates="report")
 
 
 class BMDValue(Base):
@@ -75,7 +78,7 @@ class BMDValue(Base):
 
     id = Column(Integer, primary_key=True)
     report_id = Column(Integer, ForeignKey("reports.id"), nullable=False)
-    study_id = Column(Integer, ForeignKey("studies.id"), nullable=False)
+    study_id = Column(Integer, ForeignKey("studies.id"), nullable=False, index=True)
     patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
 
     body_part = Column(String, nullable=False)  # e.g., 'spine', 'hip'
@@ -92,6 +95,19 @@ class BMDValue(Base):
 # Define the BMDTrendValue model linked to the Report
 class BMDTrendValue(Base):
     __tablename__ = "bmd_trend_values"
+    ## A trend point is stored once per patient with the ids of the first
+    ## report that contained it, later reports are linked to it through
+    ## report_trend_values
+    __table_args__ = (
+        Index(
+            "uq_bmd_trend_values_patient_id_body_part_region_date",
+            "patient_id",
+            "body_part",
+            "region",
+            "date",
+            unique=True,
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     report_id = Column(Integer, ForeignKey("reports.id"), nullable=False)
@@ -112,6 +128,29 @@ class BMDTrendValue(Base):
     report = relationship("Report", back_populates="bmd_trend_values")
     study = relationship("Study", back_populates="bmd_trend_values")
     patient = relationship("Patient", back_populates="bmd_trend_values")
+    report_links = relationship("ReportTrendValue", back_populates="trend_value")
+
+
+# Links every report to the trend points it contains, in report order
+class ReportTrendValue(Base):
+    __tablename__ = "report_trend_values"
+    __table_args__ = (
+        Index(
+            "uq_report_trend_values_report_id_trend_value_id",
+            "report_id",
+            "trend_value_id",
+            unique=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False)
+    trend_value_id = Column(
+        Integer, ForeignKey("bmd_trend_values.id"), nullable=False, index=True
+    )
+
+    report = relationship("Report", back_populates="trend_value_links")
+    trend_value = relationship("BMDTrendValue", back_populates="report_links")
 
 
 class Result(Base):
@@ -119,9 +158,30 @@ class Result(Base):
     id = Column(Integer, primary_key=True)
     sopInstanceUID = Column(String)
     seriesInstanceUID = Column(String)
-    studyInstanceUID = Column(String)
+    studyInstanceUID = Column(String, index=True)
     patientID = Column(String)
-    accession = Column(String)
+    accession = Column(String, index=True)
     diagnostic_category = Column(String)
+    fracture_risk = Column(String)  # CAROC 2010 'Low', 'Moderate' or 'High'
     findings = Column(String)
     createdAt = Column(DateTime, default=datetime.utcnow)
+
+
+class InstitutionLSC(Base):
+    __tablename__ = "institution_lsc"
+
+    id = Column(Integer, primary_key=True)
+    institution_name = Column(String, nullable=False, unique=True)
+    abbreviation = Column(String, nullable=False)  # e.g., 'MH'
+    lsc_spine = Column(Float, nullable=False)  # lumbar spine LSC in g/cm2
+    lsc_total = Column(Float, nullable=False)  # total femur LSC in g/cm2
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ChangesCursor(Base):
+    __tablename__ = "changes_cursors"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)  # e.g., 'orthanc'
+    last_seq = Column(BigInteger, nullable=False)  # last Orthanc /changes Seq handled
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
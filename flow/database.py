@@ -0,0 +1,133 @@
+import os
+from functools import lru_cache
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from alembic import command
+from alembic.config import Config
+from lsc import seed_lsc
+
+
+ALEMBIC_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+
+@lru_cache(maxsize=None)
+def get_engine():
+    """Returns the engine shared by every task running in this process.
+
+    The engine and its connection pool are created on first use, so forked
+    workers each build their own. Pool behaviour is configured through the
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE and
+    DATABASE_POOL_PRE_PING environment variables.
+    """
+    return create_engine(
+        os.getenv("DATABASE_URI"),
+        pool_size=int(os.getenv("DATABASE_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DATABASE_MAX_OVERFLOW", "10")),
+        pool_recycle=int(os.getenv("DATABASE_POOL_RECYCLE", "1800")),
+        pool_pre_ping=os.getenv("DATABASE_POOL_PRE_PING", "true").lower() == "true",
+    )
+
+
+@lru_cache(maxsize=None)
+def get_sessionmaker():
+    return sessionmaker(bind=get_engine())
+
+
+def get_session():
+    return get_sessionmaker()()
+
+
+def init_db():
+    """Migrates the schema to the latest revision and seeds the default LSC
+    table. Run once when the container starts."""
+    command.upgrade(Config(ALEMBIC_CONFIG), "head")
+    with get_session() as session:
+        seed_lsc(session)
+
+
+STUDY_QUERY = text(
+    """
+    SELECT *
+    FROM studies
+    WHERE accession = :accession
+    """
+)
+
+PATIENT_QUERY = text(
+    """
+    SELECT *
+    FROM patients
+    WHERE id = :patient_id
+    """
+)
+
+BMD_VALUES_QUERY = text(
+    """
+    SELECT *
+    FROM bmd_values
+    WHERE study_id = :study_id
+    ORDER BY id
+    """
+)
+
+## Trend points are shared between the reports of a patient, the study's own
+## are those linked to its reports
+BMD_TREND_VALUES_QUERY = text(
+    """
+    SELECT
+        t.id,
+        l.report_id,
+        r.study_id,
+        t.patient_id,
+        t.body_part,
+        t.region,
+        t.date,
+        t.age,
+        t.bmd,
+        t.change_vs_previous,
+        t.pchange_vs_previous,
+        t.change_vs_baseline
+    FROM reports r
+    JOIN report_trend_values l ON l.report_id = r.id
+    JOIN bmd_trend_values t ON t.id = l.trend_value_id
+    WHERE r.study_id = :study_id
+    ORDER BY l.id
+    """
+)
+
+
+def load_sample(conn, accession):
+    """Loads the rows needed to report a single study.
+
+    Only the study matching ``accession``, its patient and the study's own
+    ``bmd_values`` / ``bmd_trend_values`` are read, so the cost of a lookup does
+    not depend on the size of the archive.
+
+    Args:
+        conn: SQLAlchemy engine or connection.
+        accession (str): Accession number of the study.
+
+    Returns:
+        Tuple of (patients, studies, bmd_values, bmd_trend_values) DataFrames with
+        the same columns as the underlying tables.
+    """
+    studies = pd.read_sql(STUDY_QUERY, conn, params={"accession": accession})
+    if studies.empty:
+        raise ValueError(f"No study found for accession {accession}")
+
+    study_id = int(studies["id"].values[0])
+    patient_id = int(studies["patient_id"].values[0])
+
+    patients = pd.read_sql(PATIENT_QUERY, conn, params={"patient_id": patient_id})
+    bmd_values = pd.read_sql(BMD_VALUES_QUERY, conn, params={"study_id": study_id})
+    bmd_trend_values = pd.read_sql(
+        BMD_TREND_VALUES_QUERY, conn, params={"study_id": study_id}
+    )
+    bmd_trend_values["date"] = pd.to_datetime(bmd_trend_values["date"])
+
+    return patients, studies, bmd_values, bmd_trend_values
+
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,185 @@
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from data_models import (
+    Patient,
+    Study,
+    Report,
+    BMDValue,
+    BMDTrendValue,
+    ReportTrendValue,
+)
+
+
+## INSERT ... ON CONFLICT is dialect specific, SQLite is used by the benchmarks
+DIALECT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def dialect_insert(session):
+    return DIALECT_INSERTS[session.get_bind().dialect.name]
+
+
+def insert_or_get_id(session, model, values, key):
+    """Inserts a row unless one with the same unique ``key`` exists and returns
+    its id.
+
+    Uses INSERT ... ON CONFLICT DO NOTHING RETURNING id, so a new row costs one
+    round-trip and concurrent runs inserting the same row do not fail on the
+    unique constraint. The existing id is read back only on a conflict.
+    """
+    row_id = session.execute(
+        dialect_insert(session)(model)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=[key])
+        .returning(model.id)
+    ).scalar()
+    if row_id is None:
+        row_id = session.execute(
+            select(model.id).filter_by(**{key: values[key]})
+        ).scalar_one()
+    return row_id
+
+
+def ingest_report(session, extracted, logger=None):
+    """Stores one parsed SR and its measurements in a single transaction.
+
+    The patient, study and report rows are upserted with ON CONFLICT to obtain
+    their ids, so the same patient can be ingested by parallel runs, and the
+    measurement rows are written with one executemany insert per table. Trend
+    points already stored for the patient are linked rather than inserted
+    again. The transaction is committed once at the end and rolled back on any
+    error.
+
+    Args:
+        session (sqlalchemy.orm.Session): Session to write with.
+        extracted (ExtractedReport): Output of sr_parser.extract_dxa_report.
+        logger: Optional logger.
+
+    Returns:
+        The number of measurement rows in the report, trend points already
+        stored by an earlier report included.
+    """
+    data = extracted.header
+    try:
+        mrn = data["PatientID"]
+        patient_id = insert_or_get_id(
+            session,
+            Patient,
+            {
+                "mrn": mrn,
+                "sex": data["PatientSex"],
+                "birth_date": data["PatientBirthDate"],
+            },
+            "mrn",
+        )
+
+        accession = data["AccessionNumber"]
+        study_date = datetime.strptime(data["StudyDate"], "%Y%m%d")
+        study_time = datetime.strptime(data["StudyTime"], "%H%M%S").time()
+        study_id = insert_or_get_id(
+            session,
+            Study,
+            {
+                "patient_id": patient_id,
+                "study_instance_uid": data["StudyInstanceUID"],
+                "accession": accession,
+                "date_time": datetime.combine(study_date, study_time),
+                "description": data["StudyDescription"],
+                "age": data["PatientAge"],
+                "size": (
+                    float(data["PatientSize"])
+                    if data["PatientSize"] is not None
+                    else None
+                ),
+                "weight": (
+                    float(data["PatientWeight"])
+                    if data["PatientWeight"] is not None
+                    else None
+                ),
+                "ethnicity": data["EthnicGroup"],
+                "modality": data["Modality"],
+                "institution_name": data["InstitutionName"],
+                "station_name": data["StationName"],
+                "manufacturer": data["Manufacturer"],
+                "manufacturer_model_name": data["ManufacturerModelName"],
+                "software_versions": data["SoftwareVersions"],
+            },
+            "accession",
+        )
+
+        if not extracted.has_dxa_report:
+            session.commit()
+            return 0
+
+        ## Nothing is returned when another run already stored this SR
+        report_id = session.execute(
+            dialect_insert(session)(Report)
+            .values(study_id=study_id, sop_instance_uid=data["SOPInstanceUID"])
+            .on_conflict_do_nothing(index_elements=["sop_instance_uid"])
+            .returning(Report.id)
+        ).scalar()
+        if report_id is None:
+            session.rollback()
+            return 0
+
+        if logger is not None:
+            for error in extracted.errors:
+                logger.info(f"Error {accession} {error}")
+
+        bmd_values = extracted.bmd_values
+        bmd_trend_values = extracted.bmd_trend_values
+        ids = {"report_id": report_id, "study_id": study_id, "patient_id": patient_id}
+        if bmd_values:
+            session.execute(
+                insert(BMDValue), [{**ids, **row._asdict()} for row in bmd_values]
+            )
+        if bmd_trend_values:
+            store_trend_values(session, ids, bmd_trend_values)
+
+        session.commit()
+        return len(bmd_values) + len(bmd_trend_values)
+    except Exception:
+        session.rollback()
+        raise
+
+
+def store_trend_values(session, ids, bmd_trend_values):
+    """Stores the points of a report's trend table that are not known yet and
+    links the report to all of them.
+
+    A report repeats the patient's whole history, so most points were already
+    stored by an earlier report and are skipped by ON CONFLICT on
+    (patient_id, body_part, region, date).
+    """
+    session.execute(
+        dialect_insert(session)(BMDTrendValue).on_conflict_do_nothing(
+            index_elements=["patient_id", "body_part", "region", "date"]
+        ),
+        [{**ids, **row._asdict()} for row in bmd_trend_values],
+    )
+
+    point_ids = {
+        (body_part, region, date): point_id
+        for point_id, body_part, region, date in session.execute(
+            select(
+                BMDTrendValue.id,
+                BMDTrendValue.body_part,
+                BMDTrendValue.region,
+                BMDTrendValue.date,
+            ).where(
+                BMDTrendValue.patient_id == ids["patient_id"],
+                BMDTrendValue.date.in_({row.date for row in bmd_trend_values}),
+            )
+        )
+    }
+    ## Links keep the report's row order, load_sample returns them in it
+    linked = dict.fromkeys(
+        point_ids[(row.body_part, row.region, row.date)] for row in bmd_trend_values
+    )
+    session.execute(
+        insert(ReportTrendValue),
+        [
+            {"report_id": ids["report_id"], "trend_value_id": point_id}
+            for point_id in linked
+        ],
+    )
@@ -0,0 +1,157 @@
+import logging, os, threading
+from collections import namedtuple
+import numpy as np
+from cachetools import TTLCache
+from prefect import flow, get_run_logger
+from sqlalchemy import select
+from data_models import InstitutionLSC
+
+
+logger = logging.getLogger(__name__)
+
+LSC = namedtuple("LSC", ["institution_name", "abbreviation", "lsc_spine", "lsc_total"])
+
+## Seeded into institution_lsc when the table is empty
+DEFAULT_LSC = [
+    LSC("Mississauga Hospital", "MH", 0.033, 0.017),
+    LSC("Queensway Hospital", "QH", 0.039, 0.024),
+    LSC("Credit Valley Hospital", "CVH", 0.036, 0.024),
+]
+
+## Rows are re-read at most every LSC_CACHE_TTL seconds, or right away after
+## invalidate_lsc_cache, which every write to institution_lsc calls
+_cache = TTLCache(maxsize=1, ttl=int(os.getenv("LSC_CACHE_TTL", "300")))
+_lock = threading.Lock()
+## Institutions already warned about, so a batch logs a missing LSC once
+_warned = set()
+
+
+def load_lsc_table():
+    """Reads the LSC table from the database."""
+    if not os.getenv("DATABASE_URI"):
+        raise Exception("DATABASE_URI is not set, cannot read the LSC table")
+
+    from database import get_session
+
+    with get_session() as session:
+        rows = session.execute(select(InstitutionLSC)).scalars().all()
+        return {
+            row.institution_name: LSC(
+                row.institution_name, row.abbreviation, row.lsc_spine, row.lsc_total
+            )
+            for row in rows
+        }
+
+
+def get_lsc_table():
+    """Returns institution_name -> LSC, cached in process."""
+    with _lock:
+        table = _cache.get("table")
+        if table is None:
+            table = load_lsc_table()
+            _cache["table"] = table
+        return table
+
+
+def invalidate_lsc_cache():
+    with _lock:
+        _cache.clear()
+        _warned.clear()
+
+
+def get_institution_lsc(institution_name):
+    lsc = get_lsc_table().get(institution_name)
+    if lsc is None:
+        warn_missing(institution_name)
+    return lsc
+
+
+def warn_missing(institution_name):
+    with _lock:
+        if institution_name in _warned:
+            return
+        _warned.add(institution_name)
+    logger.warning(f"No LSC configured for institution {institution_name}")
+
+
+def seed_lsc(session):
+    """Inserts the default LSC rows if the table is empty."""
+    if session.execute(select(InstitutionLSC.id).limit(1)).first() is None:
+        session.add_all(InstitutionLSC(**lsc._asdict()) for lsc in DEFAULT_LSC)
+        session.commit()
+        invalidate_lsc_cache()
+
+
+def set_lsc(session, institution_name, abbreviation, lsc_spine, lsc_total):
+    """Adds or updates an institution's LSC and drops the cached table."""
+    row = session.execute(
+        select(InstitutionLSC).filter_by(institution_name=institution_name)
+    ).scalar_one_or_none()
+    if row is None:
+        row = InstitutionLSC(institution_name=institution_name)
+        session.add(row)
+    row.abbreviation = abbreviation
+    row.lsc_spine = lsc_spine
+    row.lsc_total = lsc_total
+    session.commit()
+    invalidate_lsc_cache()
+
+
+@flow(name="set-institution-lsc", log_prints=True)
+def set_institution_lsc(institution_name, abbreviation, lsc_spine, lsc_total):
+    """Onboards a site or updates its least significant change, in g/cm2.
+
+    Reports use the new values once the LSC cache of the process running them
+    expires, after at most LSC_CACHE_TTL seconds.
+    """
+    from database import get_session
+
+    with get_session() as session:
+        set_lsc(session, institution_name, abbreviation, lsc_spine, lsc_total)
+    get_run_logger().info(
+        f"LSC of {institution_name} ({abbreviation}) set to "
+        f"{lsc_spine} (lumbar spine) and {lsc_total} (total femur)"
+    )
+
+
+def classify_changes(values, regions, institution_names):
+    """Vectorised get_change_type.
+
+    Args:
+        values: BMD changes in g/cm2, NaN where there is no previous exam.
+        regions: "lumbar spine" or "hip" for each change.
+        institution_names: Institution of each change.
+
+    Returns:
+        Tuple of (change, significant) arrays. change holds "increase",
+        "decrease" or None; both are None where the change is missing or the
+        institution or region has no LSC.
+    """
+    table = get_lsc_table()
+    values = np.asarray(values, dtype=float)
+    regions = np.asarray(regions, dtype=object)
+    institution_names = np.asarray(institution_names, dtype=object)
+
+    ## One lookup per institution rather than per change
+    names, inverse = np.unique(institution_names.astype(str), return_inverse=True)
+    for name in names:
+        if name not in table:
+            warn_missing(name)
+    lsc_spine = np.array([table[name].lsc_spine if name in table else np.nan for name in names])
+    lsc_total = np.array([table[name].lsc_total if name in table else np.nan for name in names])
+    threshold = np.select(
+        [regions == "lumbar spine", regions == "hip"],
+        [lsc_spine[inverse], lsc_total[inverse]],
+        np.nan,
+    )
+
+    known = ~np.isnan(threshold) & ~np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        significant = known & (np.abs(values) > threshold)
+    change = np.full(len(values), None, dtype=object)
+    change[significant & (values > 0)] = "increase"
+    change[significant & (values <= 0)] = "decrease"
+
+    significant = significant.astype(object)
+    significant[~known] = None
+    return change, significant
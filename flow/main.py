@@ -1,73 +1,264 @@
-from sr_parser import convert_dicom_to_json
-from datetime import datetime
-from data_models import Patient, Study, Report, BMDValue, BMDTrendValue, Result, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import os, glob
+from sr_parser import extract_dxa_report
+from sqlalchemy import select
+from data_models import Result
+from database import get_session
+from ingest import ingest_report
 from prefect import task, flow, get_run_logger
+from prefect.task_runners import ConcurrentTaskRunner
 from pydicom import dcmread
-import pydicom.uid
-import zipfile
+import os, shutil, tempfile, time, zipfile
 from bmd_utilities import process_sample
+from metrics import RunMetrics
+from pacs import get_association_manager
 from utilities import (
+    COMPREHENSIVE_SR_CLASS_UID,
+    PREDICTOR_UID_ROOT,
     create_sr,
+    read_reference,
+    scan_instances,
     orthanc_get_session,
     orthanc_get_url_root,
-    get_value_from_dict,
-)
-import pynetdicom
-from pynetdicom.sop_class import (
-    ComputedRadiographyImageStorage,
-    DigitalXRayImageStorageForPresentation,
-    SecondaryCaptureImageStorage,
-    ComprehensiveSRStorage,
 )
 
 
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+## "instances" fetches only the SR objects, "archive" the whole study media zip
+ORTHANC_RETRIEVE_MODE = os.getenv("ORTHANC_RETRIEVE_MODE", "instances")
+## Also look for a predictor series in Orthanc before downloading, catches
+## studies whose result was saved by another deployment or before a reset
+PRECHECK_ORTHANC_SERIES = os.getenv("PRECHECK_ORTHANC_SERIES", "true").lower() == "true"
+
+
 @flow(name="extract-studies", log_prints=True)
 def extract_studies(orthanc_study_uid):
+    metrics = RunMetrics()
+    try:
+        run_study(orthanc_study_uid, metrics=metrics)
+    finally:
+        metrics.publish("extract-studies", get_run_logger())
+
+
+@flow(name="extract-studies-batch", log_prints=True, task_runner=ConcurrentTaskRunner())
+def extract_studies_batch(
+    orthanc_study_uids=None,
+    study_date_from=None,
+    study_date_to=None,
+    max_concurrency=4,
+):
+    """Processes many studies in one flow run.
+
+    Studies are given as Orthanc study ids or looked up by StudyDate range
+    (YYYYMMDD). Up to max_concurrency studies are in flight at once and they
+    share the process-wide database engine and PACS association.
+    """
     logger = get_run_logger()
 
-    DATABASE_URI = os.getenv("DATABASE_URI")
-    engine = create_engine(DATABASE_URI)
-    Base.metadata.create_all(engine)
+    if orthanc_study_uids is None:
+        orthanc_study_uids = find_studies(study_date_from, study_date_to)
+    logger.info(f"Batch of {len(orthanc_study_uids)} studies")
+
+    metrics = RunMetrics()
+    futures = []
+    statuses = []
+    for orthanc_study_uid in orthanc_study_uids:
+        ## Refill the slot of whichever study finishes first, so one slow
+        ## study does not hold up the others
+        if len(futures) >= max_concurrency:
+            future = wait_first(futures)
+            futures.remove(future)
+            statuses.append(future.result(raise_on_failure=False))
+        futures.append(process_study.submit(orthanc_study_uid, metrics))
+    statuses.extend(future.result(raise_on_failure=False) for future in futures)
+
+    counts = {}
+    for status in statuses:
+        status = status if isinstance(status, str) else "failed"
+        counts[status] = counts.get(status, 0) + 1
+    logger.info(f"Batch finished: {counts}")
+    metrics.publish("extract-studies-batch", logger)
+    return counts
+
+
+def wait_first(futures, poll_interval=0.1):
+    """Returns the first of the futures to finish.
+
+    Prefect futures cannot be passed to concurrent.futures.wait, so each one
+    is waited on in turn for a share of poll_interval until one has finished.
+    """
+    while True:
+        for future in futures:
+            if future.wait(timeout=poll_interval / len(futures)) is not None:
+                return future
 
-    download_study(orthanc_study_uid)
 
-    ## Read dicom dir and get first file as instance
-    files = glob.glob(f"./{orthanc_study_uid}/IMAGES/*")
-    if not len(files) > 0:
-        logger.info(
-            f"Study {orthanc_study_uid} does not contain any instances... Skipping"
-        )
-        return
+@task()
+def process_study(orthanc_study_uid, metrics):
+    logger = get_run_logger()
+    try:
+        return run_study(orthanc_study_uid, call=run_task_fn, metrics=metrics)
+    except Exception as e:
+        logger.info(f"Study {orthanc_study_uid} failed due to {e}")
+        return "failed"
 
-    ## Check to see if already predicted
-    accession = ""
-    ds = None
-    for file in files:
-        ds = dcmread(file)
-        accession = ds.AccessionNumber
-        predictor_root = "1.2.826.0.1.3680043.10.1082."
-        if predictor_root in ds.SeriesInstanceUID:
-            logger.info(f"Study {orthanc_study_uid} already processed")
-            return
 
-    parse_study(orthanc_study_uid)
+def run_task(task, *args, **kwargs):
+    return task(*args, **kwargs)
+
 
-    findings, diagnostic_category = process_sample(accession)
+def run_task_fn(task, *args, **kwargs):
+    """Runs a task's function inline, honouring the task's retry settings.
 
-    sr_ds = create_sr(ds, findings, diagnostic_category)
+    Used when the caller is itself a task, where Prefect does not allow
+    calling other tasks.
+    """
+    for attempt in range(task.retries + 1):
+        try:
+            return task.fn(*args, **kwargs)
+        except Exception:
+            if attempt == task.retries:
+                raise
+            time.sleep(task.retry_delay_seconds or 0)
 
-    send_ds(sr_ds)
 
-    save_result(
-        studyInstanceUID=sr_ds.StudyInstanceUID,
-        patientID=ds.PatientID,
-        accession=accession,
-        diagnostic_category=diagnostic_category,
-        findings=findings
+def run_study(orthanc_study_uid, call=run_task, metrics=None):
+    """Downloads, parses, reports and sends back a single study.
+
+    Args:
+        orthanc_study_uid (str): Orthanc id of the study.
+        call: Function used to invoke the pipeline tasks.
+        metrics (RunMetrics): Collector for stage durations and counters, a
+            throwaway one is used when not given.
+
+    Returns:
+        "processed", "empty" or "already processed".
+    """
+    logger = get_run_logger()
+    metrics = metrics if metrics is not None else RunMetrics()
+    stage = metrics.stage
+
+    try:
+        ## Reject re-triggered studies before anything is downloaded
+        with stage("precheck"):
+            processed = already_processed(orthanc_study_uid)
+        if processed:
+            logger.info(f"Study {orthanc_study_uid} already processed")
+            return "already processed"
+
+        with stage("download"):
+            metrics.count("bytes_downloaded", call(download_study, orthanc_study_uid))
+
+        ## Index instances from their headers, shared with parse_study
+        with stage("scan"):
+            instances = scan_instances(f"./{orthanc_study_uid}")
+        metrics.count("instances_scanned", len(instances))
+        if not len(instances) > 0:
+            logger.info(
+                f"Study {orthanc_study_uid} does not contain any instances... Skipping"
+            )
+            return "empty"
+
+        ## Check to see if already predicted, in case the study changed since
+        ## the precheck
+        for instance in instances:
+            if PREDICTOR_UID_ROOT in instance.series_instance_uid:
+                logger.info(f"Study {orthanc_study_uid} already processed")
+                return "already processed"
+        accession = instances[-1].accession
+        ds = read_reference(instances[-1])
+
+        with stage("parse"):
+            reports, rows = call(parse_study, orthanc_study_uid, instances)
+        metrics.count("reports_parsed", reports)
+        metrics.count("rows_inserted", rows)
+
+        with stage("findings"):
+            findings, diagnostic_category, fracture_risk = process_sample(accession)
+
+        with stage("create_sr"):
+            sr_ds = create_sr(ds, findings, diagnostic_category, fracture_risk)
+
+        with stage("send"):
+            call(send_ds, sr_ds, metrics)
+
+        with stage("save"):
+            save_result(
+                studyInstanceUID=sr_ds.StudyInstanceUID,
+                patientID=ds.PatientID,
+                accession=accession,
+                diagnostic_category=diagnostic_category,
+                fracture_risk=fracture_risk,
+                findings=findings
+            )
+        return "processed"
+    finally:
+        ## Remove the extracted instances so long running agents don't fill the disk
+        shutil.rmtree(f"./{orthanc_study_uid}", ignore_errors=True)
+
+
+def find_studies(study_date_from, study_date_to):
+    """Returns the Orthanc ids of the studies acquired in a StudyDate range."""
+    orthanc_session = orthanc_get_session()
+    orthanc_root = orthanc_get_url_root()
+    response = orthanc_session.post(
+        f"{orthanc_root}/tools/find",
+        json={
+            "Level": "Study",
+            "Query": {"StudyDate": f"{study_date_from or ''}-{study_date_to or ''}"},
+        },
     )
+    if not response.ok:
+        raise Exception(
+            f"Request failed with code {response.status_code}, returned error was: {response.text}"
+        )
+    return response.json()
+
+
+def already_processed(orthanc_study_uid):
+    """Checks whether a study was already reported without downloading it.
+
+    The StudyInstanceUID is read from Orthanc's study metadata and looked up in
+    the indexed results table. With PRECHECK_ORTHANC_SERIES the study's series
+    are also searched for one under PREDICTOR_UID_ROOT.
+    """
+    orthanc_session = orthanc_get_session()
+    orthanc_root = orthanc_get_url_root()
+    response = orthanc_session.get(f"{orthanc_root}/studies/{orthanc_study_uid}")
+    if not response.ok:
+        raise Exception(
+            f"Request failed with code {response.status_code}, returned error was: {response.text}"
+        )
+    if result_exists(response.json().get("MainDicomTags", {}).get("StudyInstanceUID")):
+        return True
+
+    if PRECHECK_ORTHANC_SERIES:
+        response = orthanc_session.get(f"{orthanc_root}/studies/{orthanc_study_uid}/series")
+        if not response.ok:
+            raise Exception(
+                f"Request failed with code {response.status_code}, returned error was: {response.text}"
+            )
+        return has_predictor_series(response.json())
+    return False
+
+
+def result_exists(study_instance_uid):
+    if not study_instance_uid:
+        return False
+    with get_session() as s:
+        result = s.execute(
+            select(Result.id)
+            .where(Result.studyInstanceUID == study_instance_uid)
+            .limit(1)
+        ).first()
+    return result is not None
+
+
+def has_predictor_series(series):
+    """Checks Orthanc /studies/{id}/series output for a predictor series."""
+    for serie in series:
+        series_instance_uid = serie.get("MainDicomTags", {}).get("SeriesInstanceUID", "")
+        if PREDICTOR_UID_ROOT in series_instance_uid:
+            return True
+    return False
 
 
 @task(retries=3, retry_delay_seconds=5)
@@ -78,231 +269,126 @@ def download_study(orthanc_study_uid):
 
     logger.info(f"Study {orthanc_study_uid} being downloaded")
 
-    try:
-        ## Download study
-        url = f"{orthanc_root}/studies/{orthanc_study_uid}/media"
-        response = orthanc_session.get(url)
-        open(f"{orthanc_study_uid}.zip", "wb").write(response.content)
+    ## Returns the number of bytes downloaded
+    if ORTHANC_RETRIEVE_MODE == "archive":
+        return download_archive(orthanc_session, orthanc_root, orthanc_study_uid)
+    return download_sr_instances(orthanc_session, orthanc_root, orthanc_study_uid)
+
+
+def download_archive(orthanc_session, orthanc_root, orthanc_study_uid):
+    ## Stream the archive to an anonymous temporary file in fixed size chunks
+    ## and only extract the instances, so memory use does not grow with the study
+    url = f"{orthanc_root}/studies/{orthanc_study_uid}/media"
+    with orthanc_session.get(url, stream=True) as response:
         if not response.ok:
             raise Exception(
                 f"Request failed with code {response.status_code}, returned error was: {response.text}"
             )
 
-        ## Unzip study
-        with zipfile.ZipFile(f"{orthanc_study_uid}.zip", "r") as zip_ref:
-            zip_ref.extractall(f"./{orthanc_study_uid}")
-
-    except Exception as e:
-        raise e
+        size = 0
+        with tempfile.TemporaryFile() as archive:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                size += archive.write(chunk)
+            archive.seek(0)
+
+            with zipfile.ZipFile(archive, "r") as zip_ref:
+                for member in zip_ref.infolist():
+                    if member.is_dir() or not member.filename.startswith("IMAGES/"):
+                        continue
+                    zip_ref.extract(member, f"./{orthanc_study_uid}")
+    return size
+
+
+def select_sr_instances(series):
+    ## Only SR series are needed, DXA images are never parsed. The SR instances
+    ## also serve as the reference for create_sr, when a study has none a
+    ## single instance is fetched so the study can still be identified
+    instance_ids = []
+    for serie in series:
+        if serie.get("MainDicomTags", {}).get("Modality") == "SR":
+            instance_ids.extend(serie["Instances"])
+    if not instance_ids:
+        for serie in series:
+            if serie["Instances"]:
+                instance_ids.append(serie["Instances"][0])
+                break
+    return instance_ids
+
+
+def download_sr_instances(orthanc_session, orthanc_root, orthanc_study_uid):
+    url = f"{orthanc_root}/studies/{orthanc_study_uid}/series"
+    response = orthanc_session.get(url)
+    if not response.ok:
+        raise Exception(
+            f"Request failed with code {response.status_code}, returned error was: {response.text}"
+        )
+    instance_ids = select_sr_instances(response.json())
+
+    size = 0
+    os.makedirs(f"./{orthanc_study_uid}/IMAGES", exist_ok=True)
+    for instance_id in instance_ids:
+        url = f"{orthanc_root}/instances/{instance_id}/file"
+        with orthanc_session.get(url, stream=True) as response:
+            if not response.ok:
+                raise Exception(
+                    f"Request failed with code {response.status_code}, returned error was: {response.text}"
+                )
+            with open(f"./{orthanc_study_uid}/IMAGES/{instance_id}", "wb") as file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += file.write(chunk)
+    return size
 
 
 @task()
-def parse_study(orthanc_study_uid):
+def parse_study(orthanc_study_uid, instances):
     logger = get_run_logger()
     logger.info(f"Study {orthanc_study_uid} being parsed")
 
-    DATABASE_URI = os.getenv("DATABASE_URI")
-    engine = create_engine(DATABASE_URI)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    files = glob.glob(f"./{orthanc_study_uid}/IMAGES/*")
-    for file in files:
-        ds = dcmread(file)
+    reports = rows = 0
+    session = get_session()
+    for instance in instances:
+        file = instance.path
 
         ## Check if SR
-        if not "1.2.840.10008.5.1.4.1.1.88.22" in ds.SOPClassUID:
+        if not COMPREHENSIVE_SR_CLASS_UID in instance.sop_class_uid:
             logger.info(f"Instance is not a SR, skipping {file}")
             continue
+        ds = dcmread(file)
         try:
-            data = convert_dicom_to_json(ds)
+            extracted = extract_dxa_report(ds)
         except Exception as e:
             logger.info(f"Error parsing SR {file} due to {e}")
             continue
 
-        sop_instance_uid = data["SOPInstanceUID"]
-
-        report = (
-            session.query(Report).filter_by(sop_instance_uid=sop_instance_uid).first()
-        )
-
-        if report:
-            continue
-
-        mrn = data["PatientID"]
-        patient_age = data["PatientAge"]
-        patient_sex = data["PatientSex"]
-        birth_date = data["PatientBirthDate"]
-
-        # Check if patient already exists
-        patient = session.query(Patient).filter_by(mrn=mrn).first()
-        if not patient:
-            # Adding new patient
-            patient = Patient(
-                mrn=mrn,
-                sex=patient_sex,
-                birth_date=birth_date,
-            )
-            session.add(patient)
-            session.commit()
-
-        study_instance_uid = data["StudyInstanceUID"]
-        accession = data["AccessionNumber"]
-        study_date = datetime.strptime(data["StudyDate"], "%Y%m%d")
-        study_time = datetime.strptime(data["StudyTime"], "%H%M%S").time()
-        study_date_time = datetime.combine(study_date, study_time)
-        study_description = data["StudyDescription"]
-        study_size = (
-            float(data["PatientSize"]) if data["PatientSize"] is not None else None
-        )
-        study_weight = (
-            float(data["PatientWeight"]) if data["PatientWeight"] is not None else None
-        )
-        study_ethnicity = data["EthnicGroup"]
-        modality = data["Modality"]
-        insitution_name = data["InstitutionName"]
-        station_name = data["StationName"]
-        manufacturer = data["Manufacturer"]
-        manufacturer_model_name = data["ManufacturerModelName"]
-        software_versions = data["SoftwareVersions"]
-
-        # Check if study already exists
-        study = session.query(Study).filter_by(accession=accession).first()
-        if not study:
-            # Adding new study
-            study = Study(
-                patient_id=patient.id,
-                study_instance_uid=study_instance_uid,
-                accession=accession,
-                date_time=study_date_time,
-                description=study_description,
-                age=patient_age,
-                size=study_size,
-                weight=study_weight,
-                ethnicity=study_ethnicity,
-                modality=modality,
-                institution_name=insitution_name,
-                station_name=station_name,
-                manufacturer=manufacturer,
-                manufacturer_model_name=manufacturer_model_name,
-                software_versions=software_versions,
-            )
-            session.add(study)
-            session.commit()
+        reports += 1
 
-        if not "DXA Report" in data:
+        try:
+            stored = ingest_report(session, extracted, logger)
+        except Exception as e:
+            logger.info(f"Error saving SR {file} due to {e}")
             continue
+        rows += stored
+        logger.info(f"Stored {stored} BMD values from {file}")
 
-        dxa_report = data["DXA Report"]
-
-        # Adding new report
-        report = Report(
-            study_id=study.id,
-            sop_instance_uid=sop_instance_uid,
-        )
-        session.add(report)
-        session.commit()
-
-        for body_part in [
-            "Left Femur",
-            "AP Spine",
-            "Right Femur",
-            "Left Forearm",
-            "Right Forearm",
-            "DualFemur",
-        ]:
-            if body_part in dxa_report:
-                body_part_data = dxa_report[body_part]
-                for region_name, region_data in body_part_data.items():
-                    try:
-                        if "Trend" in region_name:
-                            for date_str, trend_data in region_data.items():
-                                age = get_value_from_dict(trend_data, ["AGE", "value"])
-                                bmd = get_value_from_dict(trend_data, ["BMD", "value"])
-                                change_vs_previous = get_value_from_dict(
-                                    trend_data,
-                                    ["CHANGE_VS_PREVIOUS", "BMD", "value"],
-                                )
-                                change_vs_baseline = get_value_from_dict(
-                                    trend_data,
-                                    ["CHANGE_VS_BASELINE", "BMD", "value"],
-                                )
-                                pchange_vs_previous = get_value_from_dict(
-                                    trend_data,
-                                    ["PCHANGE_VS_PREVIOUS", "BMD", "value"],
-                                )
-                                date = datetime.strptime(date_str, "%d-%b-%Y")
-                                bmd_trend_value = BMDTrendValue(
-                                    report_id=report.id,
-                                    study_id=study.id,
-                                    patient_id=patient.id,
-                                    body_part=body_part,
-                                    region=region_name,
-                                    date=date,
-                                    age=age,
-                                    bmd=bmd,
-                                    change_vs_previous=change_vs_previous,
-                                    pchange_vs_previous=pchange_vs_previous,
-                                    change_vs_baseline=change_vs_baseline,
-                                )
-                                session.add(bmd_trend_value)
-                                session.commit()
-                        else:
-                            bmd = get_value_from_dict(region_data, ["BMD", "value"])
-                            t_score = get_value_from_dict(region_data, ["BMD_TSCORE"])
-                            z_score = get_value_from_dict(region_data, ["BMD_ZSCORE"])
-                            if bmd:
-                                bmd_value = BMDValue(
-                                    report_id=report.id,
-                                    study_id=study.id,
-                                    patient_id=patient.id,
-                                    body_part=body_part,
-                                    region=region_name,
-                                    bmd=bmd,
-                                    t_score=t_score,
-                                    z_score=z_score,
-                                )
-                                session.add(bmd_value)
-                                session.commit()
-                    except Exception as e:
-                        logger.info(f"Error {accession} {e}")
+    session.close()
+    return reports, rows
 
 
 @task(retries=3, retry_delay_seconds=5)
-def send_ds(ds):
+def send_ds(ds, metrics=None):
     logger = get_run_logger()
     logger.info(f"DS being sent to Orthanc")
 
-    ae = pynetdicom.AE()
-
-    ae.add_requested_context(
-        DigitalXRayImageStorageForPresentation, pydicom.uid.ExplicitVRLittleEndian
-    )
-
-    ae.add_requested_context(
-        ComputedRadiographyImageStorage, pydicom.uid.ExplicitVRLittleEndian
-    )
-
-    ae.add_requested_context(
-        SecondaryCaptureImageStorage, pydicom.uid.ExplicitVRLittleEndian
-    )
-
-    ae.add_requested_context(ComprehensiveSRStorage, pydicom.uid.ExplicitVRLittleEndian)
-
-    assoc = ae.associate("orthanc", 4242, ae_title=b"ORTHANC")
-    if assoc.is_established:
-        status = assoc.send_c_store(ds)
-        if status:
-            logger.info(
-                "C-STORE succeeded request status: 0x{0:04x}".format(status.Status)
-            )
-        else:
-            raise Exception(
-                "Connection timed out, was aborted or received invalid response"
-            )
-
-        assoc.release()
-    else:
-        raise Exception("Association rejected, aborted or never connected")
+    datasets = ds if isinstance(ds, list) else [ds]
+    start = time.perf_counter()
+    statuses = get_association_manager().send(datasets)
+    if metrics is not None:
+        metrics.observe("cstore_latency", (time.perf_counter() - start) / len(datasets))
+        metrics.count("datasets_sent", len(datasets))
+    for status in statuses:
+        logger.info(
+            "C-STORE succeeded request status: 0x{0:04x}".format(status.Status)
+        )
 
 
 def save_result(
@@ -311,17 +397,16 @@ def save_result(
     accession,
     diagnostic_category,
     findings,
+    fracture_risk=None,
 ):
-    DATABASE_URI = os.getenv("DATABASE_URI")
-    engine = create_engine(DATABASE_URI)
-    Session = sessionmaker(bind=engine)
-    s = Session()
-    result = Result(
-        studyInstanceUID=studyInstanceUID,
-        patientID=patientID,
-        accession=accession,
-        diagnostic_category=diagnostic_category,
-        findings=findings
-    )
-    s.add(result)
-    s.commit()
+    with get_session() as s:
+        result = Result(
+            studyInstanceUID=studyInstanceUID,
+            patientID=patientID,
+            accession=accession,
+            diagnostic_category=diagnostic_category,
+            fracture_risk=fracture_risk,
+            findings=findings
+        )
+        s.add(result)
+        s.commit()
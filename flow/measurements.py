@@ -0,0 +1,108 @@
+import pandas as pd
+
+
+class Measurement:
+    __slots__ = ("body_part", "region", "bmd", "t_score", "z_score")
+
+    def __init__(self, body_part, region, bmd, t_score=None, z_score=None):
+        self.body_part = body_part
+        self.region = region
+        self.bmd = bmd
+        self.t_score = t_score
+        self.z_score = z_score
+
+
+class StudyMeasurements:
+    """The BMD values of one study indexed for constant time lookups.
+
+    Values are keyed by (body_part, region) and the trend values of the
+    previous exam by region, each key holding its rows in table order so the
+    first row is the one the report uses.
+
+    Attributes:
+        values (dict): (body_part, region) -> list of Measurement.
+        body_parts (set): Body parts with at least one value.
+        references (dict): Trend region -> list of Measurement from the
+            previous exam.
+        reference_date: Date of the previous exam, None without one.
+        baseline_date: Earliest previous exam covering every trended body part.
+    """
+
+    __slots__ = ("values", "body_parts", "references", "reference_date", "baseline_date")
+
+    def __init__(self, values, trend_values, study_date):
+        self.values = {}
+        self.body_parts = set()
+        for value in values:
+            self.values.setdefault((value.body_part, value.region), []).append(value)
+            self.body_parts.add(value.body_part)
+
+        self.reference_date, self.baseline_date = return_prev_exam_dates(
+            study_date, trend_values
+        )
+        self.references = {}
+        for date, value in trend_values:
+            if date == self.reference_date:
+                self.references.setdefault(value.region, []).append(value)
+
+    @classmethod
+    def from_frames(cls, study_date, bmd_values, bmd_trend_values):
+        """Builds the structure from bmd_values / bmd_trend_values DataFrames
+        already restricted to one study."""
+        values = [
+            Measurement(body_part, region, bmd, t_score, z_score)
+            for body_part, region, bmd, t_score, z_score in zip(
+                bmd_values["body_part"],
+                bmd_values["region"],
+                bmd_values["bmd"],
+                bmd_values["t_score"],
+                bmd_values["z_score"],
+            )
+        ]
+        trend_values = [
+            (date, Measurement(body_part, region, bmd))
+            for date, body_part, region, bmd in zip(
+                bmd_trend_values["date"],
+                bmd_trend_values["body_part"],
+                bmd_trend_values["region"],
+                bmd_trend_values["bmd"],
+            )
+        ]
+        return cls(values, trend_values, study_date)
+
+    def get(self, body_part, region):
+        return self.values.get((body_part, region), [])
+
+    def reference(self, region):
+        return self.references.get(region, [])
+
+
+def return_prev_exam_dates(study_date, trend_values):
+    """Finds the previous exam and the baseline exam among the trend values.
+
+    Args:
+        study_date: Date and time of the study.
+        trend_values (list): (date, Measurement) tuples of the study's trend.
+
+    Returns:
+        Tuple of (reference_date, baseline_date), either may be None.
+    """
+    study_date_normalized = pd.Timestamp(study_date).normalize()
+
+    body_parts_by_date = {}
+    for date, value in trend_values:
+        if date < study_date_normalized:
+            body_parts_by_date.setdefault(date, set()).add(value.body_part)
+
+    if len(body_parts_by_date) == 0:
+        return None, None
+
+    reference_date = max(body_parts_by_date)
+    required_parts = set().union(*body_parts_by_date.values())
+    valid_dates = [
+        date
+        for date, body_parts in body_parts_by_date.items()
+        if required_parts.issubset(body_parts)
+    ]
+    baseline_date = min(valid_dates) if valid_dates else None
+    return reference_date, baseline_date
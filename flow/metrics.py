@@ -0,0 +1,265 @@
+import fcntl, json, os, tempfile, threading, time
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+from contextlib import contextmanager
+
+
+## Directory scraped by node_exporter's textfile collector, every flow adds its
+## run to <flow name>.prom there at the end of a run. Unset to disable the
+## export
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+
+## Histogram upper bounds in seconds, shared by every duration metric
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+## Counters every run reports, zero when nothing was counted
+COUNTERS = {
+    "bytes_downloaded": "Bytes downloaded from Orthanc",
+    "instances_scanned": "Instances indexed from downloaded studies",
+    "reports_parsed": "SR reports parsed",
+    "rows_inserted": "BMD value and trend rows stored",
+    "datasets_sent": "Datasets sent with C-STORE",
+}
+
+## Histograms other than the stage durations
+OBSERVATIONS = {
+    "cstore_latency": "C-STORE round-trip in seconds",
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.values = []
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(BUCKETS, value)] += 1
+        self.values.append(value)
+
+    def quantile(self, q):
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class RunMetrics:
+    """Collects the metrics of one flow run.
+
+    Records wall-clock durations of pipeline stages, other latencies such as
+    C-STORE round-trips and counters such as bytes downloaded. Safe to share
+    between the threads of a concurrent task runner.
+
+    At the end of a run publish() logs a per-stage summary and a JSON summary
+    and adds the metrics to the flow's Prometheus textfile in
+    METRICS_TEXTFILE_DIR, whose counters and histograms accumulate over runs.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(Histogram)
+        self.observations = defaultdict(Histogram)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.durations[name].observe(elapsed)
+
+    def observe(self, name, value):
+        with self._lock:
+            self.observations[name].observe(value)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Returns one line per stage with its count, mean duration and throughput."""
+        wall = time.perf_counter() - self.started
+        lines = []
+        with self._lock:
+            for name, histogram in self.durations.items():
+                durations = histogram.values
+                total = sum(durations)
+                lines.append(
+                    f"{name}: {len(durations)} runs, "
+                    f"mean {total / len(durations):.3f}s, "
+                    f"p99 {histogram.quantile(0.99):.3f}s, "
+                    f"{len(durations) / wall:.2f}/s over {wall:.1f}s"
+                )
+        return lines
+
+    def to_dict(self):
+        """Structured summary of the run, e.g. for comparing runs."""
+        wall = time.perf_counter() - self.started
+
+        def describe(histogram):
+            return {
+                "count": len(histogram.values),
+                "total": sum(histogram.values),
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+                "max": max(histogram.values),
+                "buckets": dict(
+                    zip(map(str, BUCKETS + ("+Inf",)), accumulate(histogram.bucket_counts))
+                ),
+            }
+
+        with self._lock:
+            return {
+                "wall_seconds": wall,
+                "stages": {
+                    name: describe(histogram)
+                    for name, histogram in self.durations.items()
+                },
+                "observations": {
+                    name: describe(histogram)
+                    for name, histogram in self.observations.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def families(self, flow_name):
+        """Returns the metrics of this run as {metric: [type, help, {sample: value}]}."""
+        labels = f'flow="{flow_name}"'
+        families = {}
+
+        def add(metric, metric_type, help_text, samples):
+            family = families.setdefault(metric, [metric_type, help_text, {}])
+            family[2].update(samples)
+
+        def histogram_samples(metric, histogram, extra_labels=""):
+            samples = {}
+            for bound, count in zip(
+                BUCKETS + ("+Inf",), accumulate(histogram.bucket_counts)
+            ):
+                samples[f'{metric}_bucket{{{labels}{extra_labels},le="{bound}"}}'] = count
+            samples[f"{metric}_sum{{{labels}{extra_labels}}}"] = sum(histogram.values)
+            samples[f"{metric}_count{{{labels}{extra_labels}}}"] = len(histogram.values)
+            return samples
+
+        with self._lock:
+            for name, histogram in self.durations.items():
+                add(
+                    "bmd_stage_duration_seconds",
+                    "histogram",
+                    "Duration of a pipeline stage",
+                    histogram_samples("bmd_stage_duration_seconds", histogram, f',stage="{name}"'),
+                )
+            for name, histogram in self.observations.items():
+                metric = f"bmd_{name}_seconds"
+                add(
+                    metric,
+                    "histogram",
+                    OBSERVATIONS.get(name, name),
+                    histogram_samples(metric, histogram),
+                )
+            for name, value in self.counters.items():
+                metric = f"bmd_{name}_total"
+                add(metric, "counter", COUNTERS.get(name, name), {f"{metric}{{{labels}}}": value})
+
+        add("bmd_runs_total", "counter", "Finished flow runs", {f"bmd_runs_total{{{labels}}}": 1})
+        add(
+            "bmd_run_seconds_total",
+            "counter",
+            "Wall-clock duration of the flow runs",
+            {f"bmd_run_seconds_total{{{labels}}}": time.perf_counter() - self.started},
+        )
+        add(
+            "bmd_run_finished_timestamp_seconds",
+            "gauge",
+            "End of the last run",
+            {f"bmd_run_finished_timestamp_seconds{{{labels}}}": time.time()},
+        )
+        return families
+
+    def to_prometheus(self, flow_name, previous=""):
+        """Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            flow_name (str): Value of the flow label.
+            previous (str): Earlier output for the flow. Its counters and
+                histograms are added to this run's, so they cover every run
+                since the file was created, and its gauges are replaced.
+        """
+        families = parse_prometheus(previous)
+        for metric, (metric_type, help_text, samples) in self.families(flow_name).items():
+            family = families.setdefault(metric, [metric_type, help_text, {}])
+            for sample, value in samples.items():
+                if metric_type == "gauge":
+                    family[2][sample] = value
+                else:
+                    family[2][sample] = family[2].get(sample, 0) + value
+
+        lines = []
+        for metric, (metric_type, help_text, samples) in families.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for sample, value in samples.items():
+                lines.append(f"{sample} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, flow_name, directory=METRICS_TEXTFILE_DIR):
+        path = os.path.join(directory, f"{flow_name}.prom")
+        ## Runs of a flow merge into one file, the lock keeps concurrent runs
+        ## from reading the same previous values and losing each other's
+        with open(os.path.join(directory, f".{flow_name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            previous = ""
+            if os.path.exists(path):
+                with open(path) as file:
+                    previous = file.read()
+
+            ## Written to a temporary file and renamed so the collector never
+            ## reads a partial file
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=f".{flow_name}.", suffix=".tmp", delete=False
+            ) as file:
+                file.write(self.to_prometheus(flow_name, previous))
+            try:
+                os.replace(file.name, path)
+            except OSError:
+                os.unlink(file.name)
+                raise
+
+    def publish(self, flow_name, logger):
+        for line in self.summary():
+            logger.info(line)
+        logger.info(f"Run metrics: {json.dumps(self.to_dict())}")
+        if METRICS_TEXTFILE_DIR:
+            ## Metrics must never fail a run that already saved its results
+            try:
+                self.write_textfile(flow_name, METRICS_TEXTFILE_DIR)
+            except Exception as e:
+                logger.info(f"Error writing metrics to {METRICS_TEXTFILE_DIR} due to {e}")
+
+
+def parse_prometheus(text):
+    """Reads text written by RunMetrics.to_prometheus back into
+    {metric: [type, help, {sample: value}]}."""
+    families = {}
+    family = None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            metric, _, help_text = line[len("# HELP ") :].partition(" ")
+            family = families.setdefault(metric, ["untyped", help_text, {}])
+        elif line.startswith("# TYPE "):
+            metric, _, metric_type = line[len("# TYPE ") :].partition(" ")
+            family = families.setdefault(metric, [metric_type, "", {}])
+            family[0] = metric_type
+        elif line and not line.startswith("#") and family is not None:
+            sample, _, value = line.rpartition(" ")
+            family[2][sample] = float(value)
+    return families
+
+
+def format_value(value):
+    if float(value).is_integer() and abs(value) < 2**53:
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,121 @@
+"""initial schema
+
+Creates the tables as they were created by Base.metadata.create_all. Tables
+that already exist are left alone so databases created before migrations were
+introduced can be upgraded in place.
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-08-01 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def create_table(name, *columns):
+    if not sa.inspect(op.get_bind()).has_table(name):
+        op.create_table(name, *columns)
+
+
+def upgrade():
+    create_table(
+        "patients",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("mrn", sa.String(), nullable=False, unique=True),
+        sa.Column("sex", sa.String(), nullable=False),
+        sa.Column("birth_date", sa.String(), nullable=False),
+    )
+    create_table(
+        "studies",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("patient_id", sa.Integer(), sa.ForeignKey("patients.id"), nullable=False),
+        sa.Column("study_instance_uid", sa.String(), nullable=False, unique=True),
+        sa.Column("accession", sa.String(), nullable=False, unique=True),
+        sa.Column("date_time", sa.DateTime(), nullable=False),
+        sa.Column("description", sa.String(), nullable=False),
+        sa.Column("age", sa.Integer(), nullable=False),
+        sa.Column("size", sa.Float(), nullable=True),
+        sa.Column("weight", sa.Float(), nullable=True),
+        sa.Column("ethnicity", sa.String(), nullable=True),
+        sa.Column("modality", sa.String(), nullable=True),
+        sa.Column("institution_name", sa.String(), nullable=True),
+        sa.Column("station_name", sa.String(), nullable=True),
+        sa.Column("manufacturer", sa.String(), nullable=True),
+        sa.Column("manufacturer_model_name", sa.String(), nullable=True),
+        sa.Column("software_versions", sa.String(), nullable=True),
+    )
+    create_table(
+        "reports",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("study_id", sa.Integer(), sa.ForeignKey("studies.id"), nullable=False),
+        sa.Column("sop_instance_uid", sa.String(), nullable=False, unique=True),
+    )
+    create_table(
+        "bmd_values",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("report_id", sa.Integer(), sa.ForeignKey("reports.id"), nullable=False),
+        sa.Column("study_id", sa.Integer(), sa.ForeignKey("studies.id"), nullable=False),
+        sa.Column("patient_id", sa.Integer(), sa.ForeignKey("patients.id"), nullable=False),
+        sa.Column("body_part", sa.String(), nullable=False),
+        sa.Column("region", sa.String(), nullable=False),
+        sa.Column("bmd", sa.Float(), nullable=False),
+        sa.Column("t_score", sa.Float(), nullable=True),
+        sa.Column("z_score", sa.Float(), nullable=True),
+    )
+    create_table(
+        "bmd_trend_values",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("report_id", sa.Integer(), sa.ForeignKey("reports.id"), nullable=False),
+        sa.Column("study_id", sa.Integer(), sa.ForeignKey("studies.id"), nullable=False),
+        sa.Column("patient_id", sa.Integer(), sa.ForeignKey("patients.id"), nullable=False),
+        sa.Column("body_part", sa.String(), nullable=False),
+        sa.Column("region", sa.String(), nullable=False),
+        sa.Column("date", sa.DateTime(), nullable=False),
+        sa.Column("age", sa.Float(), nullable=True),
+        sa.Column("bmd", sa.Float(), nullable=False),
+        sa.Column("change_vs_previous", sa.Float(), nullable=True),
+        sa.Column("pchange_vs_previous", sa.Float(), nullable=True),
+        sa.Column("change_vs_baseline", sa.Float(), nullable=True),
+    )
+    create_table(
+        "results",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("sopInstanceUID", sa.String()),
+        sa.Column("seriesInstanceUID", sa.String()),
+        sa.Column("studyInstanceUID", sa.String()),
+        sa.Column("patientID", sa.String()),
+        sa.Column("accession", sa.String()),
+        sa.Column("diagnostic_category", sa.String()),
+        sa.Column("findings", sa.String()),
+        sa.Column("createdAt", sa.DateTime()),
+    )
+    create_table(
+        "institution_lsc",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("institution_name", sa.String(), nullable=False, unique=True),
+        sa.Column("abbreviation", sa.String(), nullable=False),
+        sa.Column("lsc_spine", sa.Float(), nullable=False),
+        sa.Column("lsc_total", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.DateTime()),
+    )
+
+
+def downgrade():
+    for table in [
+        "institution_lsc",
+        "results",
+        "bmd_trend_values",
+        "bmd_values",
+        "reports",
+        "studies",
+        "patients",
+    ]:
+        op.drop_table(table)
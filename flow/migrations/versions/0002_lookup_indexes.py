@@ -0,0 +1,47 @@
+"""lookup indexes
+
+Indexes the columns the flow filters on: a study's measurements by study_id
+(load_sample), trend values by study and date and by patient history, reports
+and studies by their parent, and results by accession and StudyInstanceUID.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-08-01 00:00:01.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ("ix_bmd_values_study_id", "bmd_values", ["study_id"]),
+    ("ix_bmd_trend_values_study_id_date", "bmd_trend_values", ["study_id", "date"]),
+    (
+        "ix_bmd_trend_values_patient_id_body_part_region_date",
+        "bmd_trend_values",
+        ["patient_id", "body_part", "region", "date"],
+    ),
+    ("ix_reports_study_id", "reports", ["study_id"]),
+    ("ix_studies_patient_id", "studies", ["patient_id"]),
+    ("ix_results_accession", "results", ["accession"]),
+    ("ix_results_studyInstanceUID", "results", ["studyInstanceUID"]),
+]
+
+
+def upgrade():
+    ## Superseded by the (study_id, date) index
+    op.drop_index("ix_bmd_trend_values_study_id", "bmd_trend_values", if_exists=True)
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, _ in INDEXES:
+        op.drop_index(name, table)
@@ -0,0 +1,121 @@
+"""dedupe trend values
+
+Every SR repeats the patient's whole trend table, so bmd_trend_values held each
+historical point once per report. Points are now unique per
+(patient_id, body_part, region, date) and reports reference them through
+report_trend_values. Existing rows are linked to the first copy of each point
+and the other copies are deleted.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-08-01 00:00:02.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "report_trend_values",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("report_id", sa.Integer(), sa.ForeignKey("reports.id"), nullable=False),
+        sa.Column(
+            "trend_value_id",
+            sa.Integer(),
+            sa.ForeignKey("bmd_trend_values.id"),
+            nullable=False,
+        ),
+    )
+
+    ## Link each report to the first copy of every point it contains, in the
+    ## order the report's rows were inserted
+    op.execute(
+        """
+        INSERT INTO report_trend_values (report_id, trend_value_id)
+        SELECT t.report_id, kept.id
+        FROM bmd_trend_values t
+        JOIN (
+            SELECT patient_id, body_part, region, date, MIN(id) AS id
+            FROM bmd_trend_values
+            GROUP BY patient_id, body_part, region, date
+        ) kept
+            ON kept.patient_id = t.patient_id
+            AND kept.body_part = t.body_part
+            AND kept.region = t.region
+            AND kept.date = t.date
+        GROUP BY t.report_id, kept.id
+        ORDER BY MIN(t.id)
+        """
+    )
+    op.create_index(
+        "uq_report_trend_values_report_id_trend_value_id",
+        "report_trend_values",
+        ["report_id", "trend_value_id"],
+        unique=True,
+    )
+    op.create_index(
+        "ix_report_trend_values_trend_value_id",
+        "report_trend_values",
+        ["trend_value_id"],
+    )
+    op.execute(
+        """
+        DELETE FROM bmd_trend_values
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM report_trend_values
+            WHERE report_trend_values.trend_value_id = bmd_trend_values.id
+        )
+        """
+    )
+
+    ## load_sample now reaches trend values through the links
+    op.drop_index("ix_bmd_trend_values_study_id_date", "bmd_trend_values")
+    op.drop_index("ix_bmd_trend_values_patient_id_body_part_region_date", "bmd_trend_values")
+    op.create_index(
+        "uq_bmd_trend_values_patient_id_body_part_region_date",
+        "bmd_trend_values",
+        ["patient_id", "body_part", "region", "date"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("uq_bmd_trend_values_patient_id_body_part_region_date", "bmd_trend_values")
+
+    ## Give every report its own copy of the points it was linked to
+    op.execute(
+        """
+        INSERT INTO bmd_trend_values (
+            report_id, study_id, patient_id, body_part, region, date, age, bmd,
+            change_vs_previous, pchange_vs_previous, change_vs_baseline
+        )
+        SELECT
+            l.report_id, r.study_id, t.patient_id, t.body_part, t.region, t.date,
+            t.age, t.bmd, t.change_vs_previous, t.pchange_vs_previous,
+            t.change_vs_baseline
+        FROM report_trend_values l
+        JOIN bmd_trend_values t ON t.id = l.trend_value_id
+        JOIN reports r ON r.id = l.report_id
+        WHERE l.report_id != t.report_id
+        ORDER BY l.id
+        """
+    )
+
+    op.create_index(
+        "ix_bmd_trend_values_patient_id_body_part_region_date",
+        "bmd_trend_values",
+        ["patient_id", "body_part", "region", "date"],
+    )
+    op.create_index(
+        "ix_bmd_trend_values_study_id_date", "bmd_trend_values", ["study_id", "date"]
+    )
+    op.drop_table("report_trend_values")
@@ -0,0 +1,27 @@
+"""result fracture risk
+
+Adds the CAROC 2010 fracture risk category to results. Existing results are
+filled in by the rescore-studies flow.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-08-01 00:00:03.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("results", sa.Column("fracture_risk", sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("results", "fracture_risk")
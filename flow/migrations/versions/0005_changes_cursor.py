@@ -0,0 +1,32 @@
+"""changes cursor
+
+Stores how far the follow-changes flow has read Orthanc's /changes feed.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2024-08-01 00:00:04.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "changes_cursors",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False, unique=True),
+        sa.Column("last_seq", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_table("changes_cursors")
@@ -0,0 +1,90 @@
+import os
+import anyio
+import httpx
+from utilities import orthanc_get_credentials, orthanc_get_url_root
+
+
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+ORTHANC_MAX_CONNECTIONS = int(os.getenv("ORTHANC_MAX_CONNECTIONS", "16"))
+ORTHANC_TIMEOUT = float(os.getenv("ORTHANC_TIMEOUT", "60"))
+ORTHANC_RETRIES = int(os.getenv("ORTHANC_RETRIES", "3"))
+
+
+class AsyncOrthancClient:
+    """Non-blocking counterpart of orthanc_get_session for the async pipeline.
+
+    One client is shared by every fetch of a run, so requests reuse keep-alive
+    connections and ORTHANC_MAX_CONNECTIONS bounds the load put on Orthanc
+    however many studies are in flight. Failed connections are retried
+    ORTHANC_RETRIES times.
+
+    Use as an async context manager:
+
+        async with AsyncOrthancClient() as client:
+            series = await client.get_json(f"/studies/{orthanc_study_uid}/series")
+    """
+
+    def __init__(
+        self,
+        url_root=None,
+        max_connections=ORTHANC_MAX_CONNECTIONS,
+        timeout=ORTHANC_TIMEOUT,
+    ):
+        transport = httpx.AsyncHTTPTransport(
+            retries=ORTHANC_RETRIES,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.client = httpx.AsyncClient(
+            base_url=url_root or orthanc_get_url_root(),
+            auth=orthanc_get_credentials(),
+            timeout=timeout,
+            transport=transport,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    @staticmethod
+    async def check(response):
+        if response.is_error:
+            await response.aread()
+            raise Exception(
+                f"Request failed with code {response.status_code}, returned error was: {response.text}"
+            )
+
+    async def get_json(self, path):
+        response = await self.client.get(path)
+        await self.check(response)
+        return response.json()
+
+    async def post_json(self, path, body):
+        response = await self.client.post(path, json=body)
+        await self.check(response)
+        return response.json()
+
+    async def download(self, path, destination):
+        """Streams a response body to a file in DOWNLOAD_CHUNK_SIZE chunks and
+        returns the number of bytes written."""
+        size = 0
+        async with self.client.stream("GET", path) as response:
+            await self.check(response)
+            async with await anyio.open_file(destination, "wb") as file:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    size += await file.write(chunk)
+        return size
+
+    async def find_studies(self, study_date_from, study_date_to):
+        """Returns the Orthanc ids of the studies acquired in a StudyDate range."""
+        return await self.post_json(
+            "/tools/find",
+            {
+                "Level": "Study",
+                "Query": {"StudyDate": f"{study_date_from or ''}-{study_date_to or ''}"},
+            },
+        )
@@ -0,0 +1,128 @@
+import atexit, os, socket, threading, time
+from functools import lru_cache
+import pydicom.uid
+import pynetdicom
+from pynetdicom.sop_class import (
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    SecondaryCaptureImageStorage,
+    ComprehensiveSRStorage,
+)
+
+
+## Orthanc's SCP closes associations opened to it once they have been idle for
+## DicomScpTimeout (30s by default), reconnect slightly before that instead of
+## hitting a dead socket
+IDLE_TIMEOUT = float(os.getenv("PACS_IDLE_TIMEOUT", "25"))
+## C-STORE statuses that mean the dataset was stored: success, and the warnings
+## for coercion of data elements, elements discarded and data set not matching
+## the SOP class
+STORE_OK_STATUSES = {0x0000, 0x0001, 0xB000, 0xB006, 0xB007}
+## DICOM peer the generated SRs are sent to
+PACS_HOST = os.getenv("PACS_HOST", "orthanc")
+PACS_PORT = int(os.getenv("PACS_PORT", "4242"))
+PACS_AE_TITLE = os.getenv("PACS_AE_TITLE", "ORTHANC")
+
+
+class AssociationManager:
+    """Keeps one association with the PACS open and reuses it between sends.
+
+    The association is (re)established lazily when none is open, when the peer
+    released or aborted it, or when it has been idle longer than idle_timeout.
+    Sends are serialised with a lock since an association carries one
+    operation at a time.
+    """
+
+    def __init__(self, host, port, ae_title, idle_timeout=IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.ae_title = ae_title
+        self.idle_timeout = idle_timeout
+
+        self._ae = pynetdicom.AE()
+        for context in [
+            DigitalXRayImageStorageForPresentation,
+            ComputedRadiographyImageStorage,
+            SecondaryCaptureImageStorage,
+            ComprehensiveSRStorage,
+        ]:
+            self._ae.add_requested_context(context, pydicom.uid.ExplicitVRLittleEndian)
+
+        self._assoc = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _associate(self):
+        if self._assoc is not None:
+            idle = time.monotonic() - self._last_used
+            if not self._assoc.is_established or idle > self.idle_timeout:
+                self._close()
+
+        if self._assoc is None:
+            assoc = self._ae.associate(self.host, self.port, ae_title=self.ae_title)
+            if not assoc.is_established:
+                raise Exception("Association rejected, aborted or never connected")
+            ## pynetdicom writes each PDU in several small sends, with Nagle's
+            ## algorithm every C-STORE then waits ~40ms for the peer's delayed ACK
+            assoc.dul.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._assoc = assoc
+            self._last_used = time.monotonic()
+            return assoc, False
+
+        return self._assoc, True
+
+    def _close(self, abort=False):
+        if self._assoc is not None:
+            if self._assoc.is_established:
+                if abort:
+                    self._assoc.abort()
+                else:
+                    self._assoc.release()
+            self._assoc = None
+
+    def send(self, datasets):
+        """Sends datasets with C-STORE over the shared association.
+
+        A failed send on a reused association is retried once on a fresh one,
+        since the peer may have dropped it without us noticing. A response with
+        a failure status raises, so the calling task retries.
+
+        Args:
+            datasets (list of pydicom.dataset.Dataset): Datasets to store.
+
+        Returns:
+            List of C-STORE response status datasets, one per dataset.
+        """
+        statuses = []
+        with self._lock:
+            for ds in datasets:
+                assoc, reused = self._associate()
+                status = assoc.send_c_store(ds)
+                if not status and reused:
+                    self._close(abort=True)
+                    assoc, _ = self._associate()
+                    status = assoc.send_c_store(ds)
+                if not status:
+                    self._close(abort=True)
+                    raise Exception(
+                        "Connection timed out, was aborted or received invalid response"
+                    )
+                self._last_used = time.monotonic()
+                if status.Status not in STORE_OK_STATUSES:
+                    raise Exception(
+                        "C-STORE failed with status 0x{0:04x}".format(status.Status)
+                    )
+                statuses.append(status)
+        return statuses
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+@lru_cache(maxsize=None)
+def get_association_manager():
+    """Returns the association manager shared by every task in this process."""
+    manager = AssociationManager(PACS_HOST, PACS_PORT, PACS_AE_TITLE)
+    atexit.register(manager.close)
+    return manager
@@ -0,0 +1,290 @@
+import os, shutil
+from collections import namedtuple
+from functools import partial
+import anyio
+from prefect import flow, get_run_logger
+from pydicom import dcmread
+from sr_parser import extract_dxa_report
+from database import get_session
+from ingest import ingest_report
+from bmd_utilities import process_sample
+from metrics import RunMetrics
+from orthanc_client import AsyncOrthancClient
+from main import (
+    PRECHECK_ORTHANC_SERIES,
+    has_predictor_series,
+    result_exists,
+    run_task_fn,
+    save_result,
+    select_sr_instances,
+    send_ds,
+)
+from utilities import (
+    COMPREHENSIVE_SR_CLASS_UID,
+    PREDICTOR_UID_ROOT,
+    create_sr,
+    read_reference,
+    scan_instances,
+)
+
+
+## Studies downloading at once, parsing at once and being stored at once
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv("PIPELINE_FETCH_CONCURRENCY", "8"))
+PIPELINE_PARSE_CONCURRENCY = int(os.getenv("PIPELINE_PARSE_CONCURRENCY", "2"))
+PIPELINE_STORE_CONCURRENCY = int(os.getenv("PIPELINE_STORE_CONCURRENCY", "2"))
+## Studies waiting between two stages. When a later stage falls behind the
+## queue fills up and the earlier stage stops fetching, which bounds the disk
+## and memory held by downloaded but unprocessed studies
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+ParsedStudy = namedtuple(
+    "ParsedStudy", ["orthanc_study_uid", "accession", "reference", "reports"]
+)
+
+
+@flow(name="extract-studies-async", log_prints=True)
+async def extract_studies_async(
+    orthanc_study_uids=None,
+    study_date_from=None,
+    study_date_to=None,
+    fetch_concurrency=PIPELINE_FETCH_CONCURRENCY,
+    parse_concurrency=PIPELINE_PARSE_CONCURRENCY,
+    store_concurrency=PIPELINE_STORE_CONCURRENCY,
+    queue_size=PIPELINE_QUEUE_SIZE,
+):
+    """Processes many studies with Orthanc fetches, SR parsing and database
+    writes overlapping, for catching up on a backlog.
+
+    Studies are given as Orthanc study ids or looked up by StudyDate range
+    (YYYYMMDD).
+    """
+    logger = get_run_logger()
+    metrics = RunMetrics()
+
+    async with AsyncOrthancClient() as client:
+        if orthanc_study_uids is None:
+            orthanc_study_uids = await client.find_studies(study_date_from, study_date_to)
+        logger.info(f"Batch of {len(orthanc_study_uids)} studies")
+
+        statuses = await run_pipeline(
+            client,
+            orthanc_study_uids,
+            fetch_concurrency=fetch_concurrency,
+            parse_concurrency=parse_concurrency,
+            store_concurrency=store_concurrency,
+            queue_size=queue_size,
+            logger=logger,
+            metrics=metrics,
+        )
+
+    counts = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    logger.info(f"Batch finished: {counts}")
+    metrics.publish("extract-studies-async", logger)
+    return counts
+
+
+async def run_pipeline(
+    client,
+    orthanc_study_uids,
+    fetch_concurrency=PIPELINE_FETCH_CONCURRENCY,
+    parse_concurrency=PIPELINE_PARSE_CONCURRENCY,
+    store_concurrency=PIPELINE_STORE_CONCURRENCY,
+    queue_size=PIPELINE_QUEUE_SIZE,
+    logger=None,
+    metrics=None,
+):
+    """Runs studies through fetch -> parse -> store stages.
+
+    Each stage has its own pool of workers connected to the next by a bounded
+    memory object stream. Fetching is async I/O on the event loop, parsing and
+    storing run in worker threads so they do not block it.
+
+    Args:
+        client (AsyncOrthancClient): Client used for every Orthanc request.
+        orthanc_study_uids (list): Orthanc ids of the studies.
+        fetch_concurrency, parse_concurrency, store_concurrency (int): Workers
+            per stage.
+        queue_size (int): Studies buffered between two stages.
+        logger: Optional logger.
+        metrics (RunMetrics): Optional collector for stage durations and
+            counters.
+
+    Returns:
+        Dict of Orthanc study id -> "processed", "empty", "already processed"
+        or "failed".
+    """
+    metrics = metrics if metrics is not None else RunMetrics()
+    statuses = {}
+
+    fetch_send, fetch_receive = anyio.create_memory_object_stream(queue_size)
+    parse_send, parse_receive = anyio.create_memory_object_stream(queue_size)
+    store_send, store_receive = anyio.create_memory_object_stream(queue_size)
+
+    async with anyio.create_task_group() as task_group:
+        task_group.start_soon(feed, orthanc_study_uids, fetch_send)
+        start_workers(
+            task_group,
+            fetch_concurrency,
+            partial(fetch_study, client, metrics=metrics),
+            fetch_receive,
+            parse_send,
+            statuses,
+            logger,
+        )
+        start_workers(
+            task_group,
+            parse_concurrency,
+            partial(anyio.to_thread.run_sync, partial(parse_study, metrics=metrics, logger=logger)),
+            parse_receive,
+            store_send,
+            statuses,
+            logger,
+        )
+        start_workers(
+            task_group,
+            store_concurrency,
+            partial(anyio.to_thread.run_sync, partial(store_study, logger=logger, metrics=metrics)),
+            store_receive,
+            None,
+            statuses,
+            logger,
+        )
+    return statuses
+
+
+async def feed(orthanc_study_uids, send):
+    async with send:
+        for orthanc_study_uid in orthanc_study_uids:
+            await send.send(orthanc_study_uid)
+
+
+def start_workers(task_group, count, worker, receive, send, statuses, logger):
+    ## Every worker holds its own clone of the streams. The next stage sees the
+    ## end of its input once the last worker of this stage closes its clone
+    with receive:
+        for _ in range(count):
+            task_group.start_soon(
+                run_worker,
+                worker,
+                receive.clone(),
+                send.clone() if send is not None else None,
+                statuses,
+                logger,
+            )
+    if send is not None:
+        send.close()
+
+
+async def run_worker(worker, receive, send, statuses, logger):
+    async with receive:
+        try:
+            async for item in receive:
+                orthanc_study_uid = item if isinstance(item, str) else item.orthanc_study_uid
+                try:
+                    status, result = await worker(item)
+                except Exception as e:
+                    if logger is not None:
+                        logger.info(f"Study {orthanc_study_uid} failed due to {e}")
+                    status, result = "failed", None
+
+                if result is None:
+                    statuses[orthanc_study_uid] = status
+                    shutil.rmtree(f"./{orthanc_study_uid}", ignore_errors=True)
+                else:
+                    ## Blocks while the next stage is full
+                    await send.send(result)
+        finally:
+            if send is not None:
+                send.close()
+
+
+async def fetch_study(client, orthanc_study_uid, metrics):
+    """Checks a study is new and downloads its SR instances."""
+    with metrics.stage("precheck"):
+        study = await client.get_json(f"/studies/{orthanc_study_uid}")
+        study_instance_uid = study.get("MainDicomTags", {}).get("StudyInstanceUID")
+        if await anyio.to_thread.run_sync(result_exists, study_instance_uid):
+            return "already processed", None
+
+        series = await client.get_json(f"/studies/{orthanc_study_uid}/series")
+        if PRECHECK_ORTHANC_SERIES and has_predictor_series(series):
+            return "already processed", None
+
+    with metrics.stage("download"):
+        os.makedirs(f"./{orthanc_study_uid}/IMAGES", exist_ok=True)
+        for instance_id in select_sr_instances(series):
+            size = await client.download(
+                f"/instances/{instance_id}/file",
+                f"./{orthanc_study_uid}/IMAGES/{instance_id}",
+            )
+            metrics.count("bytes_downloaded", size)
+    return "fetched", orthanc_study_uid
+
+
+def parse_study(orthanc_study_uid, metrics, logger=None):
+    """Reads the downloaded SRs of a study into ExtractedReport tuples.
+
+    As in main.parse_study an SR that cannot be parsed is logged and skipped.
+    """
+    with metrics.stage("parse"):
+        instances = scan_instances(f"./{orthanc_study_uid}")
+        metrics.count("instances_scanned", len(instances))
+        if not len(instances) > 0:
+            return "empty", None
+        for instance in instances:
+            if PREDICTOR_UID_ROOT in instance.series_instance_uid:
+                return "already processed", None
+
+        reports = []
+        for instance in instances:
+            if not COMPREHENSIVE_SR_CLASS_UID in instance.sop_class_uid:
+                continue
+            try:
+                extracted = extract_dxa_report(dcmread(instance.path))
+            except Exception as e:
+                if logger is not None:
+                    logger.info(f"Error parsing SR {instance.path} due to {e}")
+                continue
+            reports.append((instance.path, extracted))
+        metrics.count("reports_parsed", len(reports))
+
+        return "parsed", ParsedStudy(
+            orthanc_study_uid=orthanc_study_uid,
+            accession=instances[-1].accession,
+            reference=read_reference(instances[-1]),
+            reports=reports,
+        )
+
+
+def store_study(parsed, logger, metrics):
+    """Stores the parsed reports, then reports the study as run_study does."""
+    with metrics.stage("store"):
+        with get_session() as session:
+            for path, extracted in parsed.reports:
+                try:
+                    metrics.count("rows_inserted", ingest_report(session, extracted, logger))
+                except Exception as e:
+                    if logger is not None:
+                        logger.info(f"Error saving SR {path} due to {e}")
+
+    with metrics.stage("findings"):
+        findings, diagnostic_category, fracture_risk = process_sample(parsed.accession)
+
+    with metrics.stage("create_sr"):
+        sr_ds = create_sr(parsed.reference, findings, diagnostic_category, fracture_risk)
+
+    with metrics.stage("send"):
+        run_task_fn(send_ds, sr_ds, metrics)
+
+    with metrics.stage("save"):
+        save_result(
+            studyInstanceUID=sr_ds.StudyInstanceUID,
+            patientID=parsed.reference.PatientID,
+            accession=parsed.accession,
+            diagnostic_category=diagnostic_category,
+            fracture_risk=fracture_risk,
+            findings=findings,
+        )
+    return "processed", None
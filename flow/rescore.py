@@ -0,0 +1,310 @@
+import numpy as np
+import pandas as pd
+from prefect import flow, get_run_logger
+from sqlalchemy import bindparam, text, update
+from caroc import classify_risk
+from lsc import classify_changes
+from data_models import Result
+from database import get_engine
+
+
+VERTEBRAE = ["L1", "L2", "L3", "L4"]
+
+## Site -> (body_part, region), in the order return_findings reports them
+SITES = {
+    "left_neck": ("Left Femur", "Neck"),
+    "left_total": ("Left Femur", "Total"),
+    "left_radius": ("Left Forearm", "Radius 33%"),
+    "right_neck": ("Right Femur", "Neck"),
+    "right_total": ("Right Femur", "Total"),
+    "right_radius": ("Right Forearm", "Radius 33%"),
+}
+
+## Sites where men are scored on their lowest row (male and female reference)
+MALE_MINIMUM_SITES = ["left_neck", "left_total", "right_neck", "right_total"]
+
+STUDIES_QUERY = text(
+    """
+    SELECT s.id AS study_id, s.accession, s.age, s.date_time, s.institution_name, p.sex
+    FROM studies s
+    JOIN patients p ON p.id = s.patient_id
+    """
+)
+
+BMD_VALUES_QUERY = text(
+    """
+    SELECT id, study_id, body_part, region, bmd, t_score, z_score
+    FROM bmd_values
+    ORDER BY id
+    """
+)
+
+## The trend points linked to each study's reports, as database.load_sample
+## reads them for one study
+BMD_TREND_VALUES_QUERY = text(
+    """
+    SELECT r.study_id, t.body_part, t.region, t.date, t.bmd
+    FROM reports r
+    JOIN report_trend_values l ON l.report_id = r.id
+    JOIN bmd_trend_values t ON t.id = l.trend_value_id
+    ORDER BY l.id
+    """
+)
+
+
+def load_cohort(conn):
+    studies = pd.read_sql(STUDIES_QUERY, conn).set_index("study_id")
+    bmd_values = pd.read_sql(BMD_VALUES_QUERY, conn)
+    bmd_trend_values = pd.read_sql(BMD_TREND_VALUES_QUERY, conn)
+    bmd_trend_values["date"] = pd.to_datetime(bmd_trend_values["date"])
+    return studies, bmd_values, bmd_trend_values
+
+
+def exclude_vertebrae(t_scores):
+    """Vectorised filter_vertebra_by_tscore.
+
+    Args:
+        t_scores (numpy.ndarray): (n, 4) L1-L4 T-scores, NaN where missing.
+
+    Returns:
+        Tuple of boolean arrays (exclude_l1, exclude_l4).
+    """
+    valid = ~np.isnan(t_scores)
+    count = valid.sum(axis=1)
+
+    ## Stable descending sort with missing scores last, like sorted(reverse=True)
+    order = np.argsort(np.where(valid, -t_scores, np.inf), axis=1, kind="stable")
+    ordered = np.take_along_axis(t_scores, order, axis=1)
+    rank = np.argsort(order, axis=1)
+
+    def at(position):
+        return np.take_along_axis(
+            ordered, np.clip(position, 0, 3)[:, None], axis=1
+        )[:, 0]
+
+    with np.errstate(invalid="ignore"):
+        l1_rank = rank[:, 0]
+        exclude_l1 = valid[:, 0] & (
+            ((count > 1) & (l1_rank == 0) & (ordered[:, 0] - ordered[:, 1] > 1))
+            | ((count > 2) & (l1_rank == 1) & (ordered[:, 1] - ordered[:, 2] > 1))
+        )
+
+        l4_rank = rank[:, 3]
+        exclude_l4 = valid[:, 3] & (
+            ((count > 1) & (l4_rank == count - 1) & (at(count - 2) - at(count - 1) > 1))
+            | ((count > 2) & (l4_rank == count - 2) & (at(count - 3) - at(count - 2) > 1))
+        )
+
+    return exclude_l1, exclude_l4
+
+
+def diagnostic_categories(age, min_score):
+    """Vectorised get_diagnostic_category on the lowest score of each study."""
+    categories = np.full(len(min_score), None, dtype=object)
+    with np.errstate(invalid="ignore"):
+        over_50 = age >= 50
+        categories[over_50] = "Normal bone mass"
+        categories[over_50 & (min_score < -1)] = "Low bone mass"
+        categories[over_50 & (min_score <= -2.5)] = "Osteoporosis"
+        categories[~over_50] = "Within expected range for age"
+        categories[~over_50 & (min_score <= -2.0)] = "Below expected range for age"
+    categories[np.isnan(min_score)] = None
+    return categories
+
+
+def reference_values(studies, bmd_trend_values):
+    """Vectorised StudyMeasurements.reference.
+
+    Returns:
+        The first trend row of each study and region at the study's previous
+        exam, the latest trend date before the study's day.
+    """
+    study_day = (
+        pd.to_datetime(studies["date_time"]).dt.normalize().reindex(bmd_trend_values.study_id)
+    )
+    prior = bmd_trend_values.loc[
+        bmd_trend_values.date.to_numpy() < study_day.to_numpy()
+    ]
+    reference_date = prior.groupby("study_id")["date"].max()
+    prior = prior.loc[
+        prior.date.to_numpy() == reference_date.reindex(prior.study_id).to_numpy()
+    ]
+    return prior.drop_duplicates(["study_id", "region"], keep="first")
+
+
+def score_cohort(studies, bmd_values, bmd_trend_values):
+    """Computes the diagnostic category of every study at once.
+
+    Applies the same site selection, vertebra exclusion and T/Z-score choice as
+    return_findings, using grouped operations over the whole cohort instead of
+    one study at a time. Null scores are treated as missing.
+
+    Args:
+        studies (pandas.DataFrame): Indexed by study_id with accession, age,
+            date_time, institution_name and sex.
+        bmd_values (pandas.DataFrame): bmd_values rows ordered by id.
+        bmd_trend_values (pandas.DataFrame): Trend rows of each study in
+            report order.
+
+    Returns:
+        DataFrame indexed by study_id with accession, min_score,
+        diagnostic_category and fracture_risk, None where a study has no
+        usable score, and lumbar_change and hip_change since the previous
+        exam: "increase" or "decrease" when larger than the institution's
+        LSC, "none" when not, None without a previous exam or LSC.
+    """
+    bmd_values = bmd_values.loc[bmd_values.study_id.isin(studies.index)]
+    age = studies["age"].reindex(bmd_values.study_id).to_numpy()
+    bmd_values = bmd_values.assign(
+        score=np.where(age >= 50, bmd_values.t_score, bmd_values.z_score)
+    )
+    keys = ["study_id", "body_part", "region"]
+    first = bmd_values.drop_duplicates(keys, keep="first")
+    lowest = bmd_values.groupby(keys, as_index=False)["score"].min()
+    highest_t = bmd_values.groupby(keys, as_index=False)["t_score"].max()
+
+    def site(body_part, region, frame):
+        selected = frame.loc[(frame.body_part == body_part) & (frame.region == region)]
+        return selected.set_index("study_id").reindex(studies.index)
+
+    ## Lumbar spine, the vertebra exclusion only applies from 50 years of age
+    t_scores = np.column_stack(
+        [site("AP Spine", vertebra, first)["t_score"].to_numpy() for vertebra in VERTEBRAE]
+    )
+    exclude_l1, exclude_l4 = exclude_vertebrae(t_scores)
+    over_50 = studies["age"].to_numpy() >= 50
+    exclude_l1 &= over_50
+    exclude_l4 &= over_50
+    lumbar = np.select(
+        [exclude_l1 & exclude_l4, exclude_l4, exclude_l1],
+        [
+            np.nan,
+            site("AP Spine", "L1-L3", first)["score"].to_numpy(),
+            site("AP Spine", "L2-L4", first)["score"].to_numpy(),
+        ],
+        default=site("AP Spine", "L1-L4", first)["score"].to_numpy(),
+    )
+
+    is_male = (
+        studies["sex"].str.replace("F", "female").str.replace("M", "male") == "male"
+    ).to_numpy()
+    columns = [lumbar]
+    for name, (body_part, region) in SITES.items():
+        score = site(body_part, region, first)["score"].to_numpy()
+        if name in MALE_MINIMUM_SITES:
+            score = np.where(
+                is_male, site(body_part, region, lowest)["score"].to_numpy(), score
+            )
+        columns.append(score)
+
+    with np.errstate(invalid="ignore"):
+        scores = np.column_stack(columns).astype(float)
+        has_score = ~np.isnan(scores).all(axis=1)
+        min_score = np.full(len(studies), np.nan)
+        min_score[has_score] = np.nanmin(scores[has_score], axis=1)
+
+    ## CAROC rates men on the female reference, their highest neck T-score. The
+    ## left femur is used unless only the right one was measured
+    neck_t_score = np.full(len(studies), np.nan)
+    for body_part in ["Right Femur", "Left Femur"]:
+        t_score = np.where(
+            is_male,
+            site(body_part, "Neck", highest_t)["t_score"].to_numpy(),
+            site(body_part, "Neck", first)["t_score"].to_numpy(),
+        ).astype(float)
+        has_neck = site(body_part, "Neck", first)["region"].notna().to_numpy()
+        neck_t_score = np.where(has_neck, t_score, neck_t_score)
+    lumbar_t_score = np.where(over_50, lumbar, np.nan)
+
+    ## Change of the reported lumbar region and the left total femur since the
+    ## previous exam, rounded as get_change_value does
+    reference = reference_values(studies, bmd_trend_values)
+
+    def change(body_part, region):
+        current = site(body_part, region, first)["bmd"].to_numpy(dtype=float)
+        ## References are looked up by trend region only, as in findings
+        previous = (
+            reference.loc[reference.region == f"Trend {region}"]
+            .set_index("study_id")["bmd"]
+            .reindex(studies.index)
+            .to_numpy(dtype=float)
+        )
+        return np.round(current - previous, 3)
+
+    lumbar_change = np.select(
+        [exclude_l1 & exclude_l4, exclude_l4, exclude_l1],
+        [np.nan, change("AP Spine", "L1-L3"), change("AP Spine", "L2-L4")],
+        default=change("AP Spine", "L1-L4"),
+    )
+    ## As in return_findings a hip change of exactly zero is not reported
+    hip_change = change("Left Femur", "Total")
+    hip_change[hip_change == 0] = np.nan
+
+    changes, significant = classify_changes(
+        np.concatenate([lumbar_change, hip_change]),
+        ["lumbar spine"] * len(studies) + ["hip"] * len(studies),
+        np.tile(studies["institution_name"].to_numpy(dtype=object), 2),
+    )
+    changes[significant == False] = "none"
+    lumbar_changes, hip_changes = np.split(changes, 2)
+
+    return pd.DataFrame(
+        {
+            "accession": studies["accession"].to_numpy(),
+            "min_score": min_score,
+            "diagnostic_category": diagnostic_categories(
+                studies["age"].to_numpy(), min_score
+            ),
+            "fracture_risk": classify_risk(
+                studies["age"].to_numpy(), is_male, neck_t_score, lumbar_t_score
+            ),
+            "lumbar_change": lumbar_changes,
+            "hip_change": hip_changes,
+        },
+        index=studies.index,
+    )
+
+
+def save_categories(conn, scored):
+    """Writes the recomputed categories and fracture risks onto the stored
+    results in one executemany."""
+    rows = [
+        {
+            "b_accession": accession,
+            "b_diagnostic_category": category,
+            "b_fracture_risk": risk,
+        }
+        for accession, category, risk in zip(
+            scored["accession"], scored["diagnostic_category"], scored["fracture_risk"]
+        )
+        if category is not None
+    ]
+    if rows:
+        conn.execute(
+            update(Result.__table__)
+            .where(Result.__table__.c.accession == bindparam("b_accession"))
+            .values(
+                diagnostic_category=bindparam("b_diagnostic_category"),
+                fracture_risk=bindparam("b_fracture_risk"),
+            ),
+            rows,
+        )
+    return len(rows)
+
+
+@flow(name="rescore-studies", log_prints=True)
+def rescore_studies(save=True):
+    """Recomputes the diagnostic category and fracture risk of every stored
+    study."""
+    logger = get_run_logger()
+    with get_engine().begin() as conn:
+        studies, bmd_values, bmd_trend_values = load_cohort(conn)
+        scored = score_cohort(studies, bmd_values, bmd_trend_values)
+        logger.info(
+            f"Scored {scored.diagnostic_category.notna().sum()} of {len(scored)} studies"
+        )
+        for column in ["lumbar_change", "hip_change"]:
+            logger.info(f"{column}: {scored[column].value_counts().to_dict()}")
+        if save:
+            logger.info(f"Updated {save_categories(conn, scored)} results")
+    return scored
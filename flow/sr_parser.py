@@ -1,5 +1,13 @@
+import os
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
 import pydicom
 
+## Limits protecting workers from pathological SR trees
+SR_MAX_DEPTH = int(os.getenv("SR_MAX_DEPTH", "64"))
+SR_MAX_ITEMS = int(os.getenv("SR_MAX_ITEMS", "200000"))
+
 
 def convert_to_dict(ds):
     output = {}
@@ -26,190 +34,166 @@ def convert_value(value):
         return value
 
 
-def get_mapping(attribute_number):
-    attributes = attribute_number.split(",")
-    return hex(int(attributes[0], 16)), hex(int(attributes[1], 16))
+## Tags used to walk SR content items, as plain ints so lookups skip parsing
+VALUE_TYPE = 0x0040A040
+CONCEPT_NAME_CODE_SEQUENCE = 0x0040A043
+CODE_MEANING = 0x00080104
+CONTENT_SEQUENCE = 0x0040A730
+TEXT_VALUE = 0x0040A160
+CONCEPT_CODE_SEQUENCE = 0x0040A168
+PERSON_NAME = 0x0040A123
+MEASURED_VALUE_SEQUENCE = 0x0040A300
+NUMERIC_VALUE = 0x0040A30A
+MEASUREMENT_UNITS_CODE_SEQUENCE = 0x004008EA
+DATETIME = 0x0040A120
+DATE = 0x0040A121
+TIME = 0x0040A122
+UID = 0x0040A124
+
+
+def get_concept(measurement):
+    return measurement[CONCEPT_NAME_CODE_SEQUENCE].value[0][CODE_MEANING]
 
 
 def process_text(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a160")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[TEXT_VALUE]
 
 
 def process_code(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a168")][0][
-        get_mapping("0008,0104")
-    ]
-    return measurement_concept, measurement_value
+    measurement_value = measurement[CONCEPT_CODE_SEQUENCE].value[0][CODE_MEANING]
+    return get_concept(measurement), measurement_value
 
 
 def process_pname(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a123")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[PERSON_NAME]
 
 
 def process_num(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
+    measurement_concept = get_concept(measurement)
+    measurement_value = None
+    measurement_units = None
 
     # Access the Measured Value Sequence
-    if get_mapping("0040,a300") in measurement:
-        measured_value_sequence = measurement[get_mapping("0040,a300")]
+    if MEASURED_VALUE_SEQUENCE in measurement:
+        measured_value_sequence = measurement[MEASURED_VALUE_SEQUENCE].value
 
         if measured_value_sequence:
             measured_value = measured_value_sequence[0]
 
             # Get the numeric value
-            if get_mapping("0040,a30a") in measured_value:
-                measurement_value = measured_value[get_mapping("0040,a30a")].value
-            else:
-                measurement_value = None
+            if NUMERIC_VALUE in measured_value:
+                measurement_value = measured_value[NUMERIC_VALUE].value
 
             # Get the measurement units
-            if get_mapping("0040,08ea") in measured_value:
-                measurement_units = measured_value[get_mapping("0040,08ea")][0][
-                    get_mapping("0008,0104")
-                ].value
-            else:
-                measurement_units = None
-        else:
-            measurement_value = None
-            measurement_units = None
-    else:
-        measurement_value = None
-        measurement_units = None
+            if MEASUREMENT_UNITS_CODE_SEQUENCE in measured_value:
+                measurement_units = measured_value[
+                    MEASUREMENT_UNITS_CODE_SEQUENCE
+                ].value[0][CODE_MEANING].value
 
     return measurement_concept, measurement_value, measurement_units
 
 
 def process_datetime(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a120")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[DATETIME]
 
 
 def process_date(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a121")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[DATE]
 
 
 def process_time(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a122")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[TIME]
 
 
 def process_uidref(measurement):
-    measurement_concept = measurement[get_mapping("0040,a043")][0][
-        get_mapping("0008,0104")
-    ]
-    measurement_value = measurement[get_mapping("0040,a124")]
-    return measurement_concept, measurement_value
+    return get_concept(measurement), measurement[UID]
+
+
+def store_value(process):
+    def store(item, container):
+        measurement_concept, measurement_value = process(item)
+        container[measurement_concept.value] = measurement_value.value
+
+    return store
+
+
+def store_pname(item, container):
+    measurement_concept, measurement_value = process_pname(item)
+    container[measurement_concept.value] = convert_value(measurement_value.value)
 
 
-def process_container_type(container, report):
-    container_type = container[get_mapping("0040,a040")]
+def store_num(item, container):
+    measurement_concept, measurement_value, measurement_units = process_num(item)
 
-    if container_type.value != "CONTAINER":
+    if measurement_value is not None and measurement_units is not None:
+        container[measurement_concept.value] = {
+            "value": measurement_value,
+            "units": measurement_units,
+        }
+    elif measurement_value is not None:
+        container[measurement_concept.value] = {"value": measurement_value}
+
+
+## Content item value type -> function storing the item into its parent container
+VALUE_TYPE_HANDLERS = {
+    "TEXT": store_value(process_text),
+    "CODE": store_value(process_code),
+    "PNAME": store_pname,
+    "NUM": store_num,
+    "DATETIME": store_value(process_datetime),
+    "DATE": store_value(process_date),
+    "TIME": store_value(process_time),
+    "UIDREF": store_value(process_uidref),
+}
+
+
+def process_container_type(container, report, max_depth=None, max_items=None):
+    """Walks an SR content tree into nested dicts keyed by concept name.
+
+    The tree is walked with an explicit stack, each nested CONTAINER being
+    written straight into its parent's dict, so deep trees cost no recursion.
+    Trees nested deeper than max_depth containers or holding more than
+    max_items content items are rejected with a ValueError.
+    """
+    max_depth = SR_MAX_DEPTH if max_depth is None else max_depth
+    max_items = SR_MAX_ITEMS if max_items is None else max_items
+
+    if container[VALUE_TYPE].value != "CONTAINER":
         return
 
-    container_concept = container[get_mapping("0040,a043")][0][get_mapping("0008,0104")]
-
-    report[container_concept.value] = {}
-
-    if get_mapping("0040,a730") not in container:
-        return container_concept.value, report
-
-    container_sequence = container[get_mapping("0040,a730")]
-
-    for item in container_sequence:
-
-        measurement_report_content_type = item[get_mapping("0040,a040")].value
-
-        if measurement_report_content_type == "TEXT":
-            measurement_concept, measurement_value = process_text(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "CODE":
-            measurement_concept, measurement_value = process_code(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "PNAME":
-            measurement_concept, measurement_value = process_pname(item)
-            report[container_concept.value][measurement_concept.value] = convert_value(
-                measurement_value.value
-            )
-
-        elif measurement_report_content_type == "NUM":
-            measurement_concept, measurement_value, measurement_units = process_num(
-                item
-            )
-
-            if measurement_value is not None and measurement_units is not None:
-                report[container_concept.value][measurement_concept.value] = {
-                    "value": measurement_value,
-                    "units": measurement_units,
-                }
-            elif measurement_value is not None:
-                report[container_concept.value][measurement_concept.value] = {
-                    "value": measurement_value
-                }
-
-        elif measurement_report_content_type == "DATETIME":
-            measurement_concept, measurement_value = process_datetime(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "DATE":
-            measurement_concept, measurement_value = process_date(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "TIME":
-            measurement_concept, measurement_value = process_time(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "UIDREF":
-            measurement_concept, measurement_value = process_uidref(item)
-            report[container_concept.value][
-                measurement_concept.value
-            ] = measurement_value.value
-
-        elif measurement_report_content_type == "CONTAINER":
-            container_report = {}
-            container_concept_found, container_value_found = process_container_type(
-                item, container_report
-            )
-            report[container_concept.value][container_concept_found] = (
-                container_value_found[container_concept_found]
-            )
-
-    return container_concept.value, report
+    container_concept = get_concept(container).value
+    report[container_concept] = {}
+
+    if CONTENT_SEQUENCE not in container:
+        return container_concept, report
+
+    items = 0
+    stack = [(iter(container[CONTENT_SEQUENCE].value), report[container_concept], 1)]
+    while stack:
+        content, container_report, depth = stack[-1]
+        item = next(content, None)
+        if item is None:
+            stack.pop()
+            continue
+
+        items += 1
+        if items > max_items:
+            raise ValueError(f"SR has more than {max_items} content items")
+
+        value_type = item[VALUE_TYPE].value
+        if value_type == "CONTAINER":
+            if depth >= max_depth:
+                raise ValueError(f"SR containers are nested deeper than {max_depth}")
+            child_report = {}
+            container_report[get_concept(item).value] = child_report
+            if CONTENT_SEQUENCE in item:
+                stack.append((iter(item[CONTENT_SEQUENCE].value), child_report, depth + 1))
+        else:
+            handler = VALUE_TYPE_HANDLERS.get(value_type)
+            if handler is not None:
+                handler(item, container_report)
+
+    return container_concept, report
 
 
 def parse_age(age_str):
@@ -236,7 +220,7 @@ def add_if_exists(ds, field):
         return None
 
 
-def convert_dicom_to_json(ds):
+def convert_header(ds):
     report = {}
     report["PatientID"] = add_if_exists(ds, "PatientID")
     report["PatientBirthDate"] = add_if_exists(ds, "PatientBirthDate")
@@ -257,6 +241,189 @@ def convert_dicom_to_json(ds):
     report["Manufacturer"] = add_if_exists(ds, "Manufacturer")
     report["ManufacturerModelName"] = add_if_exists(ds, "ManufacturerModelName")
     report["SoftwareVersions"] = add_if_exists(ds, "SoftwareVersions")
+    return report
+
 
+def convert_dicom_to_json(ds):
+    report = convert_header(ds)
     _, report = process_container_type(ds, report)
     return report
+
+
+BODY_PARTS = [
+    "Left Femur",
+    "AP Spine",
+    "Right Femur",
+    "Left Forearm",
+    "Right Forearm",
+    "DualFemur",
+]
+
+BMDRow = namedtuple("BMDRow", ["body_part", "region", "bmd", "t_score", "z_score"])
+
+BMDTrendRow = namedtuple(
+    "BMDTrendRow",
+    [
+        "body_part",
+        "region",
+        "date",
+        "age",
+        "bmd",
+        "change_vs_previous",
+        "pchange_vs_previous",
+        "change_vs_baseline",
+    ],
+)
+
+ExtractedReport = namedtuple(
+    "ExtractedReport", ["header", "has_dxa_report", "bmd_values", "bmd_trend_values", "errors"]
+)
+
+
+@lru_cache(maxsize=4096)
+def parse_trend_date(date_str):
+    return datetime.strptime(date_str, "%d-%b-%Y")
+
+
+def get_children(container, counter):
+    """Maps concept name -> (value type, content item) for a container, the
+    last item winning like it does in the nested dict built by
+    process_container_type."""
+    children = {}
+    if CONTENT_SEQUENCE in container:
+        content = container[CONTENT_SEQUENCE].value
+        counter[0] += len(content)
+        if counter[0] > SR_MAX_ITEMS:
+            raise ValueError(f"SR has more than {SR_MAX_ITEMS} content items")
+        for item in content:
+            children[get_concept(item).value] = (item[VALUE_TYPE].value, item)
+    return children
+
+
+def get_numeric_value(item):
+    if MEASURED_VALUE_SEQUENCE not in item:
+        return None
+    measured_value_sequence = item[MEASURED_VALUE_SEQUENCE].value
+    if not measured_value_sequence or NUMERIC_VALUE not in measured_value_sequence[0]:
+        return None
+    return measured_value_sequence[0][NUMERIC_VALUE].value
+
+
+def get_item_value(value_type, item):
+    """Returns the scalar value of a leaf content item, NUM items giving their
+    numeric value."""
+    if value_type == "NUM":
+        return get_numeric_value(item)
+    handler = VALUE_TYPE_HANDLERS.get(value_type)
+    if handler is None:
+        return None
+    value = {}
+    handler(item, value)
+    return next(iter(value.values()), None)
+
+
+def get_num(children, concept):
+    value_type, item = children.get(concept, (None, None))
+    if value_type != "NUM":
+        return None
+    return get_numeric_value(item)
+
+
+def get_nested_num(children, container_concept, concept, counter):
+    value_type, item = children.get(container_concept, (None, None))
+    if value_type != "CONTAINER":
+        return None
+    return get_num(get_children(item, counter), concept)
+
+
+def extract_dxa_report(ds):
+    """Extracts a DXA SR straight into bmd_values and bmd_trend_values rows.
+
+    Equivalent to running convert_dicom_to_json and then reading the body part
+    and region values back out of the nested dict, but only the containers that
+    hold measurements are visited and no intermediate dicts are built.
+
+    Args:
+        ds (pydicom.dataset.Dataset): The SR dataset.
+
+    Returns:
+        ExtractedReport with the header fields, whether the SR holds a DXA
+        Report, lists of BMDRow and BMDTrendRow tuples and a list of messages
+        for regions that could not be read.
+    """
+    header = convert_header(ds)
+    bmd_values = []
+    bmd_trend_values = []
+    errors = []
+
+    if (
+        VALUE_TYPE not in ds
+        or ds[VALUE_TYPE].value != "CONTAINER"
+        or get_concept(ds).value != "DXA Report"
+    ):
+        return ExtractedReport(header, False, bmd_values, bmd_trend_values, errors)
+
+    counter = [0]
+    body_parts = get_children(ds, counter)
+    for body_part in BODY_PARTS:
+        value_type, body_part_item = body_parts.get(body_part, (None, None))
+        if value_type != "CONTAINER":
+            continue
+
+        for region, (value_type, region_item) in get_children(
+            body_part_item, counter
+        ).items():
+            if value_type != "CONTAINER":
+                continue
+            region_children = get_children(region_item, counter)
+
+            if "Trend" in region:
+                for date_str, (value_type, trend_item) in region_children.items():
+                    if value_type != "CONTAINER":
+                        continue
+                    trend_children = get_children(trend_item, counter)
+                    ## bmd is not nullable, a single bad point would abort the batch
+                    bmd = get_num(trend_children, "BMD")
+                    if bmd is None:
+                        continue
+                    try:
+                        date = parse_trend_date(date_str)
+                    except ValueError as e:
+                        errors.append(f"{body_part} {region} {e}")
+                        continue
+                    bmd_trend_values.append(
+                        BMDTrendRow(
+                            body_part=body_part,
+                            region=region,
+                            date=date,
+                            age=get_num(trend_children, "AGE"),
+                            bmd=bmd,
+                            change_vs_previous=get_nested_num(
+                                trend_children, "CHANGE_VS_PREVIOUS", "BMD", counter
+                            ),
+                            pchange_vs_previous=get_nested_num(
+                                trend_children, "PCHANGE_VS_PREVIOUS", "BMD", counter
+                            ),
+                            change_vs_baseline=get_nested_num(
+                                trend_children, "CHANGE_VS_BASELINE", "BMD", counter
+                            ),
+                        )
+                    )
+            else:
+                bmd = get_num(region_children, "BMD")
+                if bmd:
+                    bmd_values.append(
+                        BMDRow(
+                            body_part=body_part,
+                            region=region,
+                            bmd=bmd,
+                            t_score=get_item_value(
+                                *region_children.get("BMD_TSCORE", (None, None))
+                            ),
+                            z_score=get_item_value(
+                                *region_children.get("BMD_ZSCORE", (None, None))
+                            ),
+                        )
+                    )
+
+    return ExtractedReport(header, True, bmd_values, bmd_trend_values, errors)
@@ -3,6 +3,9 @@
 # Allow prefect server to start
 sleep 5
 
+# create the database schema once per container start
+python database.py
+
 # deploy prefect-flows
 prefect deployment build main.py:extract_studies \
                       -n bmd \
@@ -11,5 +14,40 @@ prefect deployment build main.py:extract_studies \
                       --skip-upload \
                       --apply
 
+prefect deployment build main.py:extract_studies_batch \
+                      -n bmd-batch \
+                      -q bmd-pool \
+                      -o prefect-batch.yaml \
+                      --skip-upload \
+                      --apply
+
+prefect deployment build pipeline.py:extract_studies_async \
+                      -n bmd-async \
+                      -q bmd-pool \
+                      -o prefect-async.yaml \
+                      --skip-upload \
+                      --apply
+
+prefect deployment build backfill.py:backfill_reports \
+                      -n bmd-backfill \
+                      -q bmd-pool \
+                      -o prefect-backfill.yaml \
+                      --skip-upload \
+                      --apply
+
+prefect deployment build changes.py:follow_changes \
+                      -n bmd-changes \
+                      -q bmd-pool \
+                      -o prefect-changes.yaml \
+                      --skip-upload \
+                      --apply
+
+prefect deployment build lsc.py:set_institution_lsc \
+                      -n bmd-lsc \
+                      -q bmd-pool \
+                      -o prefect-lsc.yaml \
+                      --skip-upload \
+                      --apply
+
 # start the agent
 prefect agent start -q 'bmd-pool'
\ No newline at end of file
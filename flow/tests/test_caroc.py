@@ -0,0 +1,30 @@
+"""Run from the flow directory with python -m pytest tests."""
+
+import numpy as np
+from caroc import classify_risk, fracture_risk
+
+
+def test_thresholds_at_age_50():
+    ## Women aged 50: Low above -2.5, High below -3.8
+    assert fracture_risk(50, False, -2.4) == "Low"
+    assert fracture_risk(50, False, -2.5) == "Moderate"
+    assert fracture_risk(50, False, -3.8) == "Moderate"
+    assert fracture_risk(50, False, -3.9) == "High"
+
+
+def test_men_high_threshold_is_exclusive():
+    assert fracture_risk(50, True, -3.9) == "Moderate"
+    assert fracture_risk(50, True, -4.0) == "High"
+
+
+def test_vectorised_matches_single_study():
+    t_scores = [-2.4, -2.5, -3.8, -3.9]
+    assert list(classify_risk(50, False, t_scores)) == [
+        fracture_risk(50, False, t_score) for t_score in t_scores
+    ]
+
+
+def test_no_category_under_50_or_without_neck_t_score():
+    assert fracture_risk(49, False, -4.0) is None
+    assert fracture_risk(60, False, None) is None
+    assert classify_risk(60, False, np.nan, hip_or_vertebral_fracture=True).item() == "High"
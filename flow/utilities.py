@@ -1,14 +1,25 @@
-import os
+import os, glob
+from collections import namedtuple
 from requests.auth import HTTPBasicAuth
 from dicomweb_client.session_utils import create_session_from_auth
 import pydicom
+from pydicom import dcmread
 from pydicom.dataset import Dataset, FileMetaDataset
 from pydicom.uid import generate_uid, ExplicitVRLittleEndian, ComprehensiveSRStorage
 from pydicom.sequence import Sequence
 from datetime import datetime
 
+COMPREHENSIVE_SR_CLASS_UID = "1.2.840.10008.5.1.4.1.1.88.22"
+PREDICTOR_UID_ROOT = "1.2.826.0.1.3680043.10.1082."
+## REST endpoint of the Orthanc the studies are fetched from
+ORTHANC_URL = os.getenv("ORTHANC_URL", "http://orthanc:8042").rstrip("/")
 
-def orthanc_get_session():
+Instance = namedtuple(
+    "Instance", ["path", "sop_class_uid", "series_instance_uid", "accession"]
+)
+
+
+def orthanc_get_credentials():
     user = os.environ.get("ORTHANC_API_USER")
     if not user:
         user = "orthanc"
@@ -16,14 +27,17 @@ def orthanc_get_session():
     password = os.environ.get("ORTHANC_API_PASSWORD")
     if not password:
         password = "orthanc"
+    return user, password
+
 
-    orthanc_auth = HTTPBasicAuth(user, password)
+def orthanc_get_session():
+    orthanc_auth = HTTPBasicAuth(*orthanc_get_credentials())
     orthanc_session = create_session_from_auth(orthanc_auth)
     return orthanc_session
 
 
 def orthanc_get_url_root():
-    return "http://orthanc:8042"
+    return ORTHANC_URL
 
 
 def add_if_exists(ds: Dataset, field: str):
@@ -43,12 +57,11 @@ def add_if_exists(ds: Dataset, field: str):
 
 
 # Function to create a basic SR document
-def create_sr(ds, findings, diagnostic_category):
+def create_sr(ds, findings, diagnostic_category, fracture_risk=None):
     # Create a new FileDataset instance (instance of Dataset)
-    predictor_uid_root = "1.2.826.0.1.3680043.10.1082."
     series_num = 3
-    sop_uid = generate_uid(f"{predictor_uid_root}2.{series_num}.")
-    series_uid = generate_uid(f"{predictor_uid_root}2.{series_num}.")
+    sop_uid = generate_uid(f"{PREDICTOR_UID_ROOT}2.{series_num}.")
+    series_uid = generate_uid(f"{PREDICTOR_UID_ROOT}2.{series_num}.")
 
     file_meta = FileMetaDataset()
     file_meta.MediaStorageSOPClassUID = ComprehensiveSRStorage
@@ -99,6 +112,17 @@ def create_sr(ds, findings, diagnostic_category):
     content_item.TextValue = diagnostic_category
     sr_ds.ContentSequence.append(content_item)
 
+    # fracture_risk, left out when no category can be given
+    if fracture_risk is not None:
+        content_item = Dataset()
+        content_item.ValueType = "TEXT"
+        content_item.ConceptNameCodeSequence = Sequence([Dataset()])
+        content_item.ConceptNameCodeSequence[0].CodeValue = "0-0-3"
+        content_item.ConceptNameCodeSequence[0].CodingSchemeDesignator = "AIDE"
+        content_item.ConceptNameCodeSequence[0].CodeMeaning = "FRACTURE RISK CATEGORY"
+        content_item.TextValue = fracture_risk
+        sr_ds.ContentSequence.append(content_item)
+
     # Add reference to the original study
     sr_ds.ReferencedStudySequence = Sequence([Dataset()])
     sr_ds.ReferencedStudySequence[0].ReferencedSOPClassUID = ds.SOPClassUID
@@ -120,3 +144,38 @@ def get_value_from_dict(data_dict, keys):
         else:
             return None
     return data_dict
+
+
+def scan_instances(directory):
+    """Indexes the instances of a downloaded study from their headers only.
+
+    Only the handful of tags needed to route instances are parsed and reading
+    stops before the pixel data, so large DXA images are never decoded.
+
+    Args:
+        directory (str): Folder the study was extracted to.
+
+    Returns:
+        List of Instance tuples, one per file.
+    """
+    instances = []
+    for path in glob.glob(f"{directory}/IMAGES/*"):
+        ds = dcmread(
+            path,
+            stop_before_pixels=True,
+            specific_tags=["SOPClassUID", "SeriesInstanceUID", "AccessionNumber"],
+        )
+        instances.append(
+            Instance(
+                path=path,
+                sop_class_uid=str(ds.get("SOPClassUID", "")),
+                series_instance_uid=str(ds.get("SeriesInstanceUID", "")),
+                accession=str(ds.get("AccessionNumber", "")),
+            )
+        )
+    return instances
+
+
+def read_reference(instance):
+    """Reads the header of the instance the generated SR will reference."""
+    return dcmread(instance.path, stop_before_pixels=True)